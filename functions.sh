@@ -482,6 +482,7 @@ aead_encrypt() {
 			-iv 00000000000000000000000000000000	\
 	|
 	(tee >(openssl dgst					\
+			-sha256					\
 			-mac HMAC				\
 			-macopt hexkey:"$mackey"		\
 			-binary) ) > "$ciphertext_file"
@@ -523,6 +524,7 @@ aead_decrypt() {
 			bs=$((sz - 32))					\
 			count=1 2>/dev/null				\
 		 | openssl dgst						\
+				-sha256					\
 				-mac HMAC				\
 				-macopt hexkey:"$mackey"		\
 				-binary); then
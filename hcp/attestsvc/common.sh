@@ -28,6 +28,52 @@ if [[ -z "$HCP_ATTESTSVC_REMOTE_REPO" ]]; then
 	echo "Error, HCP_ATTESTSVC_REMOTE_REPO (\"$HCP_ATTESTSVC_REMOTE_REPO\") must be set" >&2
 	exit 1
 fi
+# The number of shards of the enrollment DB, see hcp/enrollsvc/common.sh. It
+# must match that of the enrollment service. Shard <i> is replicated from
+# $HCP_ATTESTSVC_REMOTE_REPO-<i>, see init_clones.sh.
+HCP_ATTESTSVC_SHARDS=${HCP_ATTESTSVC_SHARDS:-1}
+if ! [[ $HCP_ATTESTSVC_SHARDS =~ ^[0-9]+$ && $HCP_ATTESTSVC_SHARDS -ge 1 &&
+		$HCP_ATTESTSVC_SHARDS -le 256 ]]; then
+	echo "Error, HCP_ATTESTSVC_SHARDS (\"$HCP_ATTESTSVC_SHARDS\") must be from 1 to 256" >&2
+	exit 1
+fi
+# What the replica keeps of the enrollment DB, i.e. "git" (the default), two
+# clones of each shard's repo (see init_clones.sh), or "kv", a key-value store
+# of the enrollments, kept up to date from the enrollment service's change feed
+# (see kv_update.py), which is at HCP_ATTESTSVC_NOTIFY_URL.
+HCP_ATTESTSVC_STORE=${HCP_ATTESTSVC_STORE:-git}
+if [[ $HCP_ATTESTSVC_STORE != git && $HCP_ATTESTSVC_STORE != kv ]]; then
+	echo "Error, HCP_ATTESTSVC_STORE (\"$HCP_ATTESTSVC_STORE\") must be \"git\" or \"kv\"" >&2
+	exit 1
+fi
+if [[ $HCP_ATTESTSVC_STORE == kv && -z "$HCP_ATTESTSVC_NOTIFY_URL" ]]; then
+	echo "Error, HCP_ATTESTSVC_NOTIFY_URL must be set if HCP_ATTESTSVC_STORE is \"kv\"" >&2
+	exit 1
+fi
+KV_DIR=$HCP_ATTESTSVC_STATE_PREFIX/kv
+KV_PATH=$KV_DIR/enrolldb.sqlite
+# The replicas that the (sharded) DB is partitioned across, if it is, as
+# comma-separated "<name>=<url>" pairs (the same for each of them, the URL
+# being that of the attestation service), and the name of this one. Each
+# replica then has only the shards that the consistent hash ring of
+# sbin/attest_partition.py gives it (see rebalance.sh), and the attestation
+# service passes quotes whose enrollments are on other replicas on to them (or,
+# if HCP_ATTESTSVC_PARTITION_MODE is "redirect", redirects the clients).
+if [[ -n "$HCP_ATTESTSVC_PEERS" ]]; then
+	if [[ $HCP_ATTESTSVC_SHARDS -eq 1 ]]; then
+		echo "Error, HCP_ATTESTSVC_PEERS is set, but the DB isn't sharded" >&2
+		exit 1
+	fi
+	if [[ ",$HCP_ATTESTSVC_PEERS" != *",$HCP_ATTESTSVC_NAME="* ]]; then
+		echo "Error, HCP_ATTESTSVC_NAME (\"$HCP_ATTESTSVC_NAME\") isn't one of HCP_ATTESTSVC_PEERS" >&2
+		exit 1
+	fi
+fi
+HCP_ATTESTSVC_PARTITION_MODE=${HCP_ATTESTSVC_PARTITION_MODE:-proxy}
+if [[ $HCP_ATTESTSVC_PARTITION_MODE != proxy && $HCP_ATTESTSVC_PARTITION_MODE != redirect ]]; then
+	echo "Error, HCP_ATTESTSVC_PARTITION_MODE (\"$HCP_ATTESTSVC_PARTITION_MODE\") must be \"proxy\" or \"redirect\"" >&2
+	exit 1
+fi
 if [[ -z "$HCP_ATTESTSVC_UPDATE_TIMER" ]]; then
 	echo "Error, HCP_ATTESTSVC_UPDATE_TIMER (\"$HCP_ATTESTSVC_UPDATE_TIMER\") must be set" >&2
 	exit 1
@@ -62,10 +108,31 @@ if [[ `whoami` == "root" ]]; then
 	echo "HCP_ATTESTSVC_STATE_PREFIX=$HCP_ATTESTSVC_STATE_PREFIX" >> /etc/environment
 	echo "HCP_ATTESTSVC_REMOTE_REPO=$HCP_ATTESTSVC_REMOTE_REPO" >> /etc/environment
 	echo "HCP_ATTESTSVC_UPDATE_TIMER=$HCP_ATTESTSVC_UPDATE_TIMER" >> /etc/environment
+	echo "HCP_ATTESTSVC_SHARDS=$HCP_ATTESTSVC_SHARDS" >> /etc/environment
+	echo "HCP_ATTESTSVC_NOTIFY_URL=$HCP_ATTESTSVC_NOTIFY_URL" >> /etc/environment
+	echo "HCP_ATTESTSVC_STORE=$HCP_ATTESTSVC_STORE" >> /etc/environment
+	echo "HCP_ATTESTSVC_PEERS=$HCP_ATTESTSVC_PEERS" >> /etc/environment
+	echo "HCP_ATTESTSVC_NAME=$HCP_ATTESTSVC_NAME" >> /etc/environment
+	echo "HCP_ATTESTSVC_PARTITION_MODE=$HCP_ATTESTSVC_PARTITION_MODE" >> /etc/environment
 	echo "SAFEBOOT_UWSGI=$SAFEBOOT_UWSGI" >> /etc/environment
 	echo "SAFEBOOT_UWSGI_FLAGS=$SAFEBOOT_UWSGI_FLAGS" >> /etc/environment
 	echo "SAFEBOOT_UWSGI_PORT=$SAFEBOOT_UWSGI_PORT" >> /etc/environment
 	echo "SAFEBOOT_UWSGI_OPTIONS=$SAFEBOOT_UWSGI_OPTIONS" >> /etc/environment
+	echo "SAFEBOOT_ATTEST_ENGINE=$SAFEBOOT_ATTEST_ENGINE" >> /etc/environment
+	echo "SAFEBOOT_ATTEST_SERVER=$SAFEBOOT_ATTEST_SERVER" >> /etc/environment
+	echo "SAFEBOOT_ASGI=$SAFEBOOT_ASGI" >> /etc/environment
+	echo "SAFEBOOT_ASYNC_WORKERS=$SAFEBOOT_ASYNC_WORKERS" >> /etc/environment
+	echo "SAFEBOOT_ASYNC_QUEUE=$SAFEBOOT_ASYNC_QUEUE" >> /etc/environment
+	echo "SAFEBOOT_ASYNC_RETRY_AFTER=$SAFEBOOT_ASYNC_RETRY_AFTER" >> /etc/environment
+	echo "SAFEBOOT_EK_CACHE_SIZE=$SAFEBOOT_EK_CACHE_SIZE" >> /etc/environment
+	echo "SAFEBOOT_EK_CACHE_TTL=$SAFEBOOT_EK_CACHE_TTL" >> /etc/environment
+	echo "SAFEBOOT_EK_RELOAD_INTERVAL=$SAFEBOOT_EK_RELOAD_INTERVAL" >> /etc/environment
+	echo "SAFEBOOT_QUOTE_MAX_SIZE=$SAFEBOOT_QUOTE_MAX_SIZE" >> /etc/environment
+	echo "SAFEBOOT_PAYLOAD_CACHE_SIZE=$SAFEBOOT_PAYLOAD_CACHE_SIZE" >> /etc/environment
+	echo "SAFEBOOT_BATCH_WORKERS=$SAFEBOOT_BATCH_WORKERS" >> /etc/environment
+	echo "SAFEBOOT_BATCH_MAX_ITEMS=$SAFEBOOT_BATCH_MAX_ITEMS" >> /etc/environment
+	echo "SAFEBOOT_BATCH_MAX_SIZE=$SAFEBOOT_BATCH_MAX_SIZE" >> /etc/environment
+	echo "SAFEBOOT_SLOW_REQUEST_MS=$SAFEBOOT_SLOW_REQUEST_MS" >> /etc/environment
 	echo "HCP_ENVIRONMENT_SET=1" >> /etc/environment
 fi
 
@@ -76,10 +143,31 @@ echo "                    HCP_USER=$HCP_USER" >&2
 echo "  HCP_ATTESTSVC_STATE_PREFIX=$HCP_ATTESTSVC_STATE_PREFIX" >&2
 echo "   HCP_ATTESTSVC_REMOTE_REPO=$HCP_ATTESTSVC_REMOTE_REPO" >&2
 echo "  HCP_ATTESTSVC_UPDATE_TIMER=$HCP_ATTESTSVC_UPDATE_TIMER" >&2
+echo "        HCP_ATTESTSVC_SHARDS=$HCP_ATTESTSVC_SHARDS" >&2
+echo "    HCP_ATTESTSVC_NOTIFY_URL=$HCP_ATTESTSVC_NOTIFY_URL" >&2
+echo "         HCP_ATTESTSVC_STORE=$HCP_ATTESTSVC_STORE" >&2
+echo "         HCP_ATTESTSVC_PEERS=$HCP_ATTESTSVC_PEERS" >&2
+echo "          HCP_ATTESTSVC_NAME=$HCP_ATTESTSVC_NAME" >&2
+echo "HCP_ATTESTSVC_PARTITION_MODE=$HCP_ATTESTSVC_PARTITION_MODE" >&2
 echo "              SAFEBOOT_UWSGI=$SAFEBOOT_UWSGI" >&2
 echo "        SAFEBOOT_UWSGI_FLAGS=$SAFEBOOT_UWSGI_FLAGS" >&2
 echo "         SAFEBOOT_UWSGI_PORT=$SAFEBOOT_UWSGI_PORT" >&2
 echo "      SAFEBOOT_UWSGI_OPTIONS=$SAFEBOOT_UWSGI_OPTIONS" >&2
+echo "      SAFEBOOT_ATTEST_ENGINE=$SAFEBOOT_ATTEST_ENGINE" >&2
+echo "      SAFEBOOT_ATTEST_SERVER=$SAFEBOOT_ATTEST_SERVER" >&2
+echo "               SAFEBOOT_ASGI=$SAFEBOOT_ASGI" >&2
+echo "      SAFEBOOT_ASYNC_WORKERS=$SAFEBOOT_ASYNC_WORKERS" >&2
+echo "        SAFEBOOT_ASYNC_QUEUE=$SAFEBOOT_ASYNC_QUEUE" >&2
+echo "  SAFEBOOT_ASYNC_RETRY_AFTER=$SAFEBOOT_ASYNC_RETRY_AFTER" >&2
+echo "      SAFEBOOT_EK_CACHE_SIZE=$SAFEBOOT_EK_CACHE_SIZE" >&2
+echo "       SAFEBOOT_EK_CACHE_TTL=$SAFEBOOT_EK_CACHE_TTL" >&2
+echo " SAFEBOOT_EK_RELOAD_INTERVAL=$SAFEBOOT_EK_RELOAD_INTERVAL" >&2
+echo "     SAFEBOOT_QUOTE_MAX_SIZE=$SAFEBOOT_QUOTE_MAX_SIZE" >&2
+echo " SAFEBOOT_PAYLOAD_CACHE_SIZE=$SAFEBOOT_PAYLOAD_CACHE_SIZE" >&2
+echo "      SAFEBOOT_BATCH_WORKERS=$SAFEBOOT_BATCH_WORKERS" >&2
+echo "    SAFEBOOT_BATCH_MAX_ITEMS=$SAFEBOOT_BATCH_MAX_ITEMS" >&2
+echo "     SAFEBOOT_BATCH_MAX_SIZE=$SAFEBOOT_BATCH_MAX_SIZE" >&2
+echo "    SAFEBOOT_SLOW_REQUEST_MS=$SAFEBOOT_SLOW_REQUEST_MS" >&2
 
 # Basic functions
 
@@ -100,3 +188,44 @@ function expect_hcp_user {
 function drop_privs_hcp {
 	su -c "$*" - $HCP_USER
 }
+
+# The shards that this replica has, i.e. all of them, unless the DB is
+# partitioned (see HCP_ATTESTSVC_PEERS)
+function my_shards {
+	if [[ -z "$HCP_ATTESTSVC_PEERS" ]]; then
+		seq 0 $((HCP_ATTESTSVC_SHARDS - 1))
+		return
+	fi
+	python3 /safeboot/sbin/attest_partition.py shards "$HCP_ATTESTSVC_PEERS" \
+		$HCP_ATTESTSVC_NAME $HCP_ATTESTSVC_SHARDS
+}
+
+# Two clones of $2 in directory $1, each with its index (see ekindex.py), and
+# two symlinks, which updater_loop.sh swaps.
+function init_clones {
+	cd $1
+	if [[ -d A || -d B || -h current || -h next || -h thirdwheel ]]; then
+		echo "Error, updater state half-baked?"
+		exit 1
+	fi
+	git clone $2 A
+	git clone $2 B
+	ln -s A current
+	ln -s B next
+	(cd A && git remote add twin ../B && git fetch twin)
+	(cd B && git remote add twin ../A && git fetch twin)
+	/hcp/attestsvc/ekindex.py build A
+	/hcp/attestsvc/ekindex.py build B
+}
+
+# The clones of shard $1 of a sharded DB, in shard-$1
+function init_shard {
+	mkdir -p $HCP_ATTESTSVC_STATE_PREFIX/shard-$1
+	init_clones $HCP_ATTESTSVC_STATE_PREFIX/shard-$1 \
+		$HCP_ATTESTSVC_REMOTE_REPO-$1
+	# check that the enrollment service agrees about which shard it is
+	if [[ `cat A/shard` != "$1 $HCP_ATTESTSVC_SHARDS" ]]; then
+		echo "Error, $HCP_ATTESTSVC_REMOTE_REPO-$1 isn't shard $1 of $HCP_ATTESTSVC_SHARDS"
+		exit 1
+	fi
+}
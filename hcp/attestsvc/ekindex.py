@@ -0,0 +1,252 @@
+#!/usr/bin/python3
+
+# The index of the enrollments in a clone of the enrollment DB, that the
+# attestation service (see sbin/attest_policy.py) maps into memory, so that
+# finding an enrollment and its golden PCRs is a probe of the mapping, rather
+# than a handful of lookups of paths in the checkout. updater_loop.sh builds
+# the index of the 'next' clone once it is up to date, swaps it in with the
+# clone, and then retires the index of the clone that was swapped out.
+#
+# The index is <clone>/.git/INDEX_BASENAME (out of the checkout, so git doesn't
+# see it), and is a file of;
+#   - a header (HEADER), of;
+#       - the magic (MAGIC),
+#       - the "retired" byte, which is set (in place, the one time the file is
+#         changed) once it is no longer the index of the current clone, so that
+#         readers (whose mappings see it straight away) know to map the new one,
+#       - the offset and the number of the slots, and the number of entries,
+#       - the commit that the index is of,
+#   - the golden PCRs (the 'pcrs' file) of each enrollment that has them,
+#   - a hash table of slots (SLOT), open addressed and probed linearly from the
+#     slot given by the first 8 bytes of the key (the ekpubhash is a hash
+#     already), each with;
+#       - the key, i.e. the ekpubhash truncated to 32 characters (as the
+#         per-TPM directories are named, see hcp/enrollsvc/common_defs.sh), as
+#         16 bytes,
+#       - the flags (F_*), 0 if the slot is empty,
+#       - the offset and length of the golden PCRs.
+# The enrollments themselves are not copied into the index, and are read from
+# the checkout (the path is given by the key, and F_PACKED).
+#
+# An index is written to a temporary file, and renamed into place, so a reader
+# that has the old one mapped carries on with that. If the clone has an index
+# already, the new one is built from that and the enrollments that have changed
+# since its commit, rather than by reading the whole checkout again.
+#
+# Usage;
+#   ekindex.py build <clone-dir>
+#   ekindex.py retire <clone-dir>
+
+import mmap
+import os
+import struct
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+INDEX_BASENAME = 'hcp-index'
+EK_BASENAME = 'ekpubhash'
+# See common_defs.sh
+RECORD_SUFFIX = '.tar'
+
+MAGIC = b'HCPEKIX1'
+# magic, retired, slots offset, number of slots, number of entries, commit
+HEADER = struct.Struct('<8sB7xQQQ64s')
+RETIRED_OFFSET = 8
+# key, flags, PCRs offset, PCRs length
+SLOT = struct.Struct('<16sIQI')
+
+F_USED = 1
+F_PACKED = 2
+F_PHASE2 = 4
+F_PCRS = 8
+
+class EKIndexError(Exception):
+    pass
+
+def index_path(clone):
+    return os.path.join(clone, '.git', INDEX_BASENAME)
+
+def git(clone, *args):
+    c = subprocess.run([ 'git', '-C', clone ] + list(args),
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if c.returncode != 0:
+        raise EKIndexError(f"git {args[0]} failed: {c.stderr.decode(errors='replace').strip()}")
+    return c.stdout
+
+def is_key(name):
+    return len(name) == 32 and all(c in '0123456789abcdef' for c in name)
+
+# The enrollment in the checkout, as (flags, pcrs), or None if there isn't one
+def read_entry(clone, ply3):
+    path = os.path.join(clone, EK_BASENAME, ply3[0:2], ply3[0:6], ply3)
+    files = {}
+    if os.path.isdir(path):
+        flags = F_USED
+        for name in os.listdir(path):
+            files[name] = None
+        if 'pcrs' in files:
+            with open(os.path.join(path, 'pcrs'), 'rb') as f:
+                files['pcrs'] = f.read()
+    elif os.path.isfile(path + RECORD_SUFFIX):
+        flags = F_USED | F_PACKED
+        # the last of a file that is in the record twice wins
+        with tarfile.open(path + RECORD_SUFFIX, mode='r:') as tar:
+            for info in tar:
+                name = os.path.normpath(info.name)
+                if info.isfile() and '/' not in name:
+                    files[name] = tar.extractfile(info).read() if name == 'pcrs' else None
+    else:
+        return None
+    if 'phase2' in files:
+        flags |= F_PHASE2
+    if files.get('pcrs') is not None:
+        flags |= F_PCRS
+    return flags, files.get('pcrs')
+
+# The ply3s of the enrollments in the checkout
+def checkout_keys(clone):
+    def subdirs(path):
+        try:
+            return sorted(os.listdir(path))
+        except (FileNotFoundError, NotADirectoryError):
+            # e.g. ekpubhash/do_not_remove
+            return []
+    top = os.path.join(clone, EK_BASENAME)
+    for ply1 in subdirs(top):
+        for ply2 in subdirs(os.path.join(top, ply1)):
+            for name in subdirs(os.path.join(top, ply1, ply2)):
+                if name.endswith(RECORD_SUFFIX):
+                    name = name[:-len(RECORD_SUFFIX)]
+                yield name
+
+class Index:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mm) < HEADER.size:
+            raise EKIndexError(f"{path}: truncated")
+        magic, self.retired, self.slots_off, self.nslots, self.nentries, commit = \
+            HEADER.unpack_from(self.mm)
+        if magic != MAGIC:
+            raise EKIndexError(f"{path}: not an index")
+        self.commit = commit.rstrip(b'\0').decode()
+
+    # Yields (ply3, flags, pcrs) for each entry
+    def entries(self):
+        for i in range(self.nslots):
+            key, flags, off, n = SLOT.unpack_from(self.mm, self.slots_off + i * SLOT.size)
+            if flags:
+                yield key.hex(), flags, self.mm[off:off + n] if flags & F_PCRS else None
+
+# Writes the index of the entries (a dict of { ply3: (flags, pcrs) }) at
+# 'commit' to 'path'
+def write(path, commit, entries):
+    nslots = 16
+    while nslots < 2 * len(entries):
+        nslots *= 2
+    slots = bytearray(nslots * SLOT.size)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(bytes(HEADER.size))
+            off = HEADER.size
+            for ply3, (flags, pcrs) in entries.items():
+                key = bytes.fromhex(ply3)
+                i = int.from_bytes(key[0:8], 'little') & (nslots - 1)
+                while SLOT.unpack_from(slots, i * SLOT.size)[1]:
+                    i = (i + 1) & (nslots - 1)
+                n = len(pcrs) if pcrs is not None else 0
+                SLOT.pack_into(slots, i * SLOT.size, key, flags, off, n)
+                if n:
+                    f.write(pcrs)
+                    off += n
+            pad = -off % 8
+            f.write(bytes(pad))
+            slots_off = off + pad
+            f.write(slots)
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, 0, slots_off, nslots, len(entries), commit.encode()))
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+# The ply3s of the enrollments that changed between two commits
+def changed_keys(clone, old, new):
+    out = git(clone, 'diff', '--name-only', '--no-renames', '-z', old, new, '--', EK_BASENAME)
+    changed = set()
+    for name in out.split(b'\0'):
+        parts = name.decode().split('/')
+        if len(parts) == 4 and parts[3].endswith(RECORD_SUFFIX):
+            changed.add(parts[3][:-len(RECORD_SUFFIX)])
+        elif len(parts) == 5:
+            changed.add(parts[3])
+    return changed
+
+# Builds (or rebuilds) the index of the clone, as of its current commit.
+# Returns the number of entries read from the checkout, and in the index.
+def build(clone):
+    path = index_path(clone)
+    commit = git(clone, 'rev-parse', '--verify', 'HEAD').decode().strip()
+    try:
+        old = Index(path)
+    except (OSError, EKIndexError):
+        old = None
+    entries, changed = {}, None
+    if old is not None:
+        # (a retired one is written again, as it is to be current again)
+        if old.commit == commit and not old.retired:
+            return 0, old.nentries
+        try:
+            changed = changed_keys(clone, old.commit, commit)
+            for ply3, flags, pcrs in old.entries():
+                entries[ply3] = (flags, bytes(pcrs) if pcrs is not None else None)
+        except EKIndexError:
+            pass
+    if changed is None:
+        entries, changed = {}, set(checkout_keys(clone))
+    for ply3 in changed:
+        entries.pop(ply3, None)
+        # the attestation service looks up the first 32 characters of a
+        # (64 character) ekpubhash, so no shorter one can be found
+        if not is_key(ply3):
+            continue
+        entry = read_entry(clone, ply3)
+        if entry is not None:
+            entries[ply3] = entry
+    write(path, commit, entries)
+    return len(changed), len(entries)
+
+# Tells the readers of the clone's index that it is no longer current
+def retire(clone):
+    try:
+        fd = os.open(index_path(clone), os.O_WRONLY)
+    except FileNotFoundError:
+        return
+    try:
+        os.pwrite(fd, b'\1', RETIRED_OFFSET)
+    finally:
+        os.close(fd)
+
+if __name__ == '__main__':
+    from sys import argv
+
+    if len(argv) == 3 and argv[1] == 'build':
+        try:
+            n, total = build(argv[2])
+        except (OSError, EKIndexError, tarfile.TarError) as e:
+            print(f"Error, unable to build the index: {e}", file=sys.stderr)
+            sys.exit(1)
+        print(f"indexed {total} enrollments ({n} read)")
+        sys.exit(0)
+
+    if len(argv) == 3 and argv[1] == 'retire':
+        retire(argv[2])
+        sys.exit(0)
+
+    print("Usage: ekindex.py build <clone-dir>", file=sys.stderr)
+    print("       ekindex.py retire <clone-dir>", file=sys.stderr)
+    sys.exit(1)
@@ -8,15 +8,53 @@ cd $HCP_ATTESTSVC_STATE_PREFIX
 
 echo "$HCP_VER" > version
 
-if [[ -d A || -d B || -h current || -h next || -h thirdwheel ]]; then
+# A key-value store (see common.sh) is filled in from the change feed of each
+# shard (that the replica has), so that it is ready for the attestation
+# service to use.
+if [[ $HCP_ATTESTSVC_STORE == kv ]]; then
+	echo "First-time initialization of $HCP_ATTESTSVC_STATE_PREFIX. Key-value store."
+	if [[ -e $KV_DIR ]]; then
+		echo "Error, updater state half-baked?"
+		exit 1
+	fi
+	mkdir $KV_DIR
+	for shard in `my_shards`; do
+		/hcp/attestsvc/kv_update.py $KV_PATH $HCP_ATTESTSVC_NOTIFY_URL \
+			$shard $HCP_ATTESTSVC_SHARDS 0
+	done
+	exit 0
+fi
+
+if [[ $HCP_ATTESTSVC_SHARDS -eq 1 ]]; then
+	echo "First-time initialization of $HCP_ATTESTSVC_STATE_PREFIX. Two clones and two symlinks."
+	init_clones $HCP_ATTESTSVC_STATE_PREFIX $HCP_ATTESTSVC_REMOTE_REPO
+	exit 0
+fi
+
+# A sharded DB (see hcp/enrollsvc/common.sh) has the above for each shard, in
+# shard-<i> (see init_shard, in common.sh), so that updater_loop.sh can update each of them independently.
+# The attestation service reads 'current', which here is a directory that
+# links each of the 256 first-ply directories of 'ekpubhash' to the same one
+# in the 'current' clone of its shard (so it follows each shard's swaps). If
+# the DB is partitioned, only the replica's shards are cloned, and the links of
+# the others go nowhere (until rebalance.sh clones them, if the replica is
+# given them).
+echo "First-time initialization of $HCP_ATTESTSVC_STATE_PREFIX. $HCP_ATTESTSVC_SHARDS shards."
+if [[ -e current ]]; then
 	echo "Error, updater state half-baked?"
 	exit 1
 fi
-
-echo "First-time initialization of $HCP_ATTESTSVC_STATE_PREFIX. Two clones and two symlinks."
-git clone $HCP_ATTESTSVC_REMOTE_REPO A
-git clone $HCP_ATTESTSVC_REMOTE_REPO B
-ln -s A current
-ln -s B next
-(cd A && git remote add twin ../B && git fetch twin)
-(cd B && git remote add twin ../A && git fetch twin)
+shards=`my_shards`
+for shard in $shards; do
+	init_shard $shard
+done
+cd $HCP_ATTESTSVC_STATE_PREFIX
+mkdir -p current/ekpubhash
+# (The same mapping as shard_of, in common_defs.sh)
+for ((ply1 = 0; ply1 < 256; ply1++)); do
+	hex=`printf "%02x" $ply1`
+	shard=$((ply1 * HCP_ATTESTSVC_SHARDS / 256))
+	ln -s ../../shard-$shard/current/ekpubhash/$hex current/ekpubhash/$hex
+done
+set -- $shards
+ln -s ../shard-${1:-0}/current/tofu_pcrs current/tofu_pcrs
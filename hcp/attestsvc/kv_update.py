@@ -0,0 +1,199 @@
+#!/usr/bin/python3
+
+# Keeps the replica's key-value store of the enrollments up to date from the
+# enrollment service's change feed (see hcp/enrollsvc/changefeed.py). This is
+# what updater_loop.sh runs (for each shard) if HCP_ATTESTSVC_STORE is "kv",
+# instead of keeping clones of the repos, and the attestation service then reads
+# the store (see sbin/attest_policy.py).
+#
+# The store is an sqlite database, with a table ('records') of the enrollments,
+# each one's packed record (see hcp/enrollsvc/common_defs.sh) keyed by its
+# ekpubhash (truncated to 32 characters, as the per-TPM directories are named),
+# and a table ('feed') of how far the feed of each shard has been applied. Each
+# page of changes is applied in one transaction, with the new position, so the
+# store always has each shard as it was at one commit, readers (in WAL mode) see
+# that until the next transaction is committed, and a restart carries on from
+# the last page that was applied. If there's no position yet, or the feed says
+# that it is no good (i.e. to resync), the shard's enrollments are replaced
+# with its snapshot, in one transaction once that has been downloaded.
+#
+# Exits with 0 once the shard is caught up and (unless <seconds> is 0) it has
+# waited that long for more changes (and applied them), and non-zero if the
+# feed can't be had. It writes what it did, if anything, to stdout.
+#
+# If the replicas partition the DB between them (see common.sh), a replica that
+# no longer has a shard drops it from the store (see rebalance.sh).
+#
+# Usage;
+#   kv_update.py <kv-path> <feed-url> <shard> <shards> <seconds>
+#   kv_update.py drop <kv-path> <shard> <shards>
+
+import base64
+import json
+import sqlite3
+import sys
+import tempfile
+import urllib.error
+import urllib.parse
+import urllib.request
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS records (ekhash TEXT PRIMARY KEY, record BLOB NOT NULL) WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS feed (shard INTEGER PRIMARY KEY, epoch TEXT NOT NULL, seq INTEGER NOT NULL)',
+]
+
+PAGE_SIZE = 100
+
+class Resync(Exception):
+    pass
+
+class FeedError(Exception):
+    pass
+
+def open_store(path):
+    # the other shards' updaters, and the attestation service's TOFU writes,
+    # may be in the middle of a transaction
+    conn = sqlite3.connect(path, timeout=60)
+    conn.execute('PRAGMA journal_mode=WAL')
+    for statement in SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+    return conn
+
+# The ekpubhash range (from, to) of a shard, as shard_of (in
+# hcp/enrollsvc/common_defs.sh) has it. 'g' sorts after any hex digit.
+def shard_range(shard, shards):
+    lo = (shard * 256 + shards - 1) // shards
+    hi = ((shard + 1) * 256 + shards - 1) // shards
+    return '%02x' % lo, '%02x' % hi if hi < 256 else 'g'
+
+def get(url, timeout):
+    try:
+        return urllib.request.urlopen(url, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if e.code == 410:
+            raise Resync()
+        raise FeedError(f"{url}: {e}")
+    except OSError as e:
+        raise FeedError(f"{url}: {e}")
+
+def check_shard(reply, shard, shards):
+    if reply.get('shard') != shard or reply.get('shards') != shards:
+        raise FeedError(f"the feed isn't that of shard {shard} of {shards}")
+
+# Replaces the shard's enrollments with its snapshot. Returns the number of them.
+def resync(conn, url, shard, shards):
+    # it is downloaded first, so as not to hold up the other writers for that
+    with tempfile.TemporaryFile() as f:
+        try:
+            with get(f"{url}/v1/snapshot?shard={shard}", 60) as r:
+                while True:
+                    chunk = r.read(65536)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+        except OSError as e:
+            raise FeedError(f"snapshot of shard {shard}: {e}")
+        f.seek(0)
+        lines = iter(f)
+        try:
+            header = json.loads(next(lines))
+            check_shard(header, shard, shards)
+            lo, hi = shard_range(shard, shards)
+            with conn:
+                conn.execute('DELETE FROM records WHERE ekhash >= ? AND ekhash < ?', (lo, hi))
+                n = 0
+                for line in lines:
+                    entry = json.loads(line)
+                    if 'end' in entry:
+                        break
+                    conn.execute('INSERT OR REPLACE INTO records VALUES (?, ?)',
+                                 (entry['ekpubhash'], base64.b64decode(entry['record'])))
+                    n += 1
+                else:
+                    raise FeedError(f"snapshot of shard {shard} is incomplete")
+                if entry['end'] != n:
+                    raise FeedError(f"snapshot of shard {shard} is incomplete")
+                conn.execute('INSERT OR REPLACE INTO feed VALUES (?, ?, ?)',
+                             (shard, header['epoch'], header['seq']))
+        except (StopIteration, ValueError, KeyError) as e:
+            raise FeedError(f"snapshot of shard {shard} is malformed: {e}")
+    return n, header['seq']
+
+# Applies a page of changes, and the new position, in one transaction
+def apply(conn, shard, page):
+    with conn:
+        for change in page['changes']:
+            if change['op'] == 'upsert':
+                conn.execute('INSERT OR REPLACE INTO records VALUES (?, ?)',
+                             (change['ekpubhash'], base64.b64decode(change['record'])))
+            else:
+                conn.execute('DELETE FROM records WHERE ekhash = ?', (change['ekpubhash'],))
+        conn.execute('INSERT OR REPLACE INTO feed VALUES (?, ?, ?)',
+                     (shard, page['epoch'], page['seq']))
+
+# Removes the shard's enrollments, and its position
+def drop(conn, shard, shards):
+    lo, hi = shard_range(shard, shards)
+    with conn:
+        n = conn.execute('DELETE FROM records WHERE ekhash >= ? AND ekhash < ?', (lo, hi)).rowcount
+        conn.execute('DELETE FROM feed WHERE shard = ?', (shard,))
+    return n
+
+def sync(conn, url, shard, shards, wait):
+    applied, caught_up, waited = 0, False, False
+    while True:
+        row = conn.execute('SELECT epoch, seq FROM feed WHERE shard = ?', (shard,)).fetchone()
+        try:
+            if row is None:
+                raise Resync()
+            # once caught up, wait for more (the once)
+            w = wait if caught_up and not waited else 0
+            waited = waited or w > 0
+            query = urllib.parse.urlencode({ 'shard': shard, 'epoch': row[0], 'after': row[1],
+                                             'limit': PAGE_SIZE, 'wait': w })
+            with get(f"{url}/v1/changes?{query}", w + 60) as r:
+                page = json.load(r)
+        except Resync:
+            n, seq = resync(conn, url, shard, shards)
+            print(f"resynced, {n} enrollments, at {seq}")
+            continue
+        except (OSError, ValueError) as e:
+            raise FeedError(f"changes of shard {shard}: {e}")
+        check_shard(page, shard, shards)
+        try:
+            apply(conn, shard, page)
+        except (KeyError, ValueError) as e:
+            raise FeedError(f"changes of shard {shard} are malformed: {e}")
+        applied += len(page['changes'])
+        caught_up = page['seq'] >= page['head']
+        if caught_up and (waited or wait == 0):
+            break
+    if applied:
+        print(f"applied {applied} changes, at {page['seq']}")
+
+if __name__ == '__main__':
+    from sys import argv
+
+    if len(argv) == 5 and argv[1] == 'drop' and all(arg.isdigit() for arg in argv[3:]):
+        try:
+            n = drop(open_store(argv[2]), int(argv[3]), int(argv[4]))
+        except sqlite3.Error as e:
+            print(f"Error, {e}", file=sys.stderr)
+            sys.exit(1)
+        if n:
+            print(f"dropped shard {argv[3]}, {n} enrollments")
+        sys.exit(0)
+
+    if len(argv) != 6 or not all(arg.isdigit() for arg in argv[3:]):
+        print("Usage: kv_update.py <kv-path> <feed-url> <shard> <shards> <seconds>",
+              file=sys.stderr)
+        print("       kv_update.py drop <kv-path> <shard> <shards>", file=sys.stderr)
+        sys.exit(1)
+
+    conn = open_store(argv[1])
+    try:
+        sync(conn, argv[2], int(argv[3]), int(argv[4]), int(argv[5]))
+    except (FeedError, sqlite3.Error) as e:
+        print(f"Error, {e}", file=sys.stderr)
+        sys.exit(1)
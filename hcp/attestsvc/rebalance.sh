@@ -0,0 +1,41 @@
+#!/bin/bash
+
+. /hcp/attestsvc/common.sh
+
+expect_hcp_user
+
+cd $HCP_ATTESTSVC_STATE_PREFIX
+
+# If the DB is partitioned (see HCP_ATTESTSVC_PEERS in common.sh), the shards
+# that the replica has change with the replicas that it is partitioned across.
+# run_repl.sh runs this before updater_loop.sh, so that a replica that has been
+# given shards clones them (or fills them in from the change feed, which
+# kv_update.py does by itself for a shard that the key-value store doesn't have
+# yet), and one that no longer has shards drops them. The consistent hash ring
+# moves as few shards as it can, so the others are left as they are.
+
+if [[ -z "$HCP_ATTESTSVC_PEERS" ]]; then
+	exit 0
+fi
+
+shards=" `my_shards | tr '\n' ' '`"
+for ((shard = 0; shard < HCP_ATTESTSVC_SHARDS; shard++)); do
+	if [[ $shards == *" $shard "* ]]; then
+		if [[ $HCP_ATTESTSVC_STORE == git && ! -d shard-$shard ]]; then
+			echo "Rebalancing, cloning shard $shard"
+			init_shard $shard
+			cd $HCP_ATTESTSVC_STATE_PREFIX
+		fi
+	elif [[ $HCP_ATTESTSVC_STORE == kv ]]; then
+		/hcp/attestsvc/kv_update.py drop $KV_PATH $shard $HCP_ATTESTSVC_SHARDS
+	elif [[ -d shard-$shard ]]; then
+		echo "Rebalancing, dropping shard $shard"
+		rm -rf shard-$shard
+	fi
+done
+
+# (see init_clones.sh)
+if [[ $HCP_ATTESTSVC_STORE == git ]]; then
+	set -- $shards
+	ln -s -f -n ../shard-${1:-0}/current/tofu_pcrs current/tofu_pcrs
+fi
@@ -17,6 +17,10 @@ fi
 (echo "Error: expected version $HCP_VER, but got '$state_version' instead" &&
 	exit 1) || exit 1
 
+# Take on (or drop) shards, if the replicas that the DB is partitioned across
+# have changed
+drop_privs_hcp /hcp/attestsvc/rebalance.sh
+
 echo "Running 'attestsvc-repl' service"
 
 drop_privs_hcp /hcp/attestsvc/updater_loop.sh
@@ -8,7 +8,31 @@ BACKOFF_TIMER=$(($HCP_ATTESTSVC_UPDATE_TIMER * 5))
 
 function datetime_log {
 	d=`date +"%Y%m%d-%H%M%S"`
-	echo "$d: $1"
+	echo "$d: $SHARD_LOG$1"
+}
+
+# How long each wait for a change notification lasts, before asking again
+NOTIFY_WAIT=60
+
+# Waits until there is something to fetch for shard $1, whose commit we have is
+# $2. With HCP_ATTESTSVC_NOTIFY_URL, that's as soon as the enrollment service's
+# change notification (see hcp/enrollsvc/notify.py) says that the commit has
+# moved, however long that takes, so an idle replica doesn't fetch at all.
+# Without it, or if the notification can't be had, it's after
+# HCP_ATTESTSVC_UPDATE_TIMER seconds, i.e. polling.
+function wait_for_update {
+	if [[ -n $HCP_ATTESTSVC_NOTIFY_URL ]]; then
+		datetime_log "waiting for a change to $2"
+		while /bin/true; do
+			rc=0
+			/hcp/attestsvc/wait_for_change.py $HCP_ATTESTSVC_NOTIFY_URL \
+				$1 $2 $NOTIFY_WAIT > /dev/null || rc=$?
+			[[ $rc -eq 0 ]] && return
+			[[ $rc -eq 1 ]] || break
+		done
+	fi
+	datetime_log "sleeping for $HCP_ATTESTSVC_UPDATE_TIMER seconds"
+	sleep $HCP_ATTESTSVC_UPDATE_TIMER
 }
 
 # By discipline and convention, we do all our bash with "-e", so make sure to
@@ -26,34 +50,89 @@ function datetime_log {
 # complexity - and new ways for things to go wrong - and is more likely to
 # "bury the lede" when someone sifts through the wreckage later trying to
 # figure out what happened.)
-while /bin/true; do
-	cd $HCP_ATTESTSVC_STATE_PREFIX
-	cd next
-	datetime_log "updating"
-	if (git fetch twin && git fetch origin && git merge origin/master); then
-		cd $HCP_ATTESTSVC_STATE_PREFIX
-		cp -P current thirdwheel
-		cp -T -P next current
-		mv -T thirdwheel next
-		datetime_log "sleeping for $HCP_ATTESTSVC_UPDATE_TIMER seconds"
-		sleep $HCP_ATTESTSVC_UPDATE_TIMER
+#
+# The loop updates the clones of shard $2 (0 if the DB isn't sharded) in
+# directory $1 (see init_clones.sh). Each update is indexed (see ekindex.py)
+# before it is swapped in, and the index of the clone that is swapped out is
+# then retired, which tells the attestation service to map the new one. An
+# update that can't be indexed is swapped in without an index, which the
+# attestation service copes with, rather than holding up the update.
+function update_loop {
+	while /bin/true; do
+		cd $1
+		cd next
+		datetime_log "updating"
+		if (git fetch twin && git fetch origin && git merge origin/master); then
+			if out=`/hcp/attestsvc/ekindex.py build .`; then
+				datetime_log "$out"
+			else
+				datetime_log "Warning, unable to index the update"
+				rm -f .git/hcp-index
+			fi
+			cd $1
+			cp -P current thirdwheel
+			cp -T -P next current
+			mv -T thirdwheel next
+			/hcp/attestsvc/ekindex.py retire next
+			wait_for_update $2 `git -C current rev-parse origin/master`
+		else
+			# TODO: we should alert that the fetch/merge failed. Such
+			# failures would (likely) point to a problem with the db we're
+			# replicating from, meaning the same failures are likely being
+			# reported by other instances that replicate from the same db.
+			# "We" can't provide much information about the db, beyond
+			# signaling the existence of an issue, so keep it concise.
+			# TODO: on the other hand, if the transient error handling and
+			# recovery steps below fail for any reason, that is a different
+			# matter entirely, and it means an operator needs to look at
+			# this node, irrespective of whether our troubles were caused
+			# by a db failure. I.e. we need error-handling around our
+			# error-handling, to raise a different kind of alert.
+			datetime_log "Transient error. Trying to revert from incomplete update."
+			git reset --hard
+			git clean -f -d -x
+			datetime_log "sleeping for $BACKOFF_TIMER seconds"
+			sleep $BACKOFF_TIMER
+		fi
+	done
+}
+
+# The loop that keeps the key-value store (see common.sh) up to date with the
+# change feed of shard $1. Each run of kv_update.py applies the changes there
+# are, then waits for more (and applies them) for up to NOTIFY_WAIT seconds.
+# The same goes for errors as above, i.e. those of kv_update.py are transient.
+function kv_loop {
+	while /bin/true; do
+		if out=`/hcp/attestsvc/kv_update.py $KV_PATH $HCP_ATTESTSVC_NOTIFY_URL \
+				$1 $HCP_ATTESTSVC_SHARDS $NOTIFY_WAIT`; then
+			[[ -n $out ]] && datetime_log "$out"
+		else
+			[[ -n $out ]] && datetime_log "$out"
+			datetime_log "Transient error. sleeping for $BACKOFF_TIMER seconds"
+			sleep $BACKOFF_TIMER
+		fi
+	done
+}
+
+if [[ $HCP_ATTESTSVC_SHARDS -eq 1 ]]; then
+	[[ $HCP_ATTESTSVC_STORE == kv ]] && kv_loop 0
+	update_loop $HCP_ATTESTSVC_STATE_PREFIX 0
+fi
+
+# A sharded DB has the clones of each shard in shard-<i> (or its part of the
+# key-value store), and each shard is updated by a loop of its own, so that
+# they are fetched (and swapped) independently, and a shard whose fetches fail
+# doesn't hold up the others. (If the DB is partitioned, that's each shard
+# that the replica has.) If any of the loops dies, kill the rest, for the same
+# reason as above.
+for shard in `my_shards`; do
+	if [[ $HCP_ATTESTSVC_STORE == kv ]]; then
+		SHARD_LOG="shard $shard: " kv_loop $shard &
 	else
-		# TODO: we should alert that the fetch/merge failed. Such
-		# failures would (likely) point to a problem with the db we're
-		# replicating from, meaning the same failures are likely being
-		# reported by other instances that replicate from the same db.
-		# "We" can't provide much information about the db, beyond
-		# signaling the existence of an issue, so keep it concise.
-		# TODO: on the other hand, if the transient error handling and
-		# recovery steps below fail for any reason, that is a different
-		# matter entirely, and it means an operator needs to look at
-		# this node, irrespective of whether our troubles were caused
-		# by a db failure. I.e. we need error-handling around our
-		# error-handling, to raise a different kind of alert.
-		datetime_log "Transient error. Trying to revert from incomplete update."
-		git reset --hard
-		git clean -f -d -x
-		datetime_log "sleeping for $BACKOFF_TIMER seconds"
-		sleep $BACKOFF_TIMER
+		SHARD_LOG="shard $shard: " update_loop $HCP_ATTESTSVC_STATE_PREFIX/shard-$shard $shard &
 	fi
 done
+wait -n || true
+datetime_log "an update loop died, exiting"
+kill `jobs -p` 2> /dev/null || true
+exit 1
@@ -0,0 +1,42 @@
+#!/usr/bin/python3
+
+# Waits for the enrollment service's change notification (see
+# hcp/enrollsvc/notify.py) to say that a shard's commit is no longer the one we
+# have, so that updater_loop.sh only fetches once there is something to fetch.
+#
+# Exits with;
+#   0 - the commit has moved (and the new one is written to stdout)
+#   1 - it didn't move within the wait, so ask again
+#   2 - the notification couldn't be had, so fall back to polling
+#
+# Usage;
+#   wait_for_change.py <notify-url> <shard> <commit> <seconds>
+
+import json
+import sys
+import urllib.parse
+import urllib.request
+
+if __name__ == '__main__':
+    from sys import argv
+
+    if len(argv) != 5 or not argv[4].isdigit():
+        print("Usage: wait_for_change.py <notify-url> <shard> <commit> <seconds>",
+              file=sys.stderr)
+        sys.exit(2)
+
+    url, shard, since, wait = argv[1:]
+    query = urllib.parse.urlencode({ 'shard': shard, 'since': since, 'wait': wait })
+    try:
+        # the server replies after 'wait' at the latest, so allow for a
+        # little more than that before giving up on it
+        with urllib.request.urlopen(f"{url}/v1/head?{query}",
+                                    timeout=int(wait) + 10) as r:
+            head = json.load(r)['head']
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Warning, no change notification: {e}", file=sys.stderr)
+        sys.exit(2)
+    if head == since:
+        sys.exit(1)
+    print(head)
+    sys.exit(0)
@@ -13,5 +13,14 @@ cd $DIR
 
 # Steer attest-server (and attest-verify) towards our source of truth
 export SAFEBOOT_DB_DIR="$HCP_ATTESTSVC_STATE_PREFIX/current"
+[[ $HCP_ATTESTSVC_STORE == kv ]] && export SAFEBOOT_DB_DIR="$KV_DIR"
+
+# and to the other replicas, for the enrollments that it doesn't have
+if [[ -n "$HCP_ATTESTSVC_PEERS" ]]; then
+	export SAFEBOOT_PARTITION_PEERS="$HCP_ATTESTSVC_PEERS"
+	export SAFEBOOT_PARTITION_SELF="$HCP_ATTESTSVC_NAME"
+	export SAFEBOOT_PARTITION_SHARDS="$HCP_ATTESTSVC_SHARDS"
+	export SAFEBOOT_PARTITION_MODE="$HCP_ATTESTSVC_PARTITION_MODE"
+fi
 
 attest-server 8080
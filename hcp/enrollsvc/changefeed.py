@@ -0,0 +1,281 @@
+#!/usr/bin/python3
+
+# The change feed of the enrollment DB, from which a replica can keep a store of
+# the enrollments of its own (see hcp/attestsvc/kv_update.py), rather than
+# clones of the repos. notify.py serves it.
+#
+# Every change to the DB is a commit (see op_commit.sh), so the history of each
+# shard's repo already is an ordered log of its changes, and this just numbers
+# them. Each commit (following first parents, from the first one) is diffed
+# against its parent, and each enrollment that it adds, changes or removes is a
+# change, with the next sequence number (from 1). They are kept in the repo's
+# git directory (CHANGES_BASENAME), one fixed-length line per change;
+#     <commit> <op> <ply3>
+# where <op> is '+' (the enrollment is as of <commit>) or '-' (it was deleted),
+# so that a change is read, given its sequence number, with one seek. The log is
+# extended as commits are made, and as it is derived from the history alone,
+# the numbers are the same if it is lost and built again. The feed's "epoch" is
+# the first commit of the repo, so that a replica of a repo that has since been
+# set up again doesn't carry on from the numbers of the old one.
+#
+# A change carries the packed record (see common_defs.sh) of the enrollment as
+# of its commit, so a replica that has applied the changes up to a sequence
+# number has the shard exactly as it was at that commit. A replica that has
+# nothing yet, or whose position is no good (it is from another epoch, or too
+# far behind), resyncs from a snapshot instead, i.e. every enrollment as of the
+# last change, and the sequence number to carry on from.
+#
+# Usage;
+#   changefeed.py changes <repo-path> <after> [<limit>]
+#       Writes the changes after the given sequence number, as the feed's JSON.
+#   changefeed.py snapshot <repo-path>
+#       Writes the snapshot, as the feed's NDJSON.
+
+import base64
+import json
+import os
+import sys
+import threading
+
+import enrolldb
+
+CHANGES_BASENAME = 'hcp-changes'
+# See ply_path_add in common_defs.sh
+PLY3_LEN = 32
+
+# A replica that is further behind than this is told to resync, as the
+# snapshot is then likely to be less to fetch than the changes
+MAX_BEHIND = 100000
+
+# The commits diffed by each run of 'git diff-tree', while building the log
+DIFF_BATCH = 1000
+
+class Resync(Exception):
+    pass
+
+# Yields (commit, { ply3: state }) for each commit in the output of 'git
+# diff-tree --stdin --name-status -z', where the state of an enrollment that
+# the commit changed is;
+#   '+'     - it has a file that was added or changed, so it still exists,
+#   '-'     - its packed record was removed,
+#   'check' - some of the files of its directory were removed, which may or may
+#             not be all of them.
+def diffs(out):
+    commit, changed = None, {}
+    tokens = iter(out.split(b'\0'))
+    for token in tokens:
+        if not token:
+            continue
+        # a status is a letter, and the commit that the diffs are of precedes them
+        if len(token) > 1:
+            if commit is not None:
+                yield commit, changed
+            commit, changed = token.decode(), {}
+            continue
+        parts = next(tokens).decode().split('/')
+        if len(parts) == 4 and parts[3].endswith(enrolldb.RECORD_SUFFIX):
+            ply3 = parts[3][:-len(enrolldb.RECORD_SUFFIX)]
+            state = '-'
+        elif len(parts) == 5:
+            ply3 = parts[3]
+            state = 'check'
+        else:
+            # e.g. ekpubhash/do_not_remove
+            continue
+        if token != b'D':
+            state = '+'
+        if changed.get(ply3) != '+':
+            changed[ply3] = state
+    if commit is not None:
+        yield commit, changed
+
+# The path of an enrollment (without the packed record's suffix), given its ply3
+def ply3_path(ply3):
+    return '/'.join([ enrolldb.EK_BASENAME, ply3[0:2], ply3[0:6], ply3 ])
+
+# Yields (ply3, record) for those of the enrollments (ply3s) that exist as of
+# the commit (or tree), where record is its packed record, reading the blobs
+# with 'blobs' (a BlobReader).
+def read_records(repo, blobs, commit, ply3s):
+    paths = []
+    for ply3 in ply3s:
+        paths += [ ply3_path(ply3), ply3_path(ply3) + enrolldb.RECORD_SUFFIX ]
+    found = {}
+    for entry in enrolldb.ls_tree(repo, commit, paths):
+        info, _, path = entry.decode().partition('\t')
+        parts = path.split('/')
+        if len(parts) == 4:
+            found[parts[3][:-len(enrolldb.RECORD_SUFFIX)]] = info.split()[2]
+        elif len(parts) == 5:
+            found.setdefault(parts[3], {})[parts[4]] = info.split()[2]
+    for ply3 in ply3s:
+        if ply3 in found:
+            yield ply3, record(blobs, found[ply3])
+
+# Given the oid of a packed record, or the { name: oid } of a directory's files
+def record(blobs, files):
+    if isinstance(files, str):
+        return blobs.read(files)
+    return enrolldb.pack_files({ name: blobs.read(oid) for name, oid in files.items() })
+
+class ChangeLog:
+    def __init__(self, repo):
+        self.repo = repo
+        self.path = os.path.join(repo, '.git', CHANGES_BASENAME)
+        self.lock = threading.Lock()
+        roots = enrolldb.git(repo, 'rev-list', '--max-parents=0', 'HEAD').decode().split()
+        self.epoch = roots[-1]
+        self.linelen = len(self.epoch) + PLY3_LEN + 4
+        self.recover()
+
+    # Reads the seq'th line of the log, as (seq, commit, op, ply3)
+    def read(self, fd, seq):
+        line = os.pread(fd, self.linelen, (seq - 1) * self.linelen).decode()
+        commit, op, ply3 = line.split()
+        return seq, commit, op, ply3
+
+    # Finds how far the log goes, i.e. the number of changes in it (self.seq),
+    # and the commit that they take it up to (self.head, None if it is empty).
+    # As the changes of the last commit in it may have only been partly
+    # written, they are dropped, to be written again.
+    def recover(self):
+        self.seq, self.head = 0, None
+        with open(self.path, 'ab+') as f:
+            n = os.fstat(f.fileno()).st_size // self.linelen
+            if n == 0:
+                f.truncate(0)
+                return
+            last = self.read(f.fileno(), n)[1]
+            # the changes of each commit are together, so the first of those
+            # of the last commit is found by bisection
+            lo, hi = 1, n
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.read(f.fileno(), mid)[1] == last:
+                    hi = mid
+                else:
+                    lo = mid + 1
+            f.truncate((lo - 1) * self.linelen)
+        self.seq = lo - 1
+        parents = enrolldb.git(self.repo, 'rev-list', '--parents', '-n', '1', last).decode().split()
+        self.head = parents[1] if len(parents) > 1 else None
+
+    # Extends the log with the changes of the commits since the last update, up
+    # to the current one. Returns the number of changes in the log.
+    def update(self):
+        with self.lock:
+            head = enrolldb.git(self.repo, 'rev-parse', '--verify', 'HEAD').decode().strip()
+            if head == self.head:
+                return self.seq
+            revs = head if self.head is None else f'{self.head}..{head}'
+            commits = enrolldb.git(self.repo, 'rev-list', '--first-parent', '--reverse',
+                                   revs).split()
+            with open(self.path, 'ab') as f:
+                for i in range(0, len(commits), DIFF_BATCH):
+                    batch = b'\n'.join(commits[i:i + DIFF_BATCH]) + b'\n'
+                    out = enrolldb.git(self.repo, 'diff-tree', '--stdin', '-r', '--root',
+                                       '--no-renames', '--name-status', '-z', '--',
+                                       enrolldb.EK_BASENAME, input=batch)
+                    for commit, changed in diffs(out):
+                        check = [ ply3 for ply3, state in changed.items() if state == 'check' ]
+                        if check:
+                            out = enrolldb.git(self.repo, 'ls-tree', '--name-only', '-z', commit,
+                                               '--', *[ ply3_path(ply3) for ply3 in check ])
+                            present = set(path.decode().split('/')[3]
+                                          for path in out.split(b'\0') if path)
+                            for ply3 in check:
+                                changed[ply3] = '+' if ply3 in present else '-'
+                        lines = [ f'{commit} {changed[ply3]} {ply3.ljust(PLY3_LEN)}\n'
+                                  for ply3 in sorted(changed) ]
+                        f.write(''.join(lines).encode())
+                        f.flush()
+                        self.seq += len(lines)
+                        self.head = commit
+            self.head = head
+            return self.seq
+
+    # The changes after 'after', as the feed's JSON has them, i.e.;
+    #     { "epoch": <epoch>, "seq": <the last one given, or 'after'>,
+    #       "head": <the last one there is>,
+    #       "changes": [ { "seq": <n>, "ekpubhash": <ply3>,
+    #                      "op": "upsert" | "delete",
+    #                      "record": <the packed record, in base64> }, ... ] }
+    # but at most 'limit' of them. Raises Resync if 'after' is no good.
+    def changes(self, epoch, after, limit):
+        head = self.seq
+        if epoch != self.epoch or after > head or head - after > MAX_BEHIND:
+            raise Resync()
+        with open(self.path, 'rb') as f:
+            changes = [ self.read(f.fileno(), seq)
+                        for seq in range(after + 1, min(after + limit, head) + 1) ]
+        by_commit = {}
+        for seq, commit, op, ply3 in changes:
+            if op == '+':
+                by_commit.setdefault(commit, []).append(ply3)
+        records = {}
+        blobs = enrolldb.BlobReader(self.repo)
+        try:
+            for commit, ply3s in by_commit.items():
+                for ply3, data in read_records(self.repo, blobs, commit, ply3s):
+                    records[(commit, ply3)] = data
+        finally:
+            blobs.close()
+        result = []
+        for seq, commit, op, ply3 in changes:
+            change = { 'seq': seq, 'ekpubhash': ply3 }
+            if (commit, ply3) in records:
+                change['op'] = 'upsert'
+                change['record'] = base64.b64encode(records[(commit, ply3)]).decode()
+            else:
+                change['op'] = 'delete'
+            result.append(change)
+        return { 'epoch': self.epoch, 'seq': changes[-1][0] if changes else after,
+                 'head': head, 'changes': result }
+
+    # Writes the snapshot, as the feed's NDJSON, i.e. a line of;
+    #     { "epoch": <epoch>, "seq": <the last change>, ... 'header' }
+    # then one for each enrollment, as of that change;
+    #     { "ekpubhash": <ply3>, "record": <the packed record, in base64> }
+    # and lastly one to say that's all of them (so that a snapshot that is cut
+    # short isn't taken for a smaller one);
+    #     { "end": <the number of enrollments> }
+    def snapshot(self, out, header={}):
+        with self.lock:
+            seq, head = self.seq, self.head
+        out.write((json.dumps(dict(header, epoch=self.epoch, seq=seq)) + '\n').encode())
+        n = 0
+        blobs = enrolldb.BlobReader(self.repo)
+        try:
+            for ply3, files in enrolldb.ply_dirs(self.repo, head, ''):
+                data = base64.b64encode(record(blobs, files)).decode()
+                out.write((json.dumps({ 'ekpubhash': ply3, 'record': data }) + '\n').encode())
+                n += 1
+        finally:
+            blobs.close()
+        out.write((json.dumps({ 'end': n }) + '\n').encode())
+
+if __name__ == '__main__':
+    from sys import argv
+
+    if len(argv) in (4, 5) and argv[1] == 'changes' and \
+            all(arg.isdigit() for arg in argv[3:]):
+        log = ChangeLog(argv[2])
+        log.update()
+        limit = int(argv[4]) if len(argv) == 5 else MAX_BEHIND
+        try:
+            json.dump(log.changes(log.epoch, int(argv[3]), limit), sys.stdout)
+        except Resync:
+            print("Error, no such changes, resync", file=sys.stderr)
+            sys.exit(1)
+        print()
+        sys.exit(0)
+
+    if len(argv) == 3 and argv[1] == 'snapshot':
+        log = ChangeLog(argv[2])
+        log.update()
+        log.snapshot(sys.stdout.buffer)
+        sys.exit(0)
+
+    print("Usage: changefeed.py changes <repo-path> <after> [<limit>]", file=sys.stderr)
+    print("       changefeed.py snapshot <repo-path>", file=sys.stderr)
+    sys.exit(1)
@@ -13,11 +13,12 @@ set -e
 # handlers for the management interface) from the enrollment code
 # (asset-generation and DB manipulation). We run them both as distinct,
 # non-root accounts. The flask handlers invoke the enrollment functions via a
-# curated sudo configuration. A critical requirement is that there be no way
-# for the caller (flask) to be able to influence the environment of the callee
-# (enrollment). As such, we want to avoid whitelisting and other
-# environment-forwarding mechanisms, as they represent potential attack vectors
-# (e.g. if a flask handler is compromised).
+# worker process (worker.py) that runs as the enrollment account and only
+# accepts a fixed set of requests from the flask account. A critical
+# requirement is that there be no way for the caller (flask) to be able to
+# influence the environment of the callee (enrollment). As such, we want to
+# avoid whitelisting and other environment-forwarding mechanisms, as they
+# represent potential attack vectors (e.g. if a flask handler is compromised).
 #
 # We can't solve this by baking all configuration into the container image
 # (/etc/environment), because we want general-purpose Enrollment Service images
@@ -35,7 +36,8 @@ set -e
 #   /etc/environment in that case.
 # - All non-root environments pick up this uncontaminated /etc/environment;
 #   - when we drop privs, and
-#   - when a call is made across a sudo boundary.
+#   - when the enrollment worker runs the op_<verb>.sh scripts (with a fresh
+#     environment, as sudo would).
 # - No whitelisting or other environment carry-over.
 #
 # NB: because the user accounts (DB_USER and FLASK_USER) are created by
@@ -47,7 +49,7 @@ set -e
 
 if [[ `whoami` != "root" ]]; then
 	if [[ -z "$HCP_ENVIRONMENT_SET" ]]; then
-		echo "Running in reduced non-root environment (sudo probably)." >&2
+		echo "Running in reduced non-root environment (enrollment worker probably)." >&2
 		cat /etc/environment >&2
 		source /etc/environment
 	fi
@@ -124,7 +126,7 @@ if [[ `whoami` == "root" ]]; then
 	tmpf=`mktemp`
 	chmod 644 $tmpf
 	echo "# HCP settings, put here so that non-root environments" > $tmpf
-	echo "# always get known-good values, especially via sudo!" >> $tmpf
+	echo "# always get known-good values, especially via the worker!" >> $tmpf
 	echo "HCP_VER=$HCP_VER" >> $tmpf
 	echo "DB_USER=$DB_USER" >> $tmpf
 	echo "FLASK_USER=$FLASK_USER" >> $tmpf
@@ -136,8 +138,12 @@ if [[ `whoami` == "root" ]]; then
 	echo "HCP_RUN_ENROLL_UWSGI_PORT=$HCP_RUN_ENROLL_UWSGI_PORT" >> $tmpf
 	echo "HCP_RUN_ENROLL_UWSGI_FLAGS=$HCP_RUN_ENROLL_UWSGI_FLAGS" >> $tmpf
 	echo "HCP_RUN_ENROLL_UWSGI_OPTIONS=$HCP_RUN_ENROLL_UWSGI_OPTIONS" >> $tmpf
+	echo "HCP_RUN_ENROLL_BATCH_JOBS=$HCP_RUN_ENROLL_BATCH_JOBS" >> $tmpf
+	echo "HCP_RUN_ENROLL_RECORD_FORMAT=$HCP_RUN_ENROLL_RECORD_FORMAT" >> $tmpf
+	echo "HCP_RUN_ENROLL_SHARDS=$HCP_RUN_ENROLL_SHARDS" >> $tmpf
 	echo "HCP_RUN_ENROLL_GITDAEMON=$HCP_RUN_ENROLL_GITDAEMON" >> $tmpf
 	echo "HCP_RUN_ENROLL_GITDAEMON_FLAGS=$HCP_RUN_ENROLL_GITDAEMON_FLAGS" >> $tmpf
+	echo "HCP_RUN_ENROLL_NOTIFY_PORT=$HCP_RUN_ENROLL_NOTIFY_PORT" >> $tmpf
 	echo "HCP_ENVIRONMENT_SET=1" >> $tmpf
 	mv $tmpf /etc/environment
 	# Use the passed-in values to seed the enrollment config for safeboot
@@ -169,22 +175,64 @@ echo "           HCP_RUN_ENROLL_UWSGI=$HCP_RUN_ENROLL_UWSGI" >&2
 echo "      HCP_RUN_ENROLL_UWSGI_PORT=$HCP_RUN_ENROLL_UWSGI_PORT" >&2
 echo "     HCP_RUN_ENROLL_UWSGI_FLAGS=$HCP_RUN_ENROLL_UWSGI_FLAGS" >&2
 echo "   HCP_RUN_ENROLL_UWSGI_OPTIONS=$HCP_RUN_ENROLL_UWSGI_OPTIONS" >&2
+echo "      HCP_RUN_ENROLL_BATCH_JOBS=$HCP_RUN_ENROLL_BATCH_JOBS" >&2
+echo "   HCP_RUN_ENROLL_RECORD_FORMAT=$HCP_RUN_ENROLL_RECORD_FORMAT" >&2
+echo "          HCP_RUN_ENROLL_SHARDS=$HCP_RUN_ENROLL_SHARDS" >&2
 echo "       HCP_RUN_ENROLL_GITDAEMON=$HCP_RUN_ENROLL_GITDAEMON" >&2
 echo " HCP_RUN_ENROLL_GITDAEMON_FLAGS=$HCP_RUN_ENROLL_GITDAEMON_FLAGS" >&2
+echo "     HCP_RUN_ENROLL_NOTIFY_PORT=$HCP_RUN_ENROLL_NOTIFY_PORT" >&2
 
 # Derive more configuration using these constants
-REPO_NAME=enrolldb.git
 EK_BASENAME=ekpubhash
-REPO_PATH=$HCP_ENROLLSVC_STATE_PREFIX/$REPO_NAME
-EK_PATH=$REPO_PATH/$EK_BASENAME
-REPO_LOCKPATH=$HCP_ENROLLSVC_STATE_PREFIX/lock-$REPO_NAME
+HN2EK_BASENAME=hn2ek
+
+# The DB can be split into "shards", each a repo of its own (with its own lock
+# and hn2ek table), holding the enrollments whose ekpubhash falls in one range
+# of first-ply directory names (see shard_of, in common_defs.sh). Changes to
+# different shards don't wait for each other, and replicas fetch each shard
+# independently. The number of shards is chosen when the DB is set up
+# (HCP_RUN_ENROLL_SHARDS, see init_repo.sh) and recorded in the 'shards' file.
+# With one shard (the default, and the case if there's no such file) the repo
+# is enrolldb.git, as it always was, otherwise shard <i> is enrolldb-<i>.git.
+SHARDS=1
+[[ -f $HCP_ENROLLSVC_STATE_PREFIX/shards ]] &&
+	read -r SHARDS < $HCP_ENROLLSVC_STATE_PREFIX/shards
+
+# Sets REPO_NAME, REPO_PATH, EK_PATH, REPO_LOCKPATH, HN2EK_PATH and
+# HN2EK_LOG_PATH to those of shard $1. They start out as those of shard 0.
+function shard_select {
+	if [[ $SHARDS -eq 1 ]]; then
+		REPO_NAME=enrolldb.git
+	else
+		REPO_NAME=enrolldb-$1.git
+	fi
+	REPO_PATH=$HCP_ENROLLSVC_STATE_PREFIX/$REPO_NAME
+	EK_PATH=$REPO_PATH/$EK_BASENAME
+	REPO_LOCKPATH=$HCP_ENROLLSVC_STATE_PREFIX/lock-$REPO_NAME
+	HN2EK_PATH=$REPO_PATH/$HN2EK_BASENAME
+	HN2EK_LOG_PATH=$HN2EK_PATH.log
+}
+shard_select 0
+
+# The paths of all the shard repos, in order
+SHARD_PATHS=
+for ((i = 0; i < SHARDS; i++)); do
+	SHARD_PATHS="$SHARD_PATHS $HCP_ENROLLSVC_STATE_PREFIX/enrolldb-$i.git"
+done
+[[ $SHARDS -eq 1 ]] && SHARD_PATHS=$REPO_PATH
+# The flask app talks to the enrollment worker (worker.py) through this. It is
+# local to the container, rather than in the state shared with enrollsvc-repl.
+WORKER_DIR=/run/hcp-enrollsvc
+WORKER_SOCKET=$WORKER_DIR/worker.sock
 
 # Print the additional configuration
+echo "                         SHARDS=$SHARDS" >&2
 echo "                      REPO_NAME=$REPO_NAME" >&2
 echo "                    EK_BASENAME=$EK_BASENAME" >&2
 echo "                      REPO_PATH=$REPO_PATH" >&2
 echo "                        EK_PATH=$EK_PATH" >&2
 echo "                  REPO_LOCKPATH=$REPO_LOCKPATH" >&2
+echo "                  WORKER_SOCKET=$WORKER_SOCKET" >&2
 echo "               SIGNING_KEY_PRIV=$SIGNING_KEY_PRIV" >&2
 echo "                SIGNING_KEY_PUB=$SIGNING_KEY_PUB" >&2
 
@@ -242,24 +290,19 @@ function repo_cmd_unlock {
 
 . /hcp/enrollsvc/common_defs.sh
 
-# Except ... we also provide a reverse-lookup (hostname to ekpubhash) in a
-# single file that the attestation service itself isn't supposed to need. We
-# put the relevant definitions here (rather than in common_defs.h) to emphasize
-# this point.
+# Except ... we also provide a reverse-lookup (hostname to ekpubhash) table that
+# the attestation service itself isn't supposed to need. We put the relevant
+# definitions here (rather than in common_defs.h) to emphasize this point.
 #
-# TODO: we could do much better than the following. As the size of the dataset
-# grows, the adds and deletes to the reverse-lookup table will dominate, as
-# will memory and file-system thrashing (due to the need to copy and filter
-# copies of the table inside the critical section). As with elsewhere, we make
-# do with a simple but easy-to-validate solution for now, and mark this for a
-# smarter implementation when there is enough time and focus to not make a mess
-# of it (and once things are running at a scale that can detect problems).
+# To keep adds and deletes from rewriting (and re-sorting) the whole table
+# inside the critical section, the table is a sorted base file plus a log of the
+# changes since, which is merged into the base once it has grown enough. See
+# hn2ek.py, which does all the reading and writing of them.
 #
 # Each line of this file is a space-separated 2-tuple of;
 # - the reversed hostname (per 'rev')
 # - the ekpubhash (truncated to 32 characters if appropriate, i.e. to match the
 #   name of the per-TPM sub-sub-sub-drectory in the ekpubhash/ directory tree).
 
-# The initially-empty file
-HN2EK_BASENAME=hn2ek
-HN2EK_PATH=$REPO_PATH/$HN2EK_BASENAME
+# The initially-empty file (HN2EK_PATH), and its log of changes
+# (HN2EK_LOG_PATH), are in each shard's repo. See shard_select.
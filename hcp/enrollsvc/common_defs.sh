@@ -49,6 +49,37 @@ function check_hostname_suffix {
 # beyond that. That 3rd-ply (per-TPM) directory contains individual files for
 # each attribute to be associated with the TPM, including 'ekpubhash' itself
 # (full-length), and 'hostname'.
+#
+# Alternatively, the per-TPM state can be a "packed record", i.e. a single file
+# in place of that directory, named after it with a ".tar" suffix, that is an
+# uncompressed tar archive of the same files (as 'tar cf - -C <dir> .' would
+# give, which is also what the attestation service replies with). At scale,
+# this saves the repo (and every clone of it) all but one of the ~15 files and
+# git tree entries per TPM. A repo holds one or the other (or a mix, while it is
+# being migrated), and readers must accept both. The 'record-format' file at
+# the top of the repo says which one adds use ("packed" or "dirs", the default
+# if there is no such file). See enrolldb.py, and migrate_records.sh to convert
+# a repo.
+RECORD_SUFFIX=.tar
+RECORD_FORMAT_BASENAME=record-format
+
+# The DB may be split into SHARDS shards (see common.sh), each of which holds
+# the enrollments for a contiguous range of first-ply directory names. Shard
+# <i> holds those whose first ply, as a number (0-255), is 'p' such that
+# p * SHARDS / 256 == i, so that listing the shards in order lists the
+# enrollments in ekpubhash order. (Resharding a DB isn't supported, so this
+# must not change once a DB is set up.)
+# Given an ekpubhash ($1), outputs its shard.
+function shard_of {
+	echo $(( 0x${1:0:2} * ${SHARDS:-1} / 256 ))
+}
+
+# Given an ekpubhash prefix ($1), outputs the shards that it can match.
+function shards_of_prefix {
+	local lo=`echo "${1}00" | cut -c 1,2`
+	local hi=`echo "${1}ff" | cut -c 1,2`
+	seq `shard_of $lo` `shard_of $hi`
+}
 
 # Given an ekpubhash ($1), figure out the corresponding 3-ply of directories.
 # Outputs;
@@ -0,0 +1,566 @@
+#!/usr/bin/python3
+
+# Queries of the enrollment DB, without the repo lock, and bulk deletes.
+#
+# Rather than reading the checkout (which add/delete are changing, and which the
+# recovery path may reset, while they hold the lock), a query reads the tree of
+# the commit that HEAD points to when the query starts. Commits are immutable,
+# and HEAD only moves (atomically) once a change has been committed, so the
+# query sees exactly the DB as of one commit, for as long as it takes, and
+# doesn't hold up (or get held up by) the writers or other queries. A query is
+# read as it is written out, and it can be resumed (for paging) against the same
+# tree, after the last entry it returned.
+#
+# Deletes, on the other hand, change the checkout (under the repo lock, see
+# op_commit.sh), and are done here in one pass over the matching directories,
+# rather than with a handful of processes for each of them.
+#
+# Each enrollment is either a per-TPM directory, or (in a repo that has been
+# switched to them, see common_defs.sh) a packed record, i.e. a single
+# '<ply3>.tar' file with the same files in it. Both are read here, so a repo
+# can hold a mix of the two (e.g. while it is being migrated).
+#
+# If the DB is sharded (see common.sh), a query reads each shard that the
+# prefix can match, in order, which lists the entries in ekpubhash order as
+# each shard holds a range of them. Each shard is read as of its own snapshot.
+#
+# Usage;
+#   enrolldb.py query <ekpubhash-prefix> <repo-path> [<repo-path> ...]
+#       Writes the /v1/query JSON response to stdout (see op_query.sh), as it
+#       goes rather than building it in memory. The repo paths are those of
+#       the shards, in order.
+#   enrolldb.py delete <repo-path> <ekpubhash-prefix> <hn2ek-changes-path>
+#       Removes the matching entries from the checkout (but doesn't stage or
+#       commit that), appends the removal of their lines from the hn2ek table
+#       to hn2ek-changes-path (in the form of the hn2ek log), and writes the
+#       /v1/delete JSON response (the entries removed) to stdout.
+#   enrolldb.py bench-delete [<entries> ...]
+#       Times delete against the per-entry shell loop that it replaced, on
+#       synthetic repos (by default of 100 and 1000 entries).
+#   enrolldb.py pack <enrollment-dir> <record-path>
+#       Writes the packed record of an enrollment directory.
+#   enrolldb.py migrate <repo-path> <packed|dirs>
+#       Converts every enrollment in the checkout to the given format, and sets
+#       the format of the repo accordingly (but doesn't stage or commit that,
+#       see migrate_records.sh).
+#   enrolldb.py bench-packed [<entries> ...]
+#       Compares the repo size, commit time and clone time of the two formats,
+#       on synthetic repos (by default of 1000 and 10000 entries).
+
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+EK_BASENAME = 'ekpubhash'
+# See common_defs.sh
+RECORD_SUFFIX = '.tar'
+RECORD_FORMAT = 'record-format'
+
+class DBError(Exception):
+    pass
+
+def git(repo, *args, **kwargs):
+    c = subprocess.run([ 'git', '-C', repo ] + list(args),
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
+    if c.returncode != 0:
+        raise DBError(f"git {args[0]} failed: {c.stderr.decode(errors='replace').strip()}")
+    return c.stdout
+
+# The tree of the current commit, i.e. the snapshot that a query reads
+def snapshot(repo):
+    return git(repo, 'rev-parse', '--verify', 'HEAD^{tree}').decode().strip()
+
+# Yields the NUL-terminated entries of 'git ls-tree -r' of 'paths' in 'tree',
+# as git produces them, so that the listing of a big tree isn't held in memory
+# and a caller that stops early doesn't pay for the rest of it.
+def ls_tree(repo, tree, paths):
+    p = subprocess.Popen([ 'git', '-C', repo, 'ls-tree', '-r', '-z', tree, '--' ] + paths,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        buf = b''
+        while True:
+            chunk = p.stdout.read1(65536)
+            if not chunk:
+                break
+            entries = (buf + chunk).split(b'\0')
+            buf = entries.pop()
+            yield from entries
+        err = p.stderr.read()
+        if p.wait() != 0:
+            raise DBError(f"git ls-tree failed: {err.decode(errors='replace').strip()}")
+    finally:
+        if p.returncode is None:
+            p.kill()
+            p.wait()
+        p.stdout.close()
+        p.stderr.close()
+
+# The ply1 directories (see ply_path_add in common_defs.sh) at or after 'ply1'
+def ply1_dirs(repo, tree, ply1):
+    out = git(repo, 'ls-tree', '-z', tree, '--', EK_BASENAME + '/')
+    return [ path for path in (entry.decode().partition('\t')[2]
+                               for entry in out.split(b'\0') if entry)
+             if path.split('/')[1] >= ply1 ]
+
+# Yields the enrollments that match the prefix, the same as ply_path_get, and
+# whose (ply3) name comes after 'after', in order, as (ply3, { name: oid }) for
+# a per-TPM directory, or (ply3, oid) for a packed record.
+def ply_dirs(repo, tree, prefix, after=''):
+    # only list the sub-tree that the prefix narrows the search down to, or
+    # that the search resumes in
+    if len(prefix) >= 2:
+        paths = [ EK_BASENAME + '/' + prefix[0:2] ]
+        if len(prefix) >= 6:
+            paths[0] += '/' + prefix[0:6]
+    elif after:
+        paths = [ path for path in ply1_dirs(repo, tree, after[0:2])
+                  if path.split('/')[1].startswith(prefix) ]
+        if not paths:
+            return
+    else:
+        paths = [ EK_BASENAME ]
+    match = prefix[0:32]
+    ply3, files = None, {}
+    for entry in ls_tree(repo, tree, paths):
+        info, _, fpath = entry.decode().partition('\t')
+        parts = fpath.split('/')
+        # ekpubhash/<ply1>/<ply2>/<ply3>.tar
+        if len(parts) == 4 and parts[3].endswith(RECORD_SUFFIX):
+            name = parts[3][:-len(RECORD_SUFFIX)]
+            if name.startswith(match) and name > after:
+                if ply3 is not None:
+                    yield ply3, files
+                    ply3 = None
+                yield name, info.split()[2]
+            continue
+        # ekpubhash/<ply1>/<ply2>/<ply3>/<file>
+        if len(parts) != 5 or not parts[3].startswith(match) or parts[3] <= after:
+            continue
+        if parts[3] != ply3:
+            if ply3 is not None:
+                yield ply3, files
+            ply3, files = parts[3], {}
+        files[parts[4]] = info.split()[2]
+    if ply3 is not None:
+        yield ply3, files
+
+# Reads blobs, given their oids, from one 'git cat-file --batch' for all of them
+class BlobReader:
+    def __init__(self, repo):
+        self.p = subprocess.Popen([ 'git', '-C', repo, 'cat-file', '--batch' ],
+                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def read(self, oid):
+        self.p.stdin.write(oid.encode() + b'\n')
+        self.p.stdin.flush()
+        header = self.p.stdout.readline().split()
+        if len(header) != 3:
+            raise DBError(f"git cat-file: missing object {oid}")
+        data = self.p.stdout.read(int(header[2]) + 1)
+        return data[:-1]
+
+    def close(self):
+        self.p.stdin.close()
+        self.p.stdout.close()
+        self.p.wait()
+
+def first_line(data):
+    return data.decode(errors='replace').partition('\n')[0]
+
+# A packed record is an uncompressed tar archive of the enrollment directory,
+# i.e. what 'tar cf - -C <dir> .' gives (which is also what the attestation
+# service replies with), but with the members in order and without the owners
+# and times, so that the same enrollment always packs to the same bytes.
+def pack(path):
+    def strip(info):
+        info.uid = info.gid = 0
+        info.uname = info.gname = ''
+        info.mtime = 0
+        return info
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w', format=tarfile.GNU_FORMAT) as tar:
+        tar.add(path, arcname='.', filter=strip)
+    return buf.getvalue()
+
+# The same, given the files (as { name: data }) rather than the directory, e.g.
+# as read from the repo rather than the checkout.
+def pack_files(files):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w', format=tarfile.GNU_FORMAT) as tar:
+        info = tarfile.TarInfo('.')
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+        tar.addfile(info)
+        for name in sorted(files):
+            info = tarfile.TarInfo('./' + name)
+            info.size = len(files[name])
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(files[name]))
+    return buf.getvalue()
+
+# The files of a packed record, as { name: data }. A file may have been
+# appended again since (see attest_policy.py), in which case the last one wins.
+def unpack(data):
+    files = {}
+    with tarfile.open(fileobj=io.BytesIO(data), mode='r:') as tar:
+        for info in tar:
+            name = os.path.normpath(info.name)
+            if info.isfile() and '/' not in name:
+                files[name] = tar.extractfile(info).read()
+    return files
+
+def entry(ekpubhash, hostname, names):
+    return {
+        'ekpubhash': first_line(ekpubhash),
+        'hostname': first_line(hostname),
+        'others': sorted(name for name in names
+                         if name not in ('ekpubhash', 'hostname')),
+    }
+
+# Yields (ply3, entry) for the TPMs whose ekpubhash matches the prefix, in
+# ekpubhash order, as they are in the snapshot 'tree' (or the current one).
+# Given the last ply3 of a previous call ('after'), and the same tree, this
+# carries on where that left off.
+def query(repo, prefix, tree=None, after=''):
+    if tree is None:
+        tree = snapshot(repo)
+    blobs = BlobReader(repo)
+    try:
+        for ply3, files in ply_dirs(repo, tree, prefix, after):
+            if isinstance(files, str):
+                try:
+                    files = unpack(blobs.read(files))
+                except tarfile.TarError as e:
+                    raise DBError(f"{ply3}{RECORD_SUFFIX}: {e}")
+            else:
+                files = { name: blobs.read(oid) if name in ('ekpubhash', 'hostname') else b''
+                          for name, oid in files.items() }
+            yield ply3, entry(files.get('ekpubhash', b''), files.get('hostname', b''), files)
+    finally:
+        blobs.close()
+
+# See shard_of in common_defs.sh
+def shard_of(ekpubhash, shards):
+    return int(ekpubhash[0:2], 16) * shards // 256
+
+def shards_of_prefix(prefix, shards):
+    lo = shard_of((prefix + '00')[0:2], shards)
+    hi = shard_of((prefix + 'ff')[0:2], shards)
+    return list(range(lo, hi + 1))
+
+# Yields (tree, ply3, entry) for the TPMs whose ekpubhash matches the prefix,
+# from the shards (a list of repo paths, in order) that can hold them, the same
+# as query. 'tree' is the snapshot of the ply3's shard, and given that and the
+# ply3 of the last entry of a previous call, this carries on where that left
+# off; the shards after that one are read as of their current snapshots.
+def query_shards(repos, prefix, tree=None, after=''):
+    first = shard_of(after, len(repos)) if after else -1
+    for shard in shards_of_prefix(prefix, len(repos)):
+        if shard < first:
+            continue
+        if shard == first:
+            t, a = tree or snapshot(repos[shard]), after
+        else:
+            t, a = snapshot(repos[shard]), ''
+        results = query(repos[shard], prefix, t, a)
+        try:
+            for ply3, entry in results:
+                yield t, ply3, entry
+        finally:
+            results.close()
+
+def query_json(repos, prefix, out=sys.stdout):
+    out.write('{\n  "entries": [')
+    sep = '\n    '
+    for _, _, entry in query_shards(repos, prefix):
+        out.write(sep + json.dumps(entry))
+        sep = ',\n    '
+    out.write('\n  ]\n}\n')
+
+# Yields (ply3, path) for the enrollments in the checkout that match the
+# prefix, the same as ply_path_get, in order. The path is of the per-TPM
+# directory, or of the packed record.
+def checkout_records(repo, prefix):
+    def subdirs(path, n):
+        try:
+            names = sorted(os.listdir(path))
+        except (FileNotFoundError, NotADirectoryError):
+            # e.g. ekpubhash/do_not_remove
+            return []
+        # each ply's name is a prefix of the ekpubhash, n characters long
+        m = min(n, len(prefix))
+        return [ os.path.join(path, name) for name in names
+                 if name[:m] == prefix[:m] ]
+    for ply1 in subdirs(os.path.join(repo, EK_BASENAME), 2):
+        for ply2 in subdirs(ply1, 6):
+            for path in subdirs(ply2, 32):
+                name = os.path.basename(path)
+                if name.endswith(RECORD_SUFFIX):
+                    name = name[:-len(RECORD_SUFFIX)]
+                elif not os.path.isdir(path):
+                    continue
+                yield name, path
+
+# The files of an enrollment in the checkout, as { name: data }, though only
+# 'ekpubhash' and 'hostname' are read from a per-TPM directory.
+def read_record(path):
+    if not os.path.isdir(path):
+        with open(path, 'rb') as f:
+            return unpack(f.read())
+    files = {}
+    for name in os.listdir(path):
+        files[name] = b''
+        if name in ('ekpubhash', 'hostname'):
+            with open(os.path.join(path, name), 'rb') as f:
+                files[name] = f.read()
+    return files
+
+def remove_record(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+    # as 'git rm' would, don't leave the emptied plies behind
+    for parent in (os.path.dirname(path), os.path.dirname(os.path.dirname(path))):
+        try:
+            os.rmdir(parent)
+        except OSError:
+            break
+
+# Removes the matching entries from the checkout, writing the deleted entries
+# (in the same form as query_json) to 'out', and the removal of their hn2ek
+# lines (in the form of the hn2ek log) to 'changes'. Returns the number of
+# entries deleted. The caller holds the repo lock, and stages the removals (with
+# everything else) once it is done.
+def delete(repo, prefix, changes, out=sys.stdout):
+    out.write('{\n  "entries": [')
+    sep = '\n    '
+    n = 0
+    for ply3, path in checkout_records(repo, prefix):
+        files = read_record(path)
+        e = entry(files.get('ekpubhash', b''), files.get('hostname', b''), files)
+        changes.write('- %s %s\n' % (e['hostname'][::-1], ply3))
+        remove_record(path)
+        out.write(sep + json.dumps(e))
+        sep = ',\n    '
+        n += 1
+    out.write('\n  ]\n}\n')
+    return n
+
+# Converts every enrollment in the checkout to packed records (or back to
+# per-TPM directories), and sets the format that op_commit.sh adds them in
+# from then on. Returns the number of enrollments converted. The caller holds
+# the repo lock, and commits it.
+def migrate(repo, to_packed):
+    n = 0
+    for ply3, path in checkout_records(repo, ''):
+        if os.path.isdir(path) != to_packed:
+            continue
+        if to_packed:
+            with open(path + RECORD_SUFFIX, 'wb') as f:
+                f.write(pack(path))
+            shutil.rmtree(path)
+        else:
+            with open(path, 'rb') as f:
+                files = unpack(f.read())
+            dirpath = path[:-len(RECORD_SUFFIX)]
+            os.mkdir(dirpath)
+            for name, data in files.items():
+                with open(os.path.join(dirpath, name), 'wb') as f:
+                    f.write(data)
+            os.unlink(path)
+        n += 1
+    with open(os.path.join(repo, RECORD_FORMAT), 'w') as f:
+        f.write('packed\n' if to_packed else 'dirs\n')
+    return n
+
+# What op_query.sh (in delete mode) used to do for each entry, for comparison
+old_delete = '''
+for i in `ls -d ekpubhash/*/*/* 2> /dev/null`; do
+	read ekp < $i/ekpubhash
+	read hn < $i/hostname
+	revhn=`echo $hn | rev`
+	echo $revhn `basename "$i"` >> ../filter
+	ls -1 $i | grep -v "ekpubhash" | grep -v "hostname" | \\
+		jq -Rn --arg ekpubhash "$ekp" --arg hostname "$hn" \\
+		'{ekpubhash: $ekpubhash, hostname: $hostname, others: [inputs]}'
+	git rm -q -r $i
+done | jq -n '{entries: [inputs]}' > /dev/null
+grep -F -v -f ../filter hn2ek > hn2ek.tmp || true
+mv hn2ek.tmp hn2ek
+git add hn2ek
+git commit -q -m "delete all"
+'''
+
+# Synthetic enrollments, with roughly the files that attest-enroll generates by
+# default (and with HCP's gencert) for each TPM
+def make_enrollment(d, ekpubhash, hostname):
+    os.makedirs(d)
+    files = [ ('ekpubhash', ekpubhash + '\n'), ('hostname', hostname + '\n'),
+              ('ek.pub', os.urandom(314)), ('meta-data', hostname + '\n') ]
+    for name in ('rootfs.key', 'pkinit-client-key'):
+        files += [ (name + '.enc', os.urandom(64)), (name + '.symkeyenc', os.urandom(256)),
+                   (name + '.policy', os.urandom(32)) ]
+    files += [ ('pkinit-client-cert.pem', os.urandom(1200).hex()),
+               ('hostname.sig', os.urandom(256)), ('manifest', os.urandom(200).hex()),
+               ('manifest.sig', os.urandom(256)) ]
+    for name, data in files:
+        with open(os.path.join(d, name), 'w' if isinstance(data, str) else 'wb') as f:
+            f.write(data)
+
+# Adds 'n' synthetic enrollments to the checkout (packed, or as per-TPM
+# directories), and their lines to the hn2ek table
+def make_enrollments(path, n, packed=False, first=0):
+    lines = []
+    for i in range(first, first + n):
+        ekpubhash = '%064x' % (int.from_bytes(os.urandom(32), 'big'))
+        d = os.path.join(path, EK_BASENAME, ekpubhash[0:2], ekpubhash[0:6], ekpubhash[0:32])
+        hostname = 'host-%d.rack-%d.example.com' % (i, i % 40)
+        make_enrollment(d, ekpubhash, hostname)
+        if packed:
+            with open(d + RECORD_SUFFIX, 'wb') as f:
+                f.write(pack(d))
+            shutil.rmtree(d)
+        lines.append('%s %s\n' % (hostname[::-1], ekpubhash[0:32]))
+    with open(os.path.join(path, 'hn2ek'), 'a') as f:
+        f.writelines(sorted(lines))
+
+# A committed repo of 'n' synthetic enrollments
+def make_repo(path, n):
+    subprocess.run([ 'git', 'init', '-q', path ], check=True)
+    make_enrollments(path, n)
+    git(path, 'add', '.')
+    git(path, '-c', 'user.name=bench', '-c', 'user.email=bench@localhost',
+        'commit', '-q', '-m', 'init')
+
+def bench_delete(sizes):
+    env = dict(os.environ, GIT_AUTHOR_NAME='bench', GIT_AUTHOR_EMAIL='bench@localhost',
+               GIT_COMMITTER_NAME='bench', GIT_COMMITTER_EMAIL='bench@localhost')
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            old = os.path.join(tmp, 'old', 'repo')
+            new = os.path.join(tmp, 'new', 'repo')
+            make_repo(old, n)
+            shutil.copytree(os.path.dirname(old), os.path.dirname(new), symlinks=True)
+            start = time.perf_counter()
+            subprocess.run([ 'bash', '-c', old_delete ], cwd=old, env=env, check=True)
+            t_old = time.perf_counter() - start
+            start = time.perf_counter()
+            with open(os.path.join(tmp, 'changes'), 'w') as changes, \
+                    open(os.devnull, 'w') as out:
+                deleted = delete(new, '', changes, out)
+            subprocess.run([ sys.executable,
+                             os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hn2ek.py'),
+                             'apply', os.path.join(new, 'hn2ek'),
+                             os.path.join(tmp, 'changes') ], check=True)
+            subprocess.run([ 'git', 'add', '-A', '.' ], cwd=new, env=env, check=True)
+            subprocess.run([ 'git', 'commit', '-q', '-m', 'delete all' ], cwd=new, env=env,
+                           check=True)
+            t_new = time.perf_counter() - start
+            if deleted != n or git(old, 'ls-tree', '-r', 'HEAD', '--', EK_BASENAME) or \
+                    git(new, 'ls-tree', '-r', 'HEAD', '--', EK_BASENAME):
+                print("MISMATCH for %d entries" % n, file=sys.stderr)
+                return 1
+            print("%8d entries: bulk %.3f s (%.0f/s), per-entry loop %.3f s (%.0f/s) (%.0fx)"
+                  % (n, t_new, n / t_new, t_old, n / t_old, t_old / t_new))
+    return 0
+
+def du(path):
+    total = 0
+    for d, _, names in os.walk(path):
+        total += sum(os.lstat(os.path.join(d, name)).st_size for name in names)
+    return total
+
+def files(path):
+    return sum(len(names) for d, _, names in os.walk(path) if '.git' not in d.split(os.sep))
+
+def bench_packed(sizes):
+    env = dict(os.environ, GIT_AUTHOR_NAME='bench', GIT_AUTHOR_EMAIL='bench@localhost',
+               GIT_COMMITTER_NAME='bench', GIT_COMMITTER_EMAIL='bench@localhost')
+    def run(repo, *args):
+        git(repo, *args, env=env)
+    print("%8s %7s %9s %10s %11s %11s %9s" % ("entries", "format", "files", "repo MiB",
+          "import s", "commit ms", "clone s"))
+    for n in sizes:
+        for to_packed in (False, True):
+            with tempfile.TemporaryDirectory() as tmp:
+                repo = os.path.join(tmp, 'repo')
+                run(tmp, 'init', '-q', repo)
+                # so that an auto gc doesn't skew the timings (or clash with
+                # the gc below)
+                run(repo, 'config', 'gc.auto', '0')
+                make_enrollments(repo, n, to_packed)
+                # committing the whole DB at once (e.g. a migration)
+                start = time.perf_counter()
+                run(repo, 'add', '-A', '.')
+                run(repo, 'commit', '-q', '-m', 'init')
+                t_import = time.perf_counter() - start
+                # what op_commit.sh does for each (single-item) group
+                adds = 10
+                start = time.perf_counter()
+                for i in range(adds):
+                    make_enrollments(repo, 1, to_packed, n + i)
+                    run(repo, 'add', '-A', '.')
+                    run(repo, 'commit', '-q', '-m', 'add')
+                t_commit = (time.perf_counter() - start) / adds
+                run(repo, 'gc', '-q')
+                # what the attestation service's replicas do
+                start = time.perf_counter()
+                run(tmp, 'clone', '-q', '--no-local', repo, 'clone')
+                t_clone = time.perf_counter() - start
+                print("%8d %7s %9d %10.1f %11.2f %11.1f %9.2f" % (n,
+                      'packed' if to_packed else 'dirs', files(repo),
+                      du(os.path.join(repo, '.git')) / 1048576,
+                      t_import, t_commit * 1000, t_clone))
+    return 0
+
+if __name__ == '__main__':
+    from sys import argv
+
+    if len(argv) >= 4 and argv[1] == 'query':
+        try:
+            query_json(argv[3:], argv[2])
+        except DBError as e:
+            print(f"Error, {e}", file=sys.stderr)
+            sys.exit(1)
+        sys.exit(0)
+
+    if len(argv) == 5 and argv[1] == 'delete':
+        with open(argv[4], 'a') as changes:
+            delete(argv[2], argv[3], changes)
+        sys.exit(0)
+
+    if len(argv) >= 2 and argv[1] == 'bench-delete':
+        sizes = [ int(x) for x in argv[2:] ] or [ 100, 1000 ]
+        sys.exit(bench_delete(sizes))
+
+    if len(argv) == 4 and argv[1] == 'pack':
+        data = pack(argv[2])
+        with open(argv[3], 'wb') as f:
+            f.write(data)
+        sys.exit(0)
+
+    if len(argv) == 4 and argv[1] == 'migrate' and argv[3] in ('packed', 'dirs'):
+        n = migrate(argv[2], argv[3] == 'packed')
+        print(f"Converted {n} enrollments to {argv[3]}", file=sys.stderr)
+        sys.exit(0)
+
+    if len(argv) >= 2 and argv[1] == 'bench-packed':
+        sizes = [ int(x) for x in argv[2:] ] or [ 1000, 10000 ]
+        sys.exit(bench_packed(sizes))
+
+    print("Usage: enrolldb.py query <ekpubhash-prefix> <repo-path> [<repo-path> ...]",
+          file=sys.stderr)
+    print("       enrolldb.py delete <repo-path> <ekpubhash-prefix> <hn2ek-changes-path>",
+          file=sys.stderr)
+    print("       enrolldb.py bench-delete [<entries> ...]", file=sys.stderr)
+    print("       enrolldb.py pack <enrollment-dir> <record-path>", file=sys.stderr)
+    print("       enrolldb.py migrate <repo-path> <packed|dirs>", file=sys.stderr)
+    print("       enrolldb.py bench-packed [<entries> ...]", file=sys.stderr)
+    sys.exit(1)
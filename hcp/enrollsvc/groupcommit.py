@@ -0,0 +1,176 @@
+# Group commit, for the enrollment worker (worker.py).
+#
+# Every change to the DB (add, add_batch, delete) goes through op_commit.sh,
+# which takes the repo lock and makes a git commit. Rather than each request
+# running it for itself (and contending for the lock with the others), the
+# request's handler generates what it can outside of the lock (op_enroll.sh),
+# then queues its items here. One thread takes everything that is pending, in
+# the order it was queued, and passes it to one run of op_commit.sh, i.e. one
+# critical section and one commit for the whole group. The requests of a group
+# are released once its commit is on disk, and the next group is whatever was
+# queued up meanwhile. So the busier it is, the more each commit carries,
+# rather than requests waiting (or timing out) on the lock.
+#
+# If a group's commit fails, op_commit.sh rolls the repo back to the previous
+# group's commit and fails the items of this group only.
+#
+# If the DB is sharded (see common.sh), there is a GroupCommitter per shard,
+# each running op_commit.sh for its own shard, so the groups of different
+# shards are committed in parallel. Their metrics are labelled by shard.
+
+import collections
+import subprocess
+import threading
+import time
+
+# A group is made of whole requests, as many as are pending, until it has
+# this many items (but a request with more than this is a group of its own).
+MAX_GROUP = 256
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [ 0 ] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, v):
+        for i, le in enumerate(self.buckets):
+            if v <= le:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[len(self.buckets)] += 1
+        self.sum += v
+        self.count += 1
+
+    # The samples, with 'labels' (e.g. 'shard="0"', or '') on each of them
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for le, n in zip(self.buckets + [ '+Inf' ], self.counts):
+            cumulative += n
+            le = f'le="{le}"'
+            lines.append(f"{name}_bucket{braces(labels, le)} {cumulative}")
+        lines.append(f"{name}_sum{braces(labels)} {fmt(self.sum)}")
+        lines.append(f"{name}_count{braces(labels)} {self.count}")
+        return lines
+
+def join_labels(*labels):
+    return ','.join(l for l in labels if l)
+
+def braces(*labels):
+    joined = join_labels(*labels)
+    return f"{{{joined}}}" if joined else ''
+
+def fmt(v):
+    return "%d" % (v) if v == int(v) else repr(v)
+
+seconds_buckets = [ 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60 ]
+
+class Request:
+    def __init__(self, items):
+        self.items = items
+        self.done = threading.Event()
+        self.stderr = ''
+
+class GroupCommitter:
+    # 'command' (a list) is run with the item directories as its (further)
+    # arguments, and with the environment that 'env' returns. 'labels' are
+    # put on its metrics.
+    def __init__(self, command, env, labels=''):
+        self.command = command
+        self.env = env
+        self.labels = labels
+        self.cond = threading.Condition()
+        self.queue = collections.deque()
+        self.queued_items = 0
+        # metrics, under self.cond
+        self.group_size = Histogram([ 1, 2, 4, 8, 16, 32, 64, 128, 256 ])
+        self.commit_seconds = Histogram(seconds_buckets)
+        self.wait_seconds = Histogram(seconds_buckets)
+        self.groups = 0
+        self.failed_groups = 0
+        threading.Thread(target=self.run, daemon=True).start()
+
+    # Queues the item directories of a request, and waits until they have
+    # been committed (or failed), returning the stderr of the op_commit.sh run
+    # that did them. The results are in the items (see op_commit.sh).
+    def submit(self, items):
+        req = Request(items)
+        start = time.perf_counter()
+        with self.cond:
+            self.queue.append(req)
+            self.queued_items += len(items)
+            self.cond.notify()
+        req.done.wait()
+        with self.cond:
+            self.wait_seconds.observe(time.perf_counter() - start)
+        return req.stderr
+
+    def take_group(self):
+        with self.cond:
+            while not self.queue:
+                self.cond.wait()
+            group = [ self.queue.popleft() ]
+            n = len(group[0].items)
+            while self.queue and n + len(self.queue[0].items) <= MAX_GROUP:
+                group.append(self.queue.popleft())
+                n += len(group[-1].items)
+            self.queued_items -= n
+            return group
+
+    def run(self):
+        while True:
+            group = self.take_group()
+            items = [ item for req in group for item in req.items ]
+            start = time.perf_counter()
+            try:
+                c = subprocess.run(self.command + items, env=self.env(),
+                                   stdin=subprocess.DEVNULL,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+                ok = c.returncode == 0
+                stderr = c.stderr.decode(errors='replace')
+            except OSError as e:
+                ok = False
+                stderr = f"Error, failed to run {self.command[0]}: {e}\n"
+            with self.cond:
+                self.commit_seconds.observe(time.perf_counter() - start)
+                self.group_size.observe(len(items))
+                self.groups += 1
+                if not ok:
+                    self.failed_groups += 1
+            for req in group:
+                req.stderr = stderr
+                req.done.set()
+
+# The metrics of the committers, in the Prometheus text exposition format
+def render(committers):
+    def header(name, kind, help):
+        return [ f"# HELP {name} {help}", f"# TYPE {name} {kind}" ]
+    def histogram(name, help, attr):
+        lines = header(name, 'histogram', help)
+        for c in committers:
+            with c.cond:
+                lines += getattr(c, attr).render(name, c.labels)
+        return lines
+    lines = header('enrollsvc_commit_queue_depth', 'gauge',
+                   "Changes waiting for the next group commit.")
+    for c in committers:
+        with c.cond:
+            lines.append(f"enrollsvc_commit_queue_depth{braces(c.labels)} {c.queued_items}")
+    lines += histogram('enrollsvc_commit_group_size',
+                       "Changes per group commit.", 'group_size')
+    lines += histogram('enrollsvc_commit_seconds',
+                       "Time taken by each group commit.", 'commit_seconds')
+    lines += histogram('enrollsvc_commit_wait_seconds',
+                       "Time from queueing a request's changes to their commit.",
+                       'wait_seconds')
+    lines += header('enrollsvc_commits_total', 'counter', "Group commits, by result.")
+    for c in committers:
+        with c.cond:
+            counts = { 'ok': c.groups - c.failed_groups, 'failed': c.failed_groups }
+        for result, n in counts.items():
+            result = f'result="{result}"'
+            lines.append(f"enrollsvc_commits_total{braces(c.labels, result)} {n}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,336 @@
+#!/usr/bin/python3
+
+# Lookups in, and updates to, the hn2ek (hostname to ekpubhash) reverse-lookup
+# table. See the comments at the end of common.sh for the format of the table.
+#
+# The table is in two files;
+# - hn2ek, the base, whose lines are kept sorted in byte order (LC_ALL=C), by
+#   reversed hostname. A hostname-suffix search is a prefix search, and the
+#   matches in the base are a contiguous range of lines that we find with a
+#   binary search over the file (mmap'd) rather than by reading every line.
+# - hn2ek.log, the changes since the base was written, one per line, as "+ "
+#   or "- " followed by the line that is added to or removed from the table.
+#   Adds and deletes only append to this, rather than sorting and rewriting the
+#   whole table. Once it grows past a fraction of the size of the base, it is
+#   merged into a new base ("compaction").
+#
+# A table without a log was written before there was one, when the base was
+# sorted by 'sort' in whatever the locale was (which may not be byte order), so
+# the first update of it, or run_worker.sh before that, compacts it, which sorts
+# the base.
+#
+# Both files are only changed under the repo lock. Compaction replaces the base
+# (rename) before it empties the log (also a rename), and readers open the log
+# before the base, so a reader without the lock sees either the base that the
+# log applies to, or the base with the log already merged in. Applying the log
+# again to the latter changes nothing, as each line's last change in the log
+# is what counts.
+#
+# If the DB is sharded (see common.sh), each shard has its own table, and a
+# search merges the (sorted) matches of all of them.
+#
+# Usage;
+#   hn2ek.py find <hostname_suffix> <hn2ek-path> [<hn2ek-path> ...]
+#       Writes the /v1/find JSON response to stdout (see op_find.sh), as it
+#       goes rather than building it in memory. The hn2ek paths are those of
+#       the shards.
+#   hn2ek.py add <hn2ek-path> <reversed-hostname> <ekpubhash>
+#   hn2ek.py add-list <hn2ek-path> <lines-path>
+#   hn2ek.py delete <hn2ek-path> <filter-path>
+#   hn2ek.py apply <hn2ek-path> <changes-path>
+#       Log an add, the add of each of the lines in lines-path, the deletion of
+#       each of the lines in filter-path, or the changes in changes-path (in
+#       the same form as the log), and compact the log if it is due.
+#   hn2ek.py compact <hn2ek-path>
+#       Merge the log (if any) into the base, regardless of its size, and sort
+#       the base.
+#   hn2ek.py bench [<entries> ...]
+#       Times find against a linear scan of synthetic tables (by default of
+#       10^4, 10^5 and 10^6 entries), and times adds.
+
+import heapq
+import json
+import mmap
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+# The log is compacted once it is bigger than this, or than the base divided by
+# LOG_RATIO, whichever is larger. Finds read the whole log, so this bounds their
+# extra work, while adds and deletes rewrite the base only once in every so
+# many changes.
+LOG_MIN_SIZE = 1 << 20
+LOG_RATIO = 16
+
+def log_path(path):
+    return path + '.log'
+
+# Returns { line: True (added) or False (removed) } of the last change to each
+# line in the log, for the lines that start with 'prefix'. A line without its
+# newline is an append still in progress, and is ignored.
+def read_log(f, prefix=b''):
+    changes = {}
+    for entry in f.read().split(b'\n')[:-1]:
+        op, line = entry[0:2], entry[2:]
+        if not line.startswith(prefix):
+            continue
+        if op == b'+ ':
+            changes[line] = True
+        elif op == b'- ':
+            changes[line] = False
+    return changes
+
+def open_log(path):
+    try:
+        return open(log_path(path), 'rb')
+    except FileNotFoundError:
+        return None
+
+# Returns the offset of the start of the line that contains offset 'off'
+def line_start(m, off):
+    return m.rfind(b'\n', 0, off) + 1
+
+# Returns the offset of the first line (at or after 'lo') whose key is not less
+# than 'key', where each line is "key ekpubhash\n". Comparing the whole line
+# with 'key' gives the same answer as comparing the key, as ' ' sorts before
+# every character allowed in a hostname.
+def bisect(m, key, lo=0):
+    hi = len(m)
+    while lo < hi:
+        mid = line_start(m, (lo + hi) // 2)
+        end = m.find(b'\n', mid)
+        if end < 0:
+            end = len(m)
+        if m[mid:end] < key:
+            lo = end + 1
+        else:
+            hi = mid
+    return lo
+
+# Yields the lines of the base that start with 'prefix' (bytes), in order,
+# starting from the first one that isn't less than 'start'.
+def base_range(m, prefix, start):
+    off = bisect(m, start)
+    while off < len(m):
+        end = m.find(b'\n', off)
+        if end < 0:
+            end = len(m)
+        line = m[off:end]
+        if not line.startswith(prefix):
+            break
+        yield line
+        off = end + 1
+
+# Yields the lines of the table (the base, with the log applied) that start
+# with 'prefix', in order, and that come after 'after' if it is given (e.g. the
+# last line of the previous page of a search).
+def lines_prefix(path, prefix, after=None):
+    log = open_log(path)
+    changes = {}
+    if log is not None:
+        with log:
+            changes = read_log(log, prefix)
+    added = sorted(line for line, present in changes.items()
+                   if present and (after is None or line > after))
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield from added
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            last = None
+            start = prefix if after is None or after < prefix else after
+            for line in heapq.merge(base_range(m, prefix, start), added):
+                # a line that was added again, or added since the log
+                # was merged into this base
+                if line == last or line == after:
+                    continue
+                last = line
+                if changes.get(line, True):
+                    yield line
+
+# Yields the ekpubhash of every line whose reversed hostname starts with
+# 'revprefix' (bytes). The base is replaced atomically by compaction, and the
+# log is only appended to between compactions, so once they are open we see
+# one version of them throughout, without copying or locking.
+def find_prefix(path, revprefix):
+    for line in lines_prefix(path, revprefix):
+        yield line.partition(b' ')[2].decode()
+
+def find(path, hostname_suffix):
+    return find_prefix(path, hostname_suffix[::-1].encode())
+
+# Yields (line, ekpubhash) for the matches of a hostname-suffix search, after
+# the line 'after' (bytes) if it is given, so that a search can be carried on
+# from the last line of a previous one.
+def find_lines(path, hostname_suffix, after=None):
+    for line in lines_prefix(path, hostname_suffix[::-1].encode(), after):
+        yield line, line.partition(b' ')[2].decode()
+
+# The same as find_lines, over the tables of all the shards (a list of paths),
+# in order.
+def find_shards(paths, hostname_suffix, after=None):
+    results = [ find_lines(path, hostname_suffix, after) for path in paths ]
+    try:
+        yield from heapq.merge(*results)
+    finally:
+        for r in results:
+            r.close()
+
+# The same output as the old echo-based op_find.sh, but encoded with json.
+def find_json(paths, hostname_suffix, out=sys.stdout):
+    out.write('{\n  "hostname_suffix": %s,\n  "ekpubhashes": [' %
+              json.dumps(hostname_suffix))
+    sep = '\n    '
+    for _, ekpubhash in find_shards(paths, hostname_suffix):
+        out.write(sep + json.dumps(ekpubhash))
+        sep = ',\n    '
+    out.write('\n  ]\n}\n')
+
+# Appends changes, a list of (True (add) or False (delete), line) pairs, to the
+# log, and compacts it if it is due. The caller holds the repo lock.
+def update(path, changes):
+    # see the comments at the top
+    unsorted = not os.path.exists(log_path(path))
+    with open(log_path(path), 'ab') as log:
+        for present, line in changes:
+            log.write((b'+ ' if present else b'- ') + line + b'\n')
+        size = log.tell()
+    try:
+        base_size = os.stat(path).st_size
+    except FileNotFoundError:
+        base_size = 0
+    if unsorted or size > max(LOG_MIN_SIZE, base_size // LOG_RATIO):
+        compact(path)
+
+def write_replace(path, lines):
+    with open(path + '.tmp', 'wb') as f:
+        f.writelines(lines)
+    os.replace(path + '.tmp', path)
+
+# Merges the log into a new base, which is sorted (rather than merged with the
+# log as it is) in case it wasn't already, see the comments at the top. The
+# caller holds the repo lock.
+def compact(path):
+    log = open_log(path)
+    changes = {}
+    if log is not None:
+        with log:
+            changes = read_log(log)
+    with open(path, 'rb') as f:
+        lines = set(line.rstrip(b'\n') for line in f if line.strip())
+    lines.update(line for line, present in changes.items() if present)
+    out = [ line + b'\n' for line in sorted(lines) if changes.get(line, True) ]
+    # the base first, see the comments at the top
+    write_replace(path, out)
+    write_replace(log_path(path), [])
+
+# Reads a file of table lines, e.g. for add-list
+def read_filter(filter_path):
+    with open(filter_path, 'rb') as f:
+        return [ line.rstrip(b'\n') for line in f if line.strip() ]
+
+# What op_find.sh used to do, for comparison
+def find_linear(path, hostname_suffix):
+    revprefix = hostname_suffix[::-1]
+    with open(path) as f:
+        for line in f:
+            revhn, _, ekpubhash = line.rstrip('\n').partition(' ')
+            if revhn.startswith(revprefix):
+                yield ekpubhash
+
+# Writes a sorted table of 'n' synthetic enrollments, spread over a few
+# domains, and returns the suffixes to search for.
+def make_table(path, n):
+    domains = [ 'dmz.example.com', 'lab.example.com', 'corp.example.net',
+                'edge.example.org' ]
+    lines = []
+    for i in range(n):
+        hn = 'host-%d.rack-%d.%s' % (i, i % 100, domains[i % len(domains)])
+        lines.append('%s %032x\n' % (hn[::-1], random.getrandbits(128)))
+    lines.sort(key=lambda l: l.encode())
+    with open(path, 'w') as f:
+        f.writelines(lines)
+    return [ 'host-%d.rack-%d.%s' % (i, i % 100, domains[i % len(domains)])
+             for i in random.sample(range(n), 20) ] + \
+           [ '.rack-7.' + domains[1], '.' + domains[3], 'no.such.host' ]
+
+def bench(sizes):
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'hn2ek')
+            suffixes = make_table(path, n)
+            start = time.perf_counter()
+            for s in suffixes:
+                list(find(path, s))
+            t_indexed = (time.perf_counter() - start) / len(suffixes)
+            start = time.perf_counter()
+            for s in suffixes:
+                list(find_linear(path, s))
+            t_linear = (time.perf_counter() - start) / len(suffixes)
+            for s in suffixes:
+                if list(find(path, s)) != list(find_linear(path, s)):
+                    print("MISMATCH for suffix '%s'" % s, file=sys.stderr)
+                    return 1
+            print("%8d entries: bisect %.3f ms/find, linear %.3f ms/find (%.0fx)"
+                  % (n, t_indexed * 1000, t_linear * 1000, t_linear / t_indexed))
+            # adds, including the compactions they trigger, against the
+            # sort and rewrite that op_add.sh used to do
+            adds = max(n // 10, 1000)
+            start = time.perf_counter()
+            for i in range(adds):
+                update(path, [ (True, ('host-new-%d.example.com %032x' %
+                        (i, random.getrandbits(128)))[::-1].encode()) ])
+            t_add = (time.perf_counter() - start) / adds
+            start = time.perf_counter()
+            subprocess.run('echo moc.elpmaxe.wen-tsoh 0 | cat - %s | LC_ALL=C sort > %s.tmp'
+                           % (path, path), shell=True, check=True)
+            t_sort = time.perf_counter() - start
+            print("%8d entries: log %.3f ms/add (%d adds), sort %.3f ms/add"
+                  % (n, t_add * 1000, adds, t_sort * 1000))
+    return 0
+
+if __name__ == '__main__':
+    from sys import argv
+
+    if len(argv) >= 4 and argv[1] == 'find':
+        find_json(argv[3:], argv[2])
+        sys.exit(0)
+
+    if len(argv) == 5 and argv[1] == 'add':
+        update(argv[2], [ (True, ('%s %s' % (argv[3], argv[4])).encode()) ])
+        sys.exit(0)
+
+    if len(argv) == 4 and argv[1] == 'add-list':
+        update(argv[2], [ (True, line) for line in read_filter(argv[3]) ])
+        sys.exit(0)
+
+    if len(argv) == 4 and argv[1] == 'delete':
+        update(argv[2], [ (False, line) for line in read_filter(argv[3]) ])
+        sys.exit(0)
+
+    if len(argv) == 4 and argv[1] == 'apply':
+        with open(argv[3], 'rb') as f:
+            changes = read_log(f)
+        update(argv[2], [ (present, line) for line, present in changes.items() ])
+        sys.exit(0)
+
+    if len(argv) == 3 and argv[1] == 'compact':
+        compact(argv[2])
+        sys.exit(0)
+
+    if len(argv) >= 2 and argv[1] == 'bench':
+        sizes = [ int(x) for x in argv[2:] ] or [ 10**4, 10**5, 10**6 ]
+        sys.exit(bench(sizes))
+
+    print("Usage: hn2ek.py find <hostname_suffix> <hn2ek-path> [<hn2ek-path> ...]",
+          file=sys.stderr)
+    print("       hn2ek.py add <hn2ek-path> <reversed-hostname> <ekpubhash>", file=sys.stderr)
+    print("       hn2ek.py add-list <hn2ek-path> <lines-path>", file=sys.stderr)
+    print("       hn2ek.py delete <hn2ek-path> <filter-path>", file=sys.stderr)
+    print("       hn2ek.py apply <hn2ek-path> <changes-path>", file=sys.stderr)
+    print("       hn2ek.py compact <hn2ek-path>", file=sys.stderr)
+    print("       hn2ek.py bench [<entries> ...]", file=sys.stderr)
+    sys.exit(1)
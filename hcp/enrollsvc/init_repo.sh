@@ -4,18 +4,32 @@
 
 expect_db_user
 
+# The number of shards is fixed from here on (see common.sh)
+SHARDS=${HCP_RUN_ENROLL_SHARDS:-1}
+if ! [[ $SHARDS =~ ^[0-9]+$ && $SHARDS -ge 1 && $SHARDS -le 256 ]]; then
+	echo "Error, HCP_RUN_ENROLL_SHARDS must be from 1 to 256" >&2
+	exit 1
+fi
+
 cd $HCP_ENROLLSVC_STATE_PREFIX
 echo "$HCP_VER" > version
+echo "$SHARDS" > shards
 
-mkdir $REPO_PATH
-cd $REPO_PATH
-git init
-echo "$HCP_VER" > version
-touch .git/git-daemon-export-ok
-touch $HN2EK_PATH
-mkdir $EK_BASENAME
-touch $EK_BASENAME/do_not_remove
-cp /hcp/enrollsvc/common_defs.sh .
-git add .
-git commit -m "Initial commit"
-git log
+for ((shard = 0; shard < SHARDS; shard++)); do
+	shard_select $shard
+	mkdir $REPO_PATH
+	cd $REPO_PATH
+	git init
+	echo "$HCP_VER" > version
+	touch .git/git-daemon-export-ok
+	touch $HN2EK_PATH $HN2EK_LOG_PATH
+	mkdir $EK_BASENAME
+	touch $EK_BASENAME/do_not_remove
+	cp /hcp/enrollsvc/common_defs.sh .
+	echo "${HCP_RUN_ENROLL_RECORD_FORMAT:-dirs}" > $RECORD_FORMAT_BASENAME
+	# so that replicas can check that they agree on which shard is which
+	[[ $SHARDS -eq 1 ]] || echo "$shard $SHARDS" > shard
+	git add .
+	git commit -m "Initial commit"
+	git log
+done
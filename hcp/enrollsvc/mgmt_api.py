@@ -2,6 +2,8 @@ import flask
 from flask import request, abort, send_file
 import subprocess
 import json
+import socket
+import threading
 import os, sys
 from stat import *
 from markupsafe import escape
@@ -56,19 +58,104 @@ def home():
 '''
 
 # We enforce privilege separation by running this flask app as the $FLASK_USER
-# account, which has no direct access to any enrollment state. Specific sudo
-# rules allow the $FLASK_USER to invoke the 4 /hcp/enrollsvc/op_<verb>.sh
-# scripts (for <verb> in "add", "query", "delete", and "find") running as
-# $DB_USER. The latter is the account that created the enrollment DB for use
-# only by itself.  The primary role of the /hcp/enrollsvc/op_<verb>.sh scripts
-# is to perform argument-validation, to mitigate the risk of a compromised
-# flask app. (The sudo configuration ensures a fresh environment across this
-# call interface, preventing a compromised flask handler from influencing the
-# scripts other than by the arguments passed to the command.)
+# account, which has no direct access to any enrollment state. The enrollment
+# worker (worker.py) runs as $DB_USER, the account that created the enrollment
+# DB for use only by itself, and it accepts requests only from $FLASK_USER, over
+# a Unix socket. Its requests are the same as the /hcp/enrollsvc/op_<verb>.sh
+# scripts (for <verb> in "add", "add_batch", "query", "delete", and "find") and
+# their arguments, and the primary role of the worker is to perform
+# argument-validation, to mitigate the risk of a compromised flask app. (The
+# worker runs the scripts with a fresh environment, preventing a compromised
+# flask handler from influencing them other than by the arguments passed.) The
+# worker also queues the changes of concurrent requests and commits them
+# together, so many concurrent adds/deletes don't contend for the repo lock.
 #
-# This is the sudo preamble to pass to subprocess.run(), the actual script name
-# and arguments follow this, and are appended by each handler.
-sudoargs=['sudo','-u',os.environ.get('DB_USER')]
+# Each thread keeps its connection to the worker, rather than paying for a new
+# one on every request.
+worker_socket = os.environ.get('HCP_ENROLLSVC_WORKER_SOCKET') or \
+                '/run/hcp-enrollsvc/worker.sock'
+worker_conns = threading.local()
+
+# Sends a request to the worker, and yields its output as it arrives. The
+# generator's return value is the end frame.
+def worker_stream(op, *args):
+    f = getattr(worker_conns, 'f', None)
+    if f is None:
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect(worker_socket)
+        f = worker_conns.f = s.makefile('rwb')
+        s.close()
+    done = False
+    try:
+        f.write(json.dumps({ 'op': op, 'args': list(args) }).encode() + b'\n')
+        f.flush()
+        while True:
+            line = f.readline()
+            if not line:
+                raise ConnectionError("enrollment worker closed the connection")
+            frame = json.loads(line)
+            if 'data' not in frame:
+                break
+            data = f.read(frame['data'])
+            if len(data) != frame['data']:
+                raise ConnectionError("enrollment worker closed the connection")
+            yield data
+        done = True
+    finally:
+        # On failure, or if our caller stopped reading (e.g. the client of a
+        # streamed response went away), the request may or may not have been
+        # done, so it isn't retried, but the next one gets a new connection.
+        if not done:
+            worker_conns.f = None
+            f.close()
+    return frame
+
+# Sends a request to the worker, and returns the result in the same form as
+# subprocess.run() would have for the op_<verb>.sh script.
+def worker_run(op, *args):
+    stream = worker_stream(op, *args)
+    stdout = []
+    while True:
+        try:
+            stdout.append(next(stream))
+        except StopIteration as e:
+            frame = e.value
+            break
+    return subprocess.CompletedProcess([ op ] + list(args), frame['returncode'],
+                                       b''.join(stdout).decode(), frame['stderr'])
+
+# /v1/query and /v1/find take optional 'limit' and 'cursor' parameters, to
+# return a page of results at a time. A response then includes "next", which
+# is the cursor to pass for the page that follows (null if there isn't one).
+# With 'format=ndjson', the response is instead streamed as it is produced, as
+# a line of JSON per result, followed by a line with "next" (or "error", if it
+# failed), so a client can read all the results with bounded memory
+# even without a limit.
+def search(op, arg):
+    limit = request.args.get('limit', '')
+    cursor = request.args.get('cursor', '')
+    fmt = request.args.get('format', 'json')
+    if fmt == 'ndjson':
+        # The status has been sent by the time the worker can fail, so a
+        # failure is signalled by ending with an "error" line instead of "next".
+        def stream():
+            try:
+                frame = yield from worker_stream(op, arg, limit, cursor, fmt)
+            except (OSError, ValueError) as e:
+                frame = { 'returncode': -1, 'stderr': str(e) }
+            if frame['returncode'] != 0:
+                print("Failed operation, dumping stderr")
+                print(frame['stderr'], file = sys.stderr)
+                yield json.dumps({ 'error': f"{op} failed" }).encode() + b'\n'
+        return flask.Response(stream(), mimetype='application/x-ndjson')
+    c = worker_run(op, arg, limit, cursor, fmt)
+    print(c.stdout)
+    if c.returncode != 0:
+        print("Failed operation, dumping stderr")
+        print(c.stderr, file = sys.stderr)
+        abort(500)
+    j = json.loads(c.stdout)
+    return j
 
 @app.route('/v1/add', methods=['POST'])
 def my_add():
@@ -79,19 +166,17 @@ def my_add():
     f = request.files['ekpub']
     h = request.form['hostname']
     # Create a temporary directory (for the ek.pub file), and make it world
-    # readable+executable. The /hcp/enrollsvc/op_add.sh script runs behind
-    # sudo, as another user, and it needs to be able to read the ek.pub.
+    # readable+executable. The add (/hcp/enrollsvc/op_enroll.sh) runs in the
+    # worker, as another user, and it needs to be able to read the ek.pub.
     tf = tempfile.TemporaryDirectory()
     s = os.stat(tf.name)
     os.chmod(tf.name, s.st_mode | S_IROTH | S_IXOTH)
     # Sanitize the user-supplied filename, and join it to the temp directory,
     # this is where the ek.pub file gets saved and is the path passed to the
-    # op_add.sh script.
+    # worker.
     p = os.path.join(tf.name, secure_filename(f.filename))
     f.save(p)
-    c = subprocess.run(sudoargs + ['/hcp/enrollsvc/op_add.sh', p, h],
-                       stdout = subprocess.PIPE, stderr = subprocess.PIPE,
-                       text = True)
+    c = worker_run('add', p, h)
     if c.returncode != 0:
         # stderr is for debugging
         # stdout is for the user (hint: don't leak sensitive info to stdout!)
@@ -104,28 +189,53 @@ def my_add():
     j = json.loads(c.stdout)
     return j
 
-@app.route('/v1/query', methods=['GET'])
-def my_query():
-    if 'ekpubhash' not in request.args:
-        return { "error": "ekpubhash not in request" }
-    h = request.args['ekpubhash']
-    c = subprocess.run(sudoargs + ['/hcp/enrollsvc/op_query.sh', h],
-                       stdout=subprocess.PIPE, stderr = subprocess.PIPE,
-                       text=True)
-    print(c.stdout)
+# The batch form of /v1/add. The request has any number of 'ekpub' files and
+# the same number of 'hostname' fields, which are paired up in order. The
+# response has an entry per pair (in the same order), each of which is what
+# /v1/add would have returned for it.
+@app.route('/v1/add-batch', methods=['POST'])
+def my_add_batch():
+    fs = request.files.getlist('ekpub')
+    hs = request.form.getlist('hostname')
+    if len(fs) == 0:
+        return { "error": "ekpub not in request" }
+    if len(fs) != len(hs):
+        return { "error": "number of ekpubs and hostnames differ" }
+    # As for /v1/add, the directory must be readable by the op_add_batch.sh
+    # script. It gets a sub-directory per pair, named by its position, holding
+    # 'ekpub' and 'hostname' files.
+    tf = tempfile.TemporaryDirectory()
+    s = os.stat(tf.name)
+    os.chmod(tf.name, s.st_mode | S_IROTH | S_IXOTH)
+    for i, (f, h) in enumerate(zip(fs, hs)):
+        d = os.path.join(tf.name, str(i))
+        os.mkdir(d)
+        os.chmod(d, S_IRWXU | S_IRGRP | S_IXGRP | S_IROTH | S_IXOTH)
+        f.save(os.path.join(d, 'ekpub'))
+        with open(os.path.join(d, 'hostname'), 'w') as hf:
+            hf.write(h + '\n')
+    c = worker_run('add_batch', tf.name)
     if c.returncode != 0:
         print("Failed operation, dumping stderr")
         print(c.stderr, file = sys.stderr)
-        abort(500)
+        return {
+                    "returncode": c.returncode,
+                    "txt": c.stdout
+        }
     j = json.loads(c.stdout)
     return j
 
+@app.route('/v1/query', methods=['GET'])
+def my_query():
+    if 'ekpubhash' not in request.args:
+        return { "error": "ekpubhash not in request" }
+    h = request.args['ekpubhash']
+    return search('query', h)
+
 @app.route('/v1/delete', methods=['POST'])
 def my_delete():
     h = request.form['ekpubhash']
-    c = subprocess.run(sudoargs + ['/hcp/enrollsvc/op_delete.sh', h],
-                       stdout=subprocess.PIPE, stderr = subprocess.PIPE,
-                       text=True)
+    c = worker_run('delete', h)
     print(c.stdout)
     if (c.returncode != 0):
         print("Failed operation, dumping stderr")
@@ -137,16 +247,16 @@ def my_delete():
 @app.route('/v1/find', methods=['GET'])
 def my_find():
     h = request.args['hostname_suffix']
-    c = subprocess.run(sudoargs + ['/hcp/enrollsvc/op_find.sh', h],
-                       stdout=subprocess.PIPE, stderr = subprocess.PIPE,
-                       text=True)
-    print(c.stdout)
-    if (c.returncode != 0):
-        print("Failed operation, dumping stderr")
-        print(c.stderr, file = sys.stderr)
+    return search('find', h)
+
+# The enrollment worker's metrics (the queueing and group commit of changes),
+# in the Prometheus text format.
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    c = worker_run('metrics')
+    if c.returncode != 0:
         abort(500)
-    j = json.loads(c.stdout)
-    return j
+    return flask.Response(c.stdout, mimetype='text/plain; version=0.0.4')
 
 @app.route('/v1/get-asset-signer', methods=['GET'])
 def assetSigner():
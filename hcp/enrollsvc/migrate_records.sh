@@ -0,0 +1,56 @@
+#!/bin/bash
+
+. /hcp/enrollsvc/common.sh
+
+expect_db_user
+
+echo "Starting $0" >&2
+echo "  - Param1=$1 (the record format to convert to, 'packed' or 'dirs')" >&2
+
+# Converts every enrollment in the repo to packed records, or back to per-TPM
+# directories (see common_defs.sh), in one commit, and switches adds to that
+# format from then on. It takes the repo lock like any other change, so it can
+# be run (as DB_USER) alongside the enrollment service, and if anything fails,
+# the repo is put back the way it was.
+
+if [[ $1 != packed && $1 != dirs ]]; then
+	echo "Error, the format must be 'packed' or 'dirs'" >&2
+	exit 1
+fi
+
+# If the DB is sharded, each shard is converted in turn (in a commit of its own,
+# under its own lock), stopping at the first that fails.
+function migrate_shard {
+	shard_select $1
+	cd $REPO_PATH
+
+	repo_cmd_lock || (echo "Error, failed to lock repo" >&2 && exit 1) || exit 1
+
+	unset itfailed
+	(/hcp/enrollsvc/enrolldb.py migrate . $2 &&
+		git add -A . &&
+		(git diff --cached --quiet ||
+			git commit -m "Convert enrollments to '$2' records") &&
+		sync -f .) >&2 ||
+		itfailed=1
+
+	if [[ -n "$itfailed" ]]; then
+		(echo "Failure, attempting recovery" &&
+			echo "running 'git reset --hard'" && git reset --hard &&
+			echo "running 'git clean -f -d -x'" && git clean -f -d -x) >&2 ||
+			rollbackfailed=1
+	fi
+
+	# As in op_commit.sh, if recovery failed, leave the repo locked.
+	if [[ -n "$rollbackfailed" ]]; then
+		echo "Fatal, error-recovery failed! LOCKING ENROLLSVC!" >&2
+		exit 1
+	fi
+	repo_cmd_unlock
+	[[ -n "$itfailed" ]] && exit 1
+	/bin/true
+}
+
+for ((shard = 0; shard < SHARDS; shard++)); do
+	migrate_shard $shard $1
+done
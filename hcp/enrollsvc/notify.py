@@ -0,0 +1,257 @@
+#!/usr/bin/python3
+
+# Change notification and the change feed for replicas (see
+# hcp/attestsvc/updater_loop.sh). This runs alongside git-daemon in the
+# enrollsvc-repl container (see run_repl.sh), and serves long-polls of the
+# commit that each shard's repo (see common.sh) is at, so that a replica waits
+# here and only fetches once that has moved, rather than fetching every so
+# often whether anything changed or not. It also serves each shard's change
+# feed (see changefeed.py), for replicas that keep a store of the enrollments
+# rather than clones of the repos.
+#
+# Every change to the DB is a commit (see op_commit.sh), so rather than being
+# told about them, one thread watches the repos' HEADs, by reading the ref
+# files every POLL_INTERVAL. That costs a few small local reads, and nothing of
+# git-daemon, and it sees the commits of every writer (and of both containers)
+# the same way. Once a HEAD moves, the shard's change log is brought up to date
+# and the waiting requests are all woken. The new HEAD is published even if the
+# change log can't be brought up to date (that's tried again until it can), as
+# replicas that keep clones fetch from git and don't need it.
+#
+# The requests;
+#     GET /v1/head?shard=<i>&since=<commit>&wait=<seconds>
+# replies with the shard's (default 0) commit;
+#     { "shard": <i>, "head": "<commit>" }
+# straight away if it isn't 'since' (or no 'since' is given), otherwise once it
+# moves, or after 'wait' seconds (default 0, at most MAX_WAIT) if it doesn't.
+#     GET /v1/changes?shard=<i>&epoch=<epoch>&after=<seq>&limit=<n>&wait=<seconds>
+# replies with the changes of the shard after sequence number 'after' (at most
+# 'limit' of them, default PAGE_SIZE, at most MAX_PAGE_SIZE), in the form that
+# ChangeLog.changes gives, with "shard" and "shards" (the number of them) added.
+# If there are none, it waits for them as /v1/head does. If the replica's
+# position is no good, it replies with 410 (Gone), to say that it must resync.
+#     GET /v1/snapshot?shard=<i>
+# replies with the shard's snapshot, as NDJSON, in the form that
+# ChangeLog.snapshot gives, with "shard" and "shards" added to the first line.
+#
+# Usage;
+#   notify.py <port> <repo-path> [<repo-path> ...]
+#       The repo paths are those of the shards, in order.
+
+import http.server
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+import changefeed
+import enrolldb
+
+POLL_INTERVAL = 0.1
+
+# Longer waits are reduced to this, so that a replica hears from us (or finds
+# out that we've gone) every so often
+MAX_WAIT = 60
+
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+re_commit = re.compile('[0-9a-f]{40}|[0-9a-f]{64}')
+re_number = re.compile('[0-9]+')
+
+# The commit that the repo's HEAD points to, read from the ref files as git
+# leaves them, or from git itself if they aren't in a form we know. None if
+# there is no commit.
+def read_head(repo):
+    gitdir = os.path.join(repo, '.git')
+    try:
+        with open(os.path.join(gitdir, 'HEAD')) as f:
+            head = f.readline().strip()
+        if head.startswith('ref: '):
+            ref = head[5:]
+            try:
+                with open(os.path.join(gitdir, ref)) as f:
+                    head = f.readline().strip()
+            except FileNotFoundError:
+                head = packed_ref(gitdir, ref)
+        if head is not None and re_commit.fullmatch(head):
+            return head
+    except OSError:
+        pass
+    c = subprocess.run([ 'git', '-C', repo, 'rev-parse', '--verify', '-q', 'HEAD' ],
+                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return c.stdout.decode().strip() or None
+
+def packed_ref(gitdir, ref):
+    with open(os.path.join(gitdir, 'packed-refs')) as f:
+        for line in f:
+            oid, _, name = line.rstrip('\n').partition(' ')
+            if name == ref:
+                return oid
+    return None
+
+class Watcher:
+    def __init__(self, repos):
+        self.repos = repos
+        self.cond = threading.Condition()
+        self.heads = [ read_head(repo) for repo in repos ]
+        self.logs = [ changefeed.ChangeLog(repo) for repo in repos ]
+        for log in self.logs:
+            log.update()
+        # The heads that each change log was last brought up to date with
+        self.logged = list(self.heads)
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            time.sleep(POLL_INTERVAL)
+            heads = list(self.heads)
+            updated = False
+            for shard, log in enumerate(self.logs):
+                # Anything that goes wrong here is tried again next time,
+                # rather than ending this thread (and with it, notification)
+                try:
+                    heads[shard] = read_head(self.repos[shard])
+                    if heads[shard] == self.logged[shard]:
+                        continue
+                    log.update()
+                    self.logged[shard] = heads[shard]
+                    updated = True
+                except Exception as e:
+                    print(f"Warning, shard {shard}: unable to update change log: {e}",
+                          file=sys.stderr)
+            with self.cond:
+                if heads != self.heads or updated:
+                    self.heads = heads
+                    self.cond.notify_all()
+
+    # The shard's head, once it isn't 'since', or after 'wait' seconds
+    def wait(self, shard, since, wait):
+        deadline = time.monotonic() + wait
+        with self.cond:
+            while self.heads[shard] == since:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self.cond.wait(left)
+            return self.heads[shard]
+
+    # Returns once the shard's change log has changes after 'after', or after
+    # 'wait' seconds
+    def wait_changes(self, shard, after, wait):
+        deadline = time.monotonic() + wait
+        with self.cond:
+            while self.logs[shard].seq <= after:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self.cond.wait(left)
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def reply(self, code, body):
+        data = (json.dumps(body) + '\n').encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    # The request's arguments, or None if any of them are malformed. 'spec'
+    # gives the pattern and the default (None if it must be given) of each.
+    def parse(self, query, spec):
+        args = urllib.parse.parse_qs(query)
+        result = {}
+        for name, (pattern, default) in spec.items():
+            value = args.get(name, [ default ])[0]
+            if value is None or (value != default and not pattern.fullmatch(value)):
+                return None
+            result[name] = value
+        shard = result.get('shard')
+        if shard is not None and int(shard) >= len(self.server.watcher.repos):
+            return None
+        return result
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        handler = { '/v1/head': self.head,
+                    '/v1/changes': self.changes,
+                    '/v1/snapshot': self.snapshot }.get(url.path)
+        if handler is None:
+            self.reply(404, { 'error': 'not found' })
+            return
+        handler(url.query)
+
+    def head(self, query):
+        args = self.parse(query, { 'shard': (re_number, '0'), 'since': (re_commit, ''),
+                                   'wait': (re_number, '0') })
+        if args is None:
+            self.reply(400, { 'error': 'bad request' })
+            return
+        shard = int(args['shard'])
+        head = self.server.watcher.wait(shard, args['since'] or None,
+                                        min(int(args['wait']), MAX_WAIT))
+        self.reply(200, { 'shard': shard, 'head': head })
+
+    def changes(self, query):
+        args = self.parse(query, { 'shard': (re_number, '0'), 'epoch': (re_commit, None),
+                                   'after': (re_number, None),
+                                   'limit': (re_number, str(PAGE_SIZE)),
+                                   'wait': (re_number, '0') })
+        if args is None or int(args['limit']) == 0:
+            self.reply(400, { 'error': 'bad request' })
+            return
+        watcher = self.server.watcher
+        shard, after = int(args['shard']), int(args['after'])
+        log = watcher.logs[shard]
+        if args['epoch'] == log.epoch:
+            watcher.wait_changes(shard, after, min(int(args['wait']), MAX_WAIT))
+        try:
+            page = log.changes(args['epoch'], after, min(int(args['limit']), MAX_PAGE_SIZE))
+        except changefeed.Resync:
+            self.reply(410, { 'error': 'resync' })
+            return
+        except (enrolldb.DBError, OSError) as e:
+            print(f"Error, shard {shard}: unable to read changes: {e}", file=sys.stderr)
+            self.reply(500, { 'error': 'unable to read changes' })
+            return
+        page.update(shard=shard, shards=len(watcher.repos))
+        self.reply(200, page)
+
+    def snapshot(self, query):
+        args = self.parse(query, { 'shard': (re_number, '0') })
+        if args is None:
+            self.reply(400, { 'error': 'bad request' })
+            return
+        shard = int(args['shard'])
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        # if this fails part way, the replica sees that the snapshot has no end
+        try:
+            self.server.watcher.logs[shard].snapshot(
+                self.wfile, { 'shard': shard, 'shards': len(self.server.watcher.repos) })
+        except (enrolldb.DBError, OSError) as e:
+            print(f"Error, shard {shard}: unable to write snapshot: {e}", file=sys.stderr)
+
+    # Every replica asks all the time, so don't log each request
+    def log_message(self, format, *args):
+        pass
+
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+if __name__ == '__main__':
+    from sys import argv
+
+    if len(argv) < 3 or not argv[1].isdigit():
+        print("Usage: notify.py <port> <repo-path> [<repo-path> ...]", file=sys.stderr)
+        sys.exit(1)
+
+    server = Server(('', int(argv[1])), Handler)
+    server.watcher = Watcher(argv[2:])
+    print(f"Change notification listening on port {argv[1]}", file=sys.stderr)
+    server.serve_forever()
@@ -0,0 +1,95 @@
+#!/bin/bash
+
+. /hcp/enrollsvc/common.sh
+
+expect_db_user
+
+echo "Starting $0" >&2
+echo "  - Param1=$1 (path to the batch directory)" >&2
+
+# The batch directory has a sub-directory per item, named 0, 1, 2, ..., each
+# holding an 'ekpub' file (ek.pub/ek.pem) and a 'hostname' file. This does what
+# op_add.sh does for each item, except that;
+# - the assets are generated (op_enroll.sh) for several items at once, and
+# - the items are committed (op_commit.sh) as one group, i.e. the repo is
+#   locked once, the hn2ek table is updated once, and there is one git commit,
+#   for all the items. (If the DB is sharded, that's one group per shard, and
+#   the shards are committed in parallel.)
+#
+# The JSON output should look like;
+#    {
+#        "returncode": 0,
+#        "entries": [
+#            { "returncode": 0, "hostname": "a.b.c", "ekpubhash": "abbaf00ddeadbeef" },
+#            { "returncode": 2, "hostname": "d.e.f", "txt": "Error, TPM is already enrolled" },
+#            { "returncode": 1, "hostname": "g.h.i", "txt": "Error, 'attest-enroll' failed" }
+#        ]
+#    }
+# where each entry is what op_add.sh would have returned for that item (in
+# particular, 2 still means "already enrolled"), in the order of the items.
+
+if [[ -z $1 || ! -d $1 ]]; then
+	echo "Error, missing or invalid batch directory" >&2
+	exit 1
+fi
+BATCH=$1
+NUM=`ls -1 $BATCH | wc -l`
+for ((i = 0; i < NUM; i++)); do
+	if [[ ! -f $BATCH/$i/ekpub || ! -f $BATCH/$i/hostname ]]; then
+		echo "Error, malformed batch directory" >&2
+		exit 1
+	fi
+done
+
+# The number of attest-enroll runs at once
+JOBS=${HCP_RUN_ENROLL_BATCH_JOBS:-`nproc`}
+
+# Each item gets an item directory, WORK/<i>, see op_enroll.sh and op_commit.sh
+WORK=`mktemp -d`
+trap "rm -rf $WORK" EXIT
+
+# Generate the assets for all the items, JOBS at a time, outside the lock. Like
+# op_add.sh, this is op_enroll.sh for each item.
+for ((i = 0; i < NUM; i++)); do
+	mkdir $WORK/$i
+	while [[ `jobs -rp | wc -l` -ge $JOBS ]]; do
+		wait -n || true
+	done
+	/hcp/enrollsvc/op_enroll.sh $BATCH/$i/ekpub "`head -n 1 $BATCH/$i/hostname`" \
+		$WORK/$i > /dev/null 2> $WORK/$i.log &
+done
+wait || true
+for ((i = 0; i < NUM; i++)); do
+	cat $WORK/$i.log >&2
+done
+
+# Then commit them all at once (per shard). Items are done in order, so if the
+# batch has the same TPM twice (which is necessarily in the same shard), the
+# second one gets the "already enrolled" treatment. If a commit fails,
+# op_commit.sh fails all the items of its shard that hadn't already failed.
+declare -A ITEMS
+for ((i = 0; i < NUM; i++)); do
+	[[ -f $WORK/$i/rc ]] && continue
+	shard=`shard_of $(cat $WORK/$i/ekpubhash)`
+	ITEMS[$shard]="${ITEMS[$shard]} $WORK/$i"
+done
+for shard in "${!ITEMS[@]}"; do
+	/hcp/enrollsvc/op_commit.sh $shard ${ITEMS[$shard]} &
+done
+wait || true
+
+# Output the per-item results
+for ((i = 0; i < NUM; i++)); do
+	read -r hn < $BATCH/$i/hostname || true
+	rc=1
+	[[ -f $WORK/$i/rc ]] && read -r rc < $WORK/$i/rc
+	if [[ $rc == 0 ]]; then
+		cat $WORK/$i/out
+	else
+		jq -n --argjson returncode $rc --arg hostname "$hn" \
+			--arg txt "`cat $WORK/$i/out 2> /dev/null || echo "Error, failed to add enrollment to git repo"`" \
+			'{returncode: $returncode, hostname: $hostname, txt: $txt}'
+	fi
+done | jq -s '{returncode: 0, entries: .}'
+
+/bin/true
@@ -0,0 +1,219 @@
+#!/bin/bash
+
+. /hcp/enrollsvc/common.sh
+
+expect_db_user
+
+echo "Starting $0" >&2
+echo "  - Param1=$1 (shard)" >&2
+echo "  - Params=${@:2} (paths to the item directories)" >&2
+
+# This is the critical section of every change to the DB. It applies a group of
+# changes ("items"), in the order given, under one lock, with one update of the
+# hn2ek table and one git commit. The enrollment worker queues up the changes
+# of concurrent requests and passes all those that are pending to one run of
+# this script (a "group commit"), and op_add.sh, op_add_batch.sh and
+# op_delete.sh use it for their own changes.
+#
+# If the DB is sharded (see common.sh), this only changes the one shard, under
+# that shard's lock, so the groups of different shards can run in parallel.
+# Adds must be for TPMs of this shard, whereas deletes only delete the matching
+# entries that are in this shard.
+#
+# Each item is a directory, holding an 'op' file, and;
+# - for "add", what op_enroll.sh put there,
+# - for "delete", a 'prefix' file with the ekpubhash prefix to delete.
+# An item that already has an 'rc' file (e.g. op_enroll.sh failed) is passed
+# over. Otherwise, this gives each item;
+#   rc   - 0, 1 (failed) or 2 (add only, the TPM is already enrolled)
+#   out  - what op_add.sh or op_delete.sh would print for it. I.e. for an add
+#          that succeeds;
+#              { "returncode": 0, "hostname": "a.b.c", "ekpubhash": "abbaf00ddeadbeef" }
+#          for a delete that succeeds, the deleted entries, in the same form as
+#          op_query.sh's output, and otherwise, the (user-visible) error.
+#
+# The failure of an item (e.g. it is already enrolled) only fails that item,
+# whereas any failure to update the hn2ek table or the repo fails all the items
+# that weren't already failed, and rolls the repo back to the last commit (i.e.
+# only this group's changes are lost). In that case this exits non-zero.
+
+if ! [[ $1 =~ ^[0-9]+$ && $1 -lt $SHARDS ]]; then
+	echo "Error, invalid shard" >&2
+	exit 1
+fi
+SHARD=$1
+shift
+if [[ $# -eq 0 ]]; then
+	echo "Error, no items" >&2
+	exit 1
+fi
+for i in "$@"; do
+	if [[ ! -d $i || ! -f $i/op ]]; then
+		echo "Error, malformed item directory" >&2
+		exit 1
+	fi
+done
+
+# Per-group state;
+#   hn2ek.changes  - the changes to the hn2ek table, in the format of its log
+#   msgs           - a line per change, for the commit message
+#   <n>.out        - the output of the n'th item, if the commit succeeds
+WORK=`mktemp -d`
+trap "rm -rf $WORK" EXIT
+
+function item_fail {
+	echo -n "$2" > $1/out
+	echo "$2" >&2
+	echo "$3" > $1/rc
+}
+
+shard_select $SHARD
+cd $REPO_PATH
+
+# Any error should set 'itfailed', and nothing that changes the repo should run
+# once it is set. NB: do not leak anything sensitive to an item's 'out'!! It
+# ends up in the user's JSON response.
+if ! repo_cmd_lock; then
+	for ITEM in "$@"; do
+		[[ -f $ITEM/rc ]] || item_fail $ITEM "Error, failed to lock repo" 1
+	done
+	exit 1
+fi
+unset itfailed
+
+cat /dev/null > $WORK/hn2ek.changes
+cat /dev/null > $WORK/msgs
+# Adds go in the repo's format (see common_defs.sh)
+FORMAT=dirs
+[[ -f $RECORD_FORMAT_BASENAME ]] && read -r FORMAT < $RECORD_FORMAT_BASENAME
+n=0
+for ITEM in "$@"; do
+	n=$((n + 1))
+	[[ -n $itfailed ]] && break
+	[[ -f $ITEM/rc ]] && continue
+	read -r op < $ITEM/op || true
+	if [[ $op == add ]]; then
+		read -r EKPUBHASH < $ITEM/ekpubhash || true
+		read -r hn < $ITEM/hostname || true
+		if [[ `shard_of "$EKPUBHASH"` != $SHARD ]]; then
+			item_fail $ITEM "Error, TPM is in another shard" 1
+			continue
+		fi
+		ply_path_add "$EKPUBHASH"
+		# Ensure an "exclusive" enrollment, i.e. if the directory (or the
+		# packed record) already exists (which includes an earlier item of
+		# this group having created it), the TPM is already enrolled, and
+		# we're not (yet) supporting enrollment modifications!
+		# NB: the TPM-already-enrolled case returns 2, not 1, in order for
+		# the user to be able to distinguish this. (In many environments,
+		# redundant/surplus events are an expected side-effect of
+		# reliability mechanisms, and so it's useful to be able to treat
+		# the "enrollment failed only because it was already enrolled"
+		# case as a soft/non-error.)
+		if [[ -d "$FPATH" || -f "$FPATH$RECORD_SUFFIX" ]]; then
+			item_fail $ITEM "Error, TPM is already enrolled" 2
+			continue
+		fi
+		HALFHASH=`echo $EKPUBHASH | cut -c 1-16`
+		if [[ $FORMAT == packed ]]; then
+			(mkdir -p `dirname "$FPATH"` &&
+				echo "$EKPUBHASH" > $ITEM/enroll/ekpubhash &&
+				/hcp/enrollsvc/enrolldb.py pack $ITEM/enroll \
+					"$FPATH$RECORD_SUFFIX") >&2 ||
+				itfailed=1
+		else
+			(mkdir -p "$FPATH" &&
+				echo "$EKPUBHASH" > "$FPATH/ekpubhash" &&
+				cp -a $ITEM/enroll/* "$FPATH/") >&2 ||
+				itfailed=1
+		fi
+		[[ -n $itfailed ]] && break
+		(echo "+ `echo "$hn" | rev` `basename $FPATH`" >> $WORK/hn2ek.changes &&
+			echo "map $HALFHASH to $hn" >> $WORK/msgs &&
+			jq -cn --arg hostname "$hn" --arg ekpubhash "$HALFHASH" \
+				'{returncode: 0, hostname: $hostname, ekpubhash: $ekpubhash}' \
+				> $WORK/$n.out) >&2 ||
+			itfailed=1
+	elif [[ $op == delete ]]; then
+		read -r prefix < $ITEM/prefix || true
+		if ! (check_ekpubhash_prefix "$prefix") 2> /dev/null; then
+			item_fail $ITEM "Error, malformed ekpubhash" 1
+			continue
+		fi
+		# Remove the matching directories, in one pass, outputting their
+		# entries and logging the removal of their lines from the hn2ek
+		# table. (The removals are staged with the rest, by "git add -A"
+		# below.)
+		/hcp/enrollsvc/enrolldb.py delete . "$prefix" $WORK/hn2ek.changes \
+			> $WORK/$n.out || itfailed=1
+		[[ -z $itfailed ]] &&
+			[[ `jq '.entries | length' < $WORK/$n.out` -gt 0 ]] &&
+			echo "delete $prefix" >> $WORK/msgs
+	else
+		item_fail $ITEM "Error, unknown op" 1
+		continue
+	fi
+done
+
+# One hn2ek update and one commit for the whole group (if it changed anything).
+# The commit is flushed to disk before any item is reported as done.
+if [[ -z $itfailed && -s $WORK/msgs ]]; then
+	if [[ `wc -l < $WORK/msgs` -eq 1 ]]; then
+		cp $WORK/msgs $WORK/msg
+	else
+		(echo "`wc -l < $WORK/msgs` changes (group commit)" && echo &&
+			cat $WORK/msgs) > $WORK/msg
+	fi
+	(/hcp/enrollsvc/hn2ek.py apply $HN2EK_PATH $WORK/hn2ek.changes &&
+		git add -A . &&
+		git commit -F $WORK/msg &&
+		sync -f .) >&2 ||
+		itfailed=1
+fi
+
+# TODO:
+# 1. This exception/error/rollback path (necessarily before releasing the lock)
+#    needs an alert valve of some kind. It's implemented to maximise
+#    reliability/recovery, by trying to force the clone back to its previous
+#    state, but we really ought to tell someone what we know before we
+#    deliberately try to erase all trace. E.g. if "git reset" is adding loads
+#    of erroneously-deleted files back to the checkout, or if "git clean" is
+#    removing loads of erroneously-generated junk out of the checkout, that
+#    information might indicate what's going wrong.
+# 2. More urgently: if our failure-handling code fails to rollback correctly,
+#    we _REALLY_ have to escalate! For now, we simply leave the repo locked,
+#    which is not the most effective nor appreciated escalation method.
+#
+# As each group is its own commit, putting the repo back to the last commit
+# only undoes this group, never the groups before it.
+function recover_git {
+	[[ -z "$itfailed" ]] && return
+	(echo "Failure, attempting recovery" &&
+		echo "running 'git reset --hard'" && git reset --hard &&
+		echo "running 'git clean -f -d -x'" && git clean -f -d -x) >&2 && return
+	echo "Fatal, error-recovery failed! LOCKING ENROLLSVC!" >&2
+	rollbackfailed=1
+}
+recover_git
+
+# If recovery failed, refuse to unlock the repo, forcing an intervention and
+# blocking further modifications.
+[[ -z "$rollbackfailed" ]] && repo_cmd_unlock
+
+# Give each item its result
+n=0
+for ITEM in "$@"; do
+	n=$((n + 1))
+	[[ -f $ITEM/rc ]] && continue
+	if [[ -z $itfailed ]]; then
+		cp $WORK/$n.out $ITEM/out
+		echo 0 > $ITEM/rc
+	elif [[ `cat $ITEM/op` == delete ]]; then
+		item_fail $ITEM "Error, failed to delete enrollments from git repo" 1
+	else
+		item_fail $ITEM "Error, failed to add enrollment to git repo" 1
+	fi
+done
+# If it failed, fail
+[[ -n "$itfailed" ]] && exit 1
+/bin/true
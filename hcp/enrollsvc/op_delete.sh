@@ -1,11 +1,41 @@
 #!/bin/bash
 
-# So, in fact, the delete operation is already implemented but hidden in
-# op_query.sh. This is because the main logic is around figuring out what to
-# operate on, given a ekpubhash _prefix_, which is what query already handles.
-# We activate the "delete" behavior in the way we invoke op_query;
-export QUERY_PLEASE_ALSO_DELETE=1
-
-# Source rather then execute, that way $0 shows the right thing and the
-# remaining args ($1, $2, etc) are preserved without effort.
-. /hcp/enrollsvc/op_query.sh
+. /hcp/enrollsvc/common.sh
+
+expect_db_user
+
+echo "Starting $0" >&2
+echo "  - Param1=$1 (ekpubhash)" >&2
+
+check_ekpubhash_prefix "$1"
+
+# The deletion itself is done by op_commit.sh (as a group of one), which works
+# out what to delete from the ekpubhash prefix, in the same way as op_query.sh.
+# If the DB is sharded, that is done in each shard the prefix can match, one
+# after the other, and isn't atomic across them; if one fails, the others may
+# still have deleted their entries. The output is the same as op_query.sh's,
+# listing the entries that were deleted.
+
+WORK=`mktemp -d`
+trap "rm -rf $WORK" EXIT
+
+for shard in `shards_of_prefix "$1"`; do
+	ITEM=$WORK/$shard
+	mkdir $ITEM
+	echo delete > $ITEM/op
+	echo "$1" > $ITEM/prefix
+	/hcp/enrollsvc/op_commit.sh $shard $ITEM || true
+	[[ -f $ITEM/rc ]] || exit 1
+	if [[ `cat $ITEM/rc` != 0 ]]; then
+		cat $ITEM/out
+		exit `cat $ITEM/rc`
+	fi
+done
+
+if [[ $SHARDS -eq 1 ]]; then
+	cat $ITEM/out
+else
+	for shard in `shards_of_prefix "$1"`; do
+		cat $WORK/$shard/out
+	done | jq -s '{entries: map(.entries) | add}'
+fi
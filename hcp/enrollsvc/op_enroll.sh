@@ -0,0 +1,62 @@
+#!/bin/bash
+
+. /hcp/enrollsvc/common.sh
+
+expect_db_user
+
+echo "Starting $0" >&2
+echo "  - Param1=$1 (path to ek.pub/ek.pem)" >&2
+echo "  - Param2=$2 (hostname)" >&2
+echo "  - Param3=$3 (path to the item directory)" >&2
+
+# This is the first half of an add; it generates the enrollment assets for one
+# TPM, outside of the repo lock, into an "item" directory (which must exist and
+# be empty) that op_commit.sh then adds to the DB. The item directory gets;
+#   op         - "add"
+#   hostname   - the hostname
+#   enroll/    - the assets, as generated by attest-enroll
+#   ekpubhash  - the EKPUBHASH
+# or if it fails, the same 'rc' and 'out' files that op_commit.sh gives each
+# item (see there), in which case op_commit.sh passes over it.
+#
+# Invoke attest-enroll, which creates a directory full of goodies for the host.
+# attest-enroll uses CHECKOUT and COMMIT hooks to determine the directory and
+# post-process it, respectively. What we do is;
+# - store the output directory (which doesn't exist yet) in EPHEMERAL_ENROLL
+# - call attest-enroll with our hooks
+#   - our CHECKOUT hook reads $EPHEMERAL_ENROLL and returns it to attest-enroll
+#     (via stdout),
+#   - our COMMIT hook does nothing (flexibility later)
+# - use the ek.pub goodie (which won't necessarily match $1, if the latter is in
+#   PEM format!) to determine the EKPUBHASH
+
+if [[ -z $3 || ! -d $3 ]]; then
+	echo "Error, missing or invalid item directory" >&2
+	exit 1
+fi
+ITEM=$3
+echo add > $ITEM/op
+
+function item_fail {
+	echo -n "$1" > $ITEM/out
+	echo "$1" >&2
+	echo 1 > $ITEM/rc
+	exit 1
+}
+
+[[ -n $1 && -n $2 ]] || item_fail "Error, missing at least one argument"
+(check_hostname "$2") || item_fail "Error, malformed hostname"
+
+echo "$2" > $ITEM/hostname
+
+cd /safeboot
+
+EPHEMERAL_ENROLL=$ITEM/enroll ./sbin/attest-enroll -C /safeboot/enroll.conf \
+		-V CHECKOUT=/hcp/enrollsvc/cb_checkout.sh \
+		-V COMMIT=/hcp/enrollsvc/cb_commit.sh -I $1 "$2" >&2 ||
+	item_fail "Error, 'attest-enroll' failed"
+
+[[ -f "$ITEM/enroll/ek.pub" ]] ||
+	item_fail "Error, ek.pub file not where it is expected"
+
+sha256sum "$ITEM/enroll/ek.pub" | cut -f1 -d' ' > $ITEM/ekpubhash
@@ -9,8 +9,6 @@ echo "  - Param1=$1 (hostname_suffix)" >&2
 
 check_hostname_suffix "$1"
 
-cd $REPO_PATH
-
 # The JSON output should look like;
 #    {
 #        "hostname_suffix": ".dmz.mydomain.foo",
@@ -23,31 +21,24 @@ cd $REPO_PATH
 #        ]
 #    }
 
-echo "{"
-echo "  \"hostname_suffix\": \"$1\","
-echo "  \"ekpubhashes\": ["
-
 # The table is indexed by _reversed_ hostname, so that our hostname_suffix
-# search becomes a prefix search on the table.
-revsuffix=`echo $1 | rev`
-
-# The reverse lookup table file is replaced atomically by the add/delete logic,
-# so when we pipe it into our filter loop below, it will remain unmodified
-# throughout the loop, even if the underlying file has been unlinked from the
-# file system and replaced. I.e. we don't need to copy nor lock.
-
-# TODO: we should use 'jq' to produce the JSON, not 'echo'.
-
-# Filter the lookup table, line by line, through a prefix comparison
-(while IFS=" " read -r revhn ekpubhash
-do
-	if [[ $revhn == $revsuffix* ]]; then
-		[[ -n $NEEDCOMMA ]] && echo "    ,"
-		echo "    \"$ekpubhash\""
-		NEEDCOMMA=1
-	fi
-done < $HN2EK_PATH) ||
-	(echo "Error, the filter loop failed" >&2 && exit 1) || exit 1
-
-echo "  ]"
-echo "}"
+# search becomes a prefix search on the table. It is sorted, so hn2ek.py finds
+# the matching range with a binary search rather than reading every line, and
+# writes the JSON as it goes.
+#
+# The reverse lookup table's base file is replaced atomically, and its log only
+# appended to, by the add/delete logic, so once hn2ek.py has them open, they
+# will remain consistent throughout the search, even if the base has been
+# unlinked from the file system and replaced. I.e. we don't need to copy nor
+# lock. (See hn2ek.py for the details.)
+
+# If the DB is sharded, each shard has its own table, and hn2ek.py searches them
+# all, merging the results.
+
+HN2EK_PATHS=
+for repo in $SHARD_PATHS; do
+	HN2EK_PATHS="$HN2EK_PATHS $repo/$HN2EK_BASENAME"
+done
+
+/hcp/enrollsvc/hn2ek.py find "$1" $HN2EK_PATHS ||
+	(echo "Error, the hn2ek search failed" >&2 && exit 1) || exit 1
@@ -25,6 +25,19 @@ echo "Chowning gencert CA creds for use by db_user"
 
 chown db_user:db_user $GENCERT_CA_PRIV $GENCERT_CA_CERT
 
+echo "Starting the enrollment worker"
+
+mkdir -p $WORKER_DIR
+chown $DB_USER:$DB_USER $WORKER_DIR
+chmod 755 $WORKER_DIR
+rm -f $WORKER_SOCKET
+drop_privs_db /hcp/enrollsvc/run_worker.sh &
+while [[ ! -S $WORKER_SOCKET ]]; do
+	kill -0 $! 2> /dev/null ||
+		(echo "Error, the enrollment worker exited" >&2 && exit 1) || exit 1
+	sleep 0.1
+done
+
 echo "Running 'enrollsvc-mgmt' service"
 
 drop_privs_flask /hcp/enrollsvc/flask_wrapper.sh
@@ -24,10 +24,19 @@ echo "Running 'enrollsvc-repl' service (git-daemon)"
 GITDAEMON=${HCP_RUN_ENROLL_GITDAEMON:=/usr/lib/git-core/git-daemon}
 GITDAEMON_FLAGS=${HCP_RUN_ENROLL_GITDAEMON_FLAGS:=--reuseaddr --verbose --listen=0.0.0.0 --port=9418}
 
+# If the DB is sharded, each shard is exported as a repo of its own (see
+# common.sh), for replicas to fetch independently.
 TO_RUN="$GITDAEMON \
 	--base-path=$HCP_ENROLLSVC_STATE_PREFIX \
 	$GITDAEMON_FLAGS \
-	$REPO_PATH"
+	$SHARD_PATHS"
+
+# The change notification (and the change feed) for replicas (see notify.py)
+# runs alongside. If it fails, replicas that clone fall back to polling, so
+# git-daemon carries on regardless.
+NOTIFY_PORT=${HCP_RUN_ENROLL_NOTIFY_PORT:=9419}
+echo "Running (as $DB_USER): notify.py on port $NOTIFY_PORT"
+drop_privs_db /hcp/enrollsvc/notify.py $NOTIFY_PORT $SHARD_PATHS &
 
 echo "Running (as $DB_USER): $TO_RUN"
 drop_privs_db $TO_RUN
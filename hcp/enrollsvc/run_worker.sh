@@ -0,0 +1,34 @@
+#!/bin/bash
+
+. /hcp/enrollsvc/common.sh
+
+expect_db_user
+
+# The enrollment worker (see worker.py) serves the flask app's requests, which
+# used to be made through sudo. run_mgmt.sh starts this in the background
+# before it starts the flask app.
+
+# A hn2ek table from before there was a log of its changes may not be in byte
+# order, which its searches rely on (see hn2ek.py), so sort it (by compacting
+# it) before anything searches it.
+for ((shard = 0; shard < SHARDS; shard++)); do
+	shard_select $shard
+	[[ -f $HN2EK_PATH && ! -f $HN2EK_LOG_PATH ]] || continue
+	echo "Sorting $HN2EK_PATH" >&2
+	repo_cmd_lock || (echo "Error, failed to lock repo" >&2 && exit 1) || exit 1
+	(cd $REPO_PATH &&
+		/hcp/enrollsvc/hn2ek.py compact $HN2EK_PATH &&
+		git add -A . &&
+		(git diff --cached --quiet ||
+			git commit -m "Sort the hn2ek table in byte order")) >&2 ||
+		(repo_cmd_unlock && exit 1) || exit 1
+	repo_cmd_unlock
+done
+shard_select 0
+
+echo "Running enrollment worker on $WORKER_SOCKET" >&2
+
+# For "add_batch", as for op_add_batch.sh
+export HCP_RUN_ENROLL_BATCH_JOBS
+
+exec /hcp/enrollsvc/worker.py $WORKER_SOCKET $FLASK_USER $SHARD_PATHS
@@ -0,0 +1,504 @@
+#!/usr/bin/python3
+
+# The enrollment worker. This runs as $DB_USER for the life of the
+# enrollsvc-mgmt container (see run_worker.sh), and the flask app (mgmt_api.py,
+# running as $FLASK_USER) sends it requests over a Unix socket, rather than
+# calling each of the /hcp/enrollsvc/op_<verb>.sh scripts through sudo.
+#
+# The trust boundary is the same as it was with sudo;
+# - the only peer accepted on the socket is $FLASK_USER (checked with
+#   SO_PEERCRED, not just by the socket permissions),
+# - the only requests are the same <verb>s with the same arguments as the
+#   scripts take, and these are strictly validated here (with the same rules as
+#   common_defs.sh) before anything else is done with them, and
+# - the scripts run with a fresh environment, as they would after sudo, so
+#   nothing can be passed to them other than by those arguments.
+#
+# "find" (hn2ek.py) and "query" (enrolldb.py) are served in-process, without
+# the repo lock, as they only read. "add", "add_batch" and "delete" do what
+# their op_<verb>.sh scripts do, in the same two steps; generating any assets
+# (op_enroll.sh, concurrently), then committing (op_commit.sh, which takes the
+# repo lock). But rather than committing each request by itself, they queue
+# their changes for a group commit (see groupcommit.py), and "metrics" returns
+# the group commit metrics, in the Prometheus text format.
+#
+# If the DB is sharded (see common.sh), there is a group commit per shard, and
+# each change goes to the shard(s) it is for; an "add" to its TPM's shard, and
+# an "add_batch" or "delete" is split up into the shards it touches, which are
+# committed in parallel. (So a "delete" that spans shards isn't atomic; if one
+# of them fails, the others may still have deleted their entries.) A "query"
+# reads the shards in order, and a "find" merges the hn2ek tables of them all.
+#
+# "find" and "query" take, after the op_<verb>.sh argument;
+# - a limit ("" for none) on the number of results,
+# - a cursor ("" to start at the beginning), the opaque "next" from the
+#   previous page, to carry on from where it stopped, and
+# - the format, "json" (as op_<verb>.sh writes, plus "next" if there was a
+#   limit) or "ndjson" (a line of JSON per result, then a line with "next").
+# "next" is null once there are no more results. A query's cursor also pins the
+# commit its first page was read from, so its pages are one consistent
+# snapshot (of each shard). The output is sent as it is produced, rather than all at once, so
+# a search that fails part way may have sent some of it before its end frame.
+#
+# The protocol. A connection carries any number of requests, which may be sent
+# without waiting for the responses (they are answered in order). A request is
+# one line of JSON;
+#     { "op": "<verb>", "args": [ "<arg1>", ... ] }
+# A response is zero or more data frames, each a line of JSON giving the size
+# of the data that follows it;
+#     { "data": <length> }\n<length bytes of the output>
+# followed by one end frame;
+#     { "returncode": <int>, "stderr": "<text>" }
+# The output (the concatenation of the data) is what the op_<verb>.sh script
+# would have written to stdout. A request that fails validation gets a
+# returncode of 1 (and no data), and one that isn't even well-formed closes the
+# connection.
+#
+# Usage;
+#   worker.py <socket-path> <allowed-user> <repo-path> [<repo-path> ...]
+#       The repo paths are those of the shards, in order. Each one's hn2ek table
+#       is the 'hn2ek' file in it.
+
+import base64
+import concurrent.futures
+import json
+import os
+import pwd
+import re
+import shutil
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import traceback
+
+import enrolldb
+import groupcommit
+import hn2ek
+
+# Requests longer than this are not well-formed
+MAX_REQUEST = 65536
+
+# Output is sent in data frames of up to this size
+FRAME_SIZE = 65536
+
+# Larger limits are reduced to this, to bound the size of a page
+MAX_PAGE = 10000
+MAX_CURSOR = 512
+
+# The same rules as check_ekpubhash_prefix and check_hostname in
+# common_defs.sh. (fullmatch, so that a trailing newline isn't allowed.)
+re_ekpubhash_prefix = re.compile('[0-9a-f]*')
+re_hostname = re.compile('[0-9a-zA-Z._-]*')
+re_limit = re.compile('[0-9]*')
+re_cursor = re.compile('[0-9a-zA-Z_=-]*')
+re_tree = re.compile('[0-9a-f]{40}|[0-9a-f]{64}')
+re_ply3 = re.compile('[0-9a-f]{1,32}')
+re_hn2ek_line = re.compile('[0-9a-zA-Z._-]* [0-9a-f]+')
+
+class BadRequest(Exception):
+    pass
+
+# Uploads are passed by the flask app as paths in temporary directories that it
+# made readable for us. Only accept absolute, normalized paths below the
+# temporary directory.
+def check_upload(path, isdir):
+    tmp = tempfile.gettempdir()
+    if not os.path.isabs(path) or os.path.normpath(path) != path or \
+            os.path.commonpath([tmp, path]) != tmp or path == tmp:
+        raise BadRequest("bad upload path")
+    if isdir and not os.path.isdir(path):
+        raise BadRequest("upload is not a directory")
+    if not isdir and not os.path.isfile(path):
+        raise BadRequest("upload is not a file")
+
+def check_ekpubhash_prefix(s):
+    if not re_ekpubhash_prefix.fullmatch(s):
+        raise BadRequest("malformed ekpubhash")
+
+def check_hostname(s):
+    if not re_hostname.fullmatch(s):
+        raise BadRequest("malformed hostname")
+
+def check_limit(s):
+    if not re_limit.fullmatch(s) or (s and int(s) == 0):
+        raise BadRequest("malformed limit")
+
+def check_format(s):
+    if s not in ('json', 'ndjson'):
+        raise BadRequest("unknown format")
+
+# Cursors are "<kind>:<position>", base64-encoded (URL-safe). The positions are
+# "<tree> <ply3>" for a query (the tree being the snapshot of the ply3's shard)
+# and the last hn2ek line for a find.
+def encode_cursor(kind, pos):
+    return base64.urlsafe_b64encode(f"{kind}:{pos}".encode()).decode()
+
+def decode_cursor(kind, s):
+    if s == '':
+        return None
+    if len(s) > MAX_CURSOR or not re_cursor.fullmatch(s):
+        raise BadRequest("malformed cursor")
+    try:
+        pos = base64.urlsafe_b64decode(s).decode()
+    except ValueError:
+        raise BadRequest("malformed cursor")
+    if not pos.startswith(kind + ':'):
+        raise BadRequest("malformed cursor")
+    return pos[len(kind) + 1:]
+
+def check_query_cursor(s):
+    pos = decode_cursor('q', s)
+    if pos is not None:
+        tree, _, ply3 = pos.partition(' ')
+        if not re_tree.fullmatch(tree) or not re_ply3.fullmatch(ply3):
+            raise BadRequest("malformed cursor")
+
+def check_find_cursor(s):
+    pos = decode_cursor('f', s)
+    if pos is not None and not re_hn2ek_line.fullmatch(pos):
+        raise BadRequest("malformed cursor")
+
+# For each <verb>; the checks for each of its arguments
+ops = {
+    'add': [ lambda s: check_upload(s, False), check_hostname ],
+    'add_batch': [ lambda s: check_upload(s, True) ],
+    'query': [ check_ekpubhash_prefix, check_limit, check_query_cursor, check_format ],
+    'delete': [ check_ekpubhash_prefix ],
+    'find': [ check_hostname, check_limit, check_find_cursor, check_format ],
+    'metrics': [],
+}
+
+def parse_request(line):
+    try:
+        req = json.loads(line)
+    except ValueError:
+        raise BadRequest("malformed request")
+    if not isinstance(req, dict) or not isinstance(req.get('op'), str) or \
+            not isinstance(req.get('args'), list) or \
+            not all(isinstance(a, str) for a in req['args']):
+        raise BadRequest("malformed request")
+    return req['op'], req['args']
+
+# The environment that sudo would have given the scripts
+def script_env():
+    pw = pwd.getpwuid(os.getuid())
+    return {
+        'PATH': '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin',
+        'HOME': pw.pw_dir,
+        'USER': pw.pw_name,
+        'LOGNAME': pw.pw_name,
+        'SHELL': '/bin/bash',
+    }
+
+# Sends what is written to it as data frames
+class FrameWriter:
+    def __init__(self, handler):
+        self.handler = handler
+        self.buf = []
+        self.size = 0
+
+    def write(self, s):
+        self.buf.append(s)
+        self.size += len(s)
+        if self.size >= FRAME_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.buf:
+            self.handler.send_data(''.join(self.buf).encode())
+        self.buf = []
+        self.size = 0
+
+# The number of op_enroll.sh runs at once, for each "add_batch"
+batch_jobs = int(os.environ.get('HCP_RUN_ENROLL_BATCH_JOBS') or 0) or os.cpu_count()
+
+# Runs op_enroll.sh, to generate the assets of an add into an item directory,
+# and returns its stderr. (If it fails, the item says so, see op_enroll.sh.)
+def enroll(ekpub, hostname, item):
+    try:
+        c = subprocess.run([ '/hcp/enrollsvc/op_enroll.sh', ekpub, hostname, item ],
+                           env=script_env(), stdin=subprocess.DEVNULL,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except OSError as e:
+        return f"Error, failed to run op_enroll.sh: {e}\n"
+    return c.stderr.decode(errors='replace')
+
+# Yields (position, entry) for a query, see enrolldb.query_shards
+def query_results(repos, prefix, tree, after):
+    results = enrolldb.query_shards(repos, prefix, tree, after)
+    try:
+        for t, ply3, entry in results:
+            yield f"{t} {ply3}", entry
+    finally:
+        results.close()
+
+# The same JSON as op_query.sh (and op_delete.sh) writes
+def entries_json(entries):
+    return '{\n  "entries": [' + \
+        ','.join('\n    ' + json.dumps(e) for e in entries) + '\n  ]\n}\n'
+
+# The returncode and output of an item, once op_commit.sh has been run on it,
+# or 1 and 'failed' if it didn't get that far.
+def item_result(item, failed):
+    try:
+        with open(os.path.join(item, 'rc')) as f:
+            rc = int(f.read())
+        with open(os.path.join(item, 'out')) as f:
+            return rc, f.read()
+    except (OSError, ValueError):
+        return 1, failed
+
+class Handler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        creds = self.request.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                        struct.calcsize('3i'))
+        self.peer_pid, self.peer_uid, _ = struct.unpack('3i', creds)
+
+    def send_data(self, data):
+        for off in range(0, len(data), FRAME_SIZE):
+            chunk = data[off:off + FRAME_SIZE]
+            self.wfile.write(json.dumps({ 'data': len(chunk) }).encode() + b'\n')
+            self.wfile.write(chunk)
+
+    def send_end(self, returncode, stderr=''):
+        self.wfile.write(json.dumps({ 'returncode': returncode,
+                                      'stderr': stderr }).encode() + b'\n')
+        self.wfile.flush()
+
+    # Writes a page of results, given an iterator of (position, result), and
+    # returns the position of the last result if there are more to come. In
+    # the "json" format, 'header' is the fields that come before the results,
+    # which are in a list called 'name'.
+    def write_page(self, out, results, limit, ndjson, header, name):
+        if not ndjson:
+            out.write('{\n')
+            for k, v in header.items():
+                out.write(f'  {json.dumps(k)}: {json.dumps(v)},\n')
+            out.write(f'  {json.dumps(name)}: [')
+        sep = '\n    '
+        n = 0
+        last = None
+        for pos, result in results:
+            if n == limit:
+                return last
+            if ndjson:
+                out.write(json.dumps(result) + '\n')
+            else:
+                out.write(sep + json.dumps(result))
+                sep = ',\n    '
+            n += 1
+            last = pos
+        return None
+
+    def serve_search(self, op, args):
+        limit = min(int(args[1]), MAX_PAGE) if args[1] else None
+        ndjson = args[3] == 'ndjson'
+        out = FrameWriter(self)
+        try:
+            if op == 'find':
+                after = decode_cursor('f', args[2])
+                results = hn2ek.find_shards(self.server.hn2ek_paths, args[0],
+                                            after.encode() if after else None)
+                header = { 'hostname_suffix': args[0] }
+                name = 'ekpubhashes'
+            else:
+                tree, _, after = (decode_cursor('q', args[2]) or '').partition(' ')
+                results = query_results(self.server.repo_paths, args[0], tree or None, after)
+                header = {}
+                name = 'entries'
+            try:
+                last = self.write_page(out, results, limit, ndjson, header, name)
+            finally:
+                results.close()
+        except (OSError, enrolldb.DBError) as e:
+            out.flush()
+            self.send_end(1, f"Error, the {op} failed: {e}\n")
+            return
+        if last is None:
+            cursor = None
+        elif op == 'find':
+            cursor = encode_cursor('f', last.decode())
+        else:
+            cursor = encode_cursor('q', last)
+        if ndjson:
+            out.write(json.dumps({ 'next': cursor }) + '\n')
+        elif limit is None:
+            out.write('\n  ]\n}\n')
+        else:
+            out.write(f'\n  ],\n  "next": {json.dumps(cursor)}\n}}\n')
+        out.flush()
+        self.send_end(0)
+
+    # Serves "add", "add_batch" or "delete", in the same way as (and with the
+    # same output as) their op_<verb>.sh scripts.
+    def serve_change(self, op, args):
+        work = tempfile.mkdtemp()
+        try:
+            if op == 'add':
+                item = os.path.join(work, '0')
+                os.mkdir(item)
+                stderr = enroll(args[0], args[1], item)
+                if not os.path.exists(os.path.join(item, 'rc')):
+                    stderr += self.submit(self.group_adds([ item ]))
+                rc, out = item_result(item, "Error, failed to add enrollment to git repo")
+            elif op == 'delete':
+                rc, out, stderr = self.delete(args[0], work)
+            else:
+                rc, out, stderr = self.add_batch(args[0], work)
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
+        self.send_data(out.encode())
+        self.send_end(rc, stderr)
+
+    # Commits a dict of { shard: [ item, ... ] }, the shards in parallel, and
+    # returns the stderr of their op_commit.sh runs.
+    def submit(self, groups):
+        committers = self.server.committers
+        if len(groups) == 1:
+            (shard, items), = groups.items()
+            return committers[shard].submit(items)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(groups)) as pool:
+            return ''.join(pool.map(lambda g: committers[g[0]].submit(g[1]),
+                                    groups.items()))
+
+    # Groups the adds that op_enroll.sh didn't fail by the shard of their TPM
+    def group_adds(self, items):
+        groups = {}
+        for item in items:
+            if os.path.exists(os.path.join(item, 'rc')):
+                continue
+            with open(os.path.join(item, 'ekpubhash')) as f:
+                shard = enrolldb.shard_of(f.read(), len(self.server.committers))
+            groups.setdefault(shard, []).append(item)
+        return groups
+
+    # As op_delete.sh
+    def delete(self, prefix, work):
+        shards = enrolldb.shards_of_prefix(prefix, len(self.server.committers))
+        groups = {}
+        for shard in shards:
+            item = os.path.join(work, str(shard))
+            os.mkdir(item)
+            with open(os.path.join(item, 'op'), 'w') as f:
+                f.write('delete\n')
+            with open(os.path.join(item, 'prefix'), 'w') as f:
+                f.write(prefix + '\n')
+            groups[shard] = [ item ]
+        stderr = self.submit(groups)
+        entries = []
+        for shard in shards:
+            rc, out = item_result(groups[shard][0],
+                                  "Error, failed to delete enrollments from git repo")
+            if rc != 0 or len(shards) == 1:
+                return rc, out, stderr
+            entries += json.loads(out)['entries']
+        return 0, entries_json(entries), stderr
+
+    # As op_add_batch.sh
+    def add_batch(self, batch, work):
+        num = len(os.listdir(batch))
+        hostnames = []
+        for i in range(num):
+            try:
+                with open(os.path.join(batch, str(i), 'hostname')) as f:
+                    hostnames.append(f.readline().rstrip('\n'))
+            except OSError:
+                return 1, '', "Error, malformed batch directory\n"
+            if not os.path.isfile(os.path.join(batch, str(i), 'ekpub')):
+                return 1, '', "Error, malformed batch directory\n"
+        items = [ os.path.join(work, str(i)) for i in range(num) ]
+        for item in items:
+            os.mkdir(item)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=batch_jobs) as pool:
+            stderrs = list(pool.map(enroll,
+                                    [ os.path.join(batch, str(i), 'ekpub') for i in range(num) ],
+                                    hostnames, items))
+        stderr = ''.join(stderrs)
+        groups = self.group_adds(items)
+        if groups:
+            stderr += self.submit(groups)
+        entries = []
+        for hostname, item in zip(hostnames, items):
+            rc, out = item_result(item, "Error, failed to add enrollment to git repo")
+            if rc == 0:
+                entries.append(json.loads(out))
+            else:
+                entries.append({ 'returncode': rc, 'hostname': hostname, 'txt': out })
+        return 0, json.dumps({ 'returncode': 0, 'entries': entries }, indent=2) + '\n', stderr
+
+    # Serves one request, given its (validated) verb and arguments
+    def serve(self, op, args):
+        if op in ('find', 'query'):
+            self.serve_search(op, args)
+        elif op == 'metrics':
+            self.send_data(groupcommit.render(self.server.committers).encode())
+            self.send_end(0)
+        else:
+            self.serve_change(op, args)
+
+    def handle(self):
+        if self.peer_uid != self.server.allowed_uid:
+            print(f"Refusing connection from uid {self.peer_uid} (pid {self.peer_pid})",
+                  file=sys.stderr)
+            return
+        while True:
+            line = self.rfile.readline(MAX_REQUEST + 1)
+            if not line:
+                return
+            if len(line) > MAX_REQUEST or not line.endswith(b'\n'):
+                print("Closing connection after an over-long request", file=sys.stderr)
+                return
+            try:
+                op, args = parse_request(line)
+            except BadRequest as e:
+                print(f"Closing connection after a bad request: {e}", file=sys.stderr)
+                return
+            try:
+                if op not in ops:
+                    raise BadRequest(f"unknown op '{op}'")
+                checks = ops[op]
+                if len(args) != len(checks):
+                    raise BadRequest(f"'{op}' takes {len(checks)} argument(s)")
+                for check, arg in zip(checks, args):
+                    check(arg)
+            except BadRequest as e:
+                self.send_end(1, f"Error, {e}\n")
+                continue
+            try:
+                self.serve(op, args)
+            except (OSError, ValueError):
+                traceback.print_exc()
+                return
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+if __name__ == '__main__':
+    from sys import argv
+
+    if len(argv) < 4:
+        print("Usage: worker.py <socket-path> <allowed-user> <repo-path> [<repo-path> ...]",
+              file=sys.stderr)
+        sys.exit(1)
+
+    sock_path = argv[1]
+    if os.path.exists(sock_path):
+        os.unlink(sock_path)
+    server = Server(sock_path, Handler)
+    server.allowed_uid = pwd.getpwnam(argv[2]).pw_uid
+    server.repo_paths = argv[3:]
+    server.hn2ek_paths = [ os.path.join(repo, 'hn2ek') for repo in server.repo_paths ]
+    # a group commit per shard, whose metrics are only labelled if there's
+    # more than one
+    server.committers = [
+        groupcommit.GroupCommitter([ '/hcp/enrollsvc/op_commit.sh', str(shard) ], script_env,
+                                   f'shard="{shard}"' if len(server.repo_paths) > 1 else '')
+        for shard in range(len(server.repo_paths)) ]
+    # The peer is checked per connection, the socket itself is open to all
+    os.chmod(sock_path, 0o666)
+    print(f"Enrollment worker listening on {sock_path}", file=sys.stderr)
+    server.serve_forever()
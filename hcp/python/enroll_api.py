@@ -6,14 +6,21 @@
 #               -F hostname=<hostname> \
 #               <enrollsvc-URL>/v1/add
 #
+# add-batch: curl -v -F ekpub=@</path/to/ek1.pub> -F hostname=<hostname1> \
+#                 -F ekpub=@</path/to/ek2.pub> -F hostname=<hostname2> \
+#                 <enrollsvc-URL>/v1/add-batch
+#
 # query:   curl -v -G -d ekpubhash=<hexstring> \
 #               <enrollsvc-URL>/v1/query
+#          (add '-d limit=<N>', then '-d cursor=<next>' from each response, to
+#          page through the results, or '-d format=ndjson' to stream them)
 #
 # delete:  curl -v -F ekpubhash=<hexstring> \
 #               <enrollsvc-URL>/v1/delete
 #
 # find:    curl -v -G -d hostname_suffix=<hostname_suffix> \
 #               <enrollsvc-URL>/v1/find
+#          (with the same 'limit', 'cursor' and 'format' options as query)
 #
 # get-asset-signer:  curl -v -G <enrollsvc-URL>/v1/get-asset-signer
 
@@ -43,7 +50,7 @@ if os.environ.get('HCP_GSSAPI'):
 # unpack those and pass the parameters into a more API-like interface for the
 # actual implementations.
 
-# Handler functions for the subcommands (add, query, delete, find)
+# Handler functions for the subcommands (add, add-batch, query, delete, find)
 # They all return a 2-tuple of {result,json}, where result is True iff the
 # operation was successful.
 
@@ -67,32 +74,78 @@ def enroll_add(args):
         return False, jr
     return True, jr
 
-def do_query_or_delete(args, is_delete):
-    if is_delete:
-        form_data = { 'ekpubhash': (None, args.ekpubhash) }
-        response = requests.post(args.api + '/v1/delete', files=form_data, auth=auth)
-    else:
-        form_data = { 'ekpubhash': args.ekpubhash }
-        response = requests.get(args.api + '/v1/query', params=form_data, auth=auth)
+def enroll_add_batch(args):
+    form_data = []
+    with open(args.batchfile, 'r') as bf:
+        for line in bf:
+            fields = line.split()
+            if len(fields) == 0 or fields[0].startswith('#'):
+                continue
+            if len(fields) != 2:
+                print(f"Error, malformed line in {args.batchfile}: {line.rstrip()}")
+                return False, None
+            form_data.append(('ekpub', ('ek.pub', open(fields[0], 'rb'))))
+            form_data.append(('hostname', (None, fields[1])))
+    response = requests.post(args.api + '/v1/add-batch', files=form_data, auth=auth)
     if response.status_code != 200:
         print(f"Error, response status code was {response.status_code}")
         return False, None
     try:
         jr = json.loads(response.content)
-    except:
+        rcodes = [ e['returncode'] for e in jr['entries'] ]
+    except (KeyError, ValueError):
         print("Error, JSON decoding of response failed")
         return False, None
+    # As with 'add', "already enrolled" (2) is reported as a failure, the
+    # per-entry returncodes tell the caller which it was.
+    if any(rcode != 0 for rcode in rcodes):
+        return False, jr
     return True, jr
 
+class PagingError(Exception):
+    pass
+
+# Yields the results (the items of the 'name' list) of a /v1/query or /v1/find,
+# fetching them a page of (at most) 'page_size' at a time, and following the
+# "next" cursor of each page to the one after, so that only one page is held
+# at a time. Raises PagingError if any page fails.
+def iter_results(api, path, params, name, page_size=1000):
+    cursor = ''
+    while True:
+        form_data = dict(params, limit=str(page_size), cursor=cursor)
+        response = requests.get(api + path, params=form_data, auth=auth)
+        if response.status_code != 200:
+            raise PagingError(f"response status code was {response.status_code}")
+        try:
+            jr = json.loads(response.content)
+            results = jr[name]
+        except (KeyError, ValueError):
+            raise PagingError("JSON decoding of response failed")
+        yield from results
+        # (a server that doesn't page returns everything, without "next")
+        cursor = jr.get('next')
+        if not cursor:
+            return
+
+def iter_query(api, ekpubhash, page_size=1000):
+    return iter_results(api, '/v1/query', { 'ekpubhash': ekpubhash }, 'entries',
+                        page_size)
+
+def iter_find(api, hostname_suffix, page_size=1000):
+    return iter_results(api, '/v1/find', { 'hostname_suffix': hostname_suffix },
+                        'ekpubhashes', page_size)
+
 def enroll_query(args):
-    return do_query_or_delete(args, False)
+    try:
+        entries = list(iter_query(args.api, args.ekpubhash, args.page_size))
+    except PagingError as e:
+        print(f"Error, {e}")
+        return False, None
+    return True, { 'entries': entries }
 
 def enroll_delete(args):
-    return do_query_or_delete(args, True)
-
-def enroll_find(args):
-    form_data = { 'hostname_suffix': args.hostname_suffix }
-    response = requests.get(args.api + '/v1/find', params=form_data, auth=auth)
+    form_data = { 'ekpubhash': (None, args.ekpubhash) }
+    response = requests.post(args.api + '/v1/delete', files=form_data, auth=auth)
     if response.status_code != 200:
         print(f"Error, response status code was {response.status_code}")
         return False, None
@@ -103,6 +156,15 @@ def enroll_find(args):
         return False, None
     return True, jr
 
+def enroll_find(args):
+    try:
+        ekpubhashes = list(iter_find(args.api, args.hostname_suffix, args.page_size))
+    except PagingError as e:
+        print(f"Error, {e}")
+        return False, None
+    return True, { 'hostname_suffix': args.hostname_suffix,
+                   'ekpubhashes': ekpubhashes }
+
 def enroll_getAssetSigner(args):
     response = requests.get(args.api + '/v1/get-asset-signer', auth=auth)
     if response.status_code != 200:
@@ -154,6 +216,24 @@ if __name__ == '__main__':
     parser_a.add_argument('hostname', help=add_help_hostname)
     parser_a.set_defaults(func=enroll_add)
 
+    add_batch_help = 'Enroll many {TPM,hostname} 2-tuples at once'
+    add_batch_epilog = """
+    The 'add-batch' subcommand invokes the '/v1/add-batch' handler of the
+    Enrollment Service's management API, to enroll many TPM+hostname 2-tuples in
+    one go. Each line of the provided file has the path to an 'ekpub' file and the
+    hostname to enroll it with, separated by whitespace (blank lines and lines
+    starting with '#' are ignored). The enrollment assets are generated in
+    parallel and the enrollments are committed to the database together, which is
+    much quicker than calling 'add' for each. The response has a result per line,
+    in the same order, each being what 'add' would have returned (in particular, a
+    returncode of 2 means the TPM was already enrolled).
+    """
+    add_batch_help_file = 'path to a file of \'<ekpub> <hostname>\' lines'
+    parser_b = subparsers.add_parser('add-batch', help=add_batch_help,
+                                     epilog=add_batch_epilog)
+    parser_b.add_argument('batchfile', help=add_batch_help_file)
+    parser_b.set_defaults(func=enroll_add_batch)
+
     query_help = 'Query (and list) enrollments based on prefix-search of hash(EKpub)'
     query_epilog = """
     The 'query' subcommand invokes the '/v1/query' handler of the Enrollment
@@ -166,10 +246,14 @@ if __name__ == '__main__':
     entries (respectively) will be returned. To query a specific entry, the query
     parameter should contain enough of the ekpubhash to uniquely distinguish it from
     all others. (Usually, this is significantly fewer characters than the full
-    ekpubhash value.)
+    ekpubhash value.) The entries are fetched a page at a time (see
+    '--page-size'), all from the same version of the database.
     """
     query_help_ekpubhash = 'hexidecimal prefix (empty to return all enrollments)'
+    page_size_help = 'number of results to fetch per request (default: 1000)'
     parser_q = subparsers.add_parser('query', help=query_help, epilog=query_epilog)
+    parser_q.add_argument('--page-size', metavar='<N>', type=int, default=1000,
+                          help=page_size_help)
     parser_q.add_argument('ekpubhash', help=query_help_ekpubhash)
     parser_q.set_defaults(func=enroll_query)
 
@@ -205,6 +289,8 @@ if __name__ == '__main__':
     """
     find_help_suffix = 'hostname suffix (empty to return all enrollments)'
     parser_f = subparsers.add_parser('find', help=find_help, epilog=find_epilog)
+    parser_f.add_argument('--page-size', metavar='<N>', type=int, default=1000,
+                          help=page_size_help)
     parser_f.add_argument('hostname_suffix', help=find_help_suffix)
     parser_f.set_defaults(func=enroll_find)
 
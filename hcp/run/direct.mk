@@ -83,17 +83,43 @@ HCP_RUN_ENROLL_REALM ?= REALM.EXAMPLE.XYZ
 #HCP_RUN_ENROLL_UWSGI_PORT ?= 5000
 #HCP_RUN_ENROLL_UWSGI_FLAGS ?= --http :5000 --stats :5001
 #HCP_RUN_ENROLL_UWSGI_OPTIONS ?= --processes 2 --threads 2
+#HCP_RUN_ENROLL_BATCH_JOBS ?= $(shell nproc)
+#HCP_RUN_ENROLL_RECORD_FORMAT ?= dirs
+#HCP_RUN_ENROLL_SHARDS ?= 1
 #HCP_RUN_ENROLL_GITDAEMON ?= /usr/lib/git-core/git-daemon
 #HCP_RUN_ENROLL_GITDAEMON_FLAGS ?= --reuseaddr --verbose --listen=0.0.0.0 --port=9418
+#HCP_RUN_ENROLL_NOTIFY_PORT ?= 9419
 HCP_RUN_ENROLL_XTRA_MGMT ?= --publish=5000:5000 --publish=5001:5001
-HCP_RUN_ENROLL_XTRA_REPL ?= --publish=9418:9418
+HCP_RUN_ENROLL_XTRA_REPL ?= --publish=9418:9418 --publish=9419:9419
 
 HCP_RUN_ATTEST_REMOTE_REPO ?= git://enrollsvc_repl/enrolldb
+# Must match HCP_RUN_ENROLL_SHARDS. Shard <i> is fetched from
+# $(HCP_RUN_ATTEST_REMOTE_REPO)-<i>.
+#HCP_RUN_ATTEST_SHARDS ?= 1
 HCP_RUN_ATTEST_UPDATE_TIMER ?= 10
+# Replicas wait for the enrollment service's change notification, rather than
+# polling every HCP_RUN_ATTEST_UPDATE_TIMER seconds, unless this is empty (or
+# it can't be reached).
+HCP_RUN_ATTEST_NOTIFY_URL ?= http://enrollsvc_repl:9419
+# Replicas keep clones of the enrollment DB ("git"), or a key-value store of
+# it ("kv"), kept up to date from the change feed at HCP_RUN_ATTEST_NOTIFY_URL.
+#HCP_RUN_ATTEST_STORE ?= git
+# Replicas may partition the (sharded) enrollment DB between them, each with
+# only some of its shards, in which case this is all of them, as
+# "<name>=<attestation URL>,...", and the name of this one.
+#HCP_RUN_ATTEST_PEERS ?=
+#HCP_RUN_ATTEST_PEER_NAME ?=
+#HCP_RUN_ATTEST_PARTITION_MODE ?= proxy
 #HCP_RUN_ATTEST_UWSGI ?= uwsgi_python3
 #HCP_RUN_ATTEST_UWSGI_PORT ?= 8080
 #HCP_RUN_ATTEST_UWSGI_FLAGS ?= --http :8080 --stats :8081
 #HCP_RUN_ATTEST_UWSGI_OPTIONS ?= --processes 2 --threads 2
+#HCP_RUN_ATTEST_ENGINE ?= subprocess
+#HCP_RUN_ATTEST_SERVER ?= uwsgi
+#HCP_RUN_ATTEST_ASGI ?= uvicorn
+#HCP_RUN_ATTEST_ASYNC_WORKERS ?= 4
+#HCP_RUN_ATTEST_ASYNC_QUEUE ?= 64
+#HCP_RUN_ATTEST_ASYNC_RETRY_AFTER ?= 5
 #HCP_RUN_ATTEST_XTRA_REPL ?=
 HCP_RUN_ATTEST_XTRA_HCP ?= --publish=8080:8080 --publish=8081:8081
 
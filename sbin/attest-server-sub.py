@@ -1,7 +1,8 @@
 """
 Quote and Eventlog validating Attestation Server.
 
-This is a python flask server implementing a single API end-point. This is launched
+This is a python flask server implementing a single API end-point (plus a batch
+variant of it, for hosts that attest many TPMs at once). This is launched
 (for compatibility's sake) from sbin/attest-server. See the comments there for more
 explanation about the functionality.
 """
@@ -13,41 +14,133 @@ from stat import *
 from markupsafe import escape
 from werkzeug.utils import secure_filename
 import tempfile
+import io
+import tarfile
 import logging
 import yaml
 import hashlib
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+# the in-process verification modules live alongside this file in sbin/
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import attest_policy
+import attest_metrics
+import attest_partition
 
 # hard code the hashing algorithm used
 alg = 'sha256'
 
+# Which quote verification engine to use (see sbin/attest-server);
+#   "subprocess" - fork "tpm2-attest verify" (the default),
+#   "native"     - verify in-process with attest_quote.py,
+#   "compare"    - run both, log any differences, and use the subprocess result.
+engine = os.environ.get('SAFEBOOT_ATTEST_ENGINE') or 'subprocess'
+if engine != 'subprocess':
+	import attest_quote
+	import attest_ekstore
+	import attest_seal
+	# load the EK CA certificates once, up front, rather than on the
+	# first request
+	attest_ekstore.default_store()
+
+# The largest quote tarball that is accepted, in bytes. With the "native"
+# engine, requests are handled entirely in memory; the upload is parsed
+# straight from the request body and the sealed reply is returned as bytes.
+max_quote_size = int(os.environ.get('SAFEBOOT_QUOTE_MAX_SIZE') or 4194304)
+in_memory = engine == 'native'
+
+# The bounds on a batch request (see attest_batch()), and the number of its
+# items that are attested at once.
+batch_max_items = int(os.environ.get('SAFEBOOT_BATCH_MAX_ITEMS') or 256)
+batch_max_size = int(os.environ.get('SAFEBOOT_BATCH_MAX_SIZE') or 67108864)
+batch_workers = int(os.environ.get('SAFEBOOT_BATCH_WORKERS') or os.cpu_count() or 2)
+batch_executor = ThreadPoolExecutor(max_workers=batch_workers, thread_name_prefix="batch")
+
+# The quote fields that attest_verify() depends on, and so the ones that the
+# "compare" engine diffs.
+compared = [ 'ekhash', 'pcrs', 'eventlog-pcrs' ]
+
+def quote_verify_subprocess(quote_file):
+	with attest_metrics.stage('subprocess_verify'):
+		sub = subprocess.run(["./sbin/tpm2-attest", "verify", quote_file ],
+			stdout=subprocess.PIPE,
+			stderr=sys.stderr,
+		)
+	quote = yaml.safe_load(sub.stdout)
+	if quote is None:
+		quote = {}
+	return sub.returncode == 0, quote
+
+# Returns a 2-tuple of (valid, quote), where quote is the dict that
+# "tpm2-attest verify" would have output as YAML.
+def quote_verify(quote_file):
+	if engine == 'native':
+		return attest_quote.verify(quote_file)
+	quote_valid, quote = quote_verify_subprocess(quote_file)
+	if engine == 'compare':
+		# (its stages would count the verification twice)
+		with attest_metrics.untimed():
+			native_valid, native = attest_quote.verify(quote_file)
+		if native_valid != quote_valid:
+			logging.warning(f"compare: {quote_valid=} but {native_valid=}")
+		for k in compared:
+			if native.get(k) != quote.get(k):
+				logging.warning(f"compare: '{k}' differs: {quote.get(k)} != {native.get(k)}")
+	return quote_valid, quote
+
+# Returns the sealed response tarball, or None if sealing failed. The native
+# engine seals in-process (attest_seal.py), so the secret key never touches
+# disk; otherwise "tpm2-attest seal" is run.
+def seal(quote_file, response):
+	with attest_metrics.stage('seal'):
+		return seal_stage(quote_file, response)
+
+def seal_stage(quote_file, response):
+	if engine == 'native':
+		try:
+			return attest_seal.seal(quote_file, response)
+		except (attest_quote.QuoteError, tarfile.TarError, ValueError) as e:
+			logging.warning(f"seal: {e}")
+			return None
+	result = subprocess.run(["./sbin/tpm2-attest", "seal", quote_file, ],
+		input=response,
+		capture_output=True
+	)
+	if result.returncode != 0:
+		return None
+	return result.stdout
+
 # This subroutine is the meat in the sandwich. Its only argument is a path to
 # the input tarball (the "quotefile") that was received from the attesting
-# host/client, and it returns a 2-tuple of status code and response tarball (as
-# a byte array, not a path) for returning to the host/client. This function is
-# called by the flask-handling code further down, which extracts the input
-# tarball from the http request and returns the output tarball in the http
-# response.
+# host/client (or the tarball itself, as bytes, in the in-memory mode), and it
+# returns a 2-tuple of status code and response tarball (as a byte array, not a
+# path) for returning to the host/client. This function is called by the
+# flask-handling code further down, which extracts the input tarball from the
+# http request and returns the output tarball in the http response.
 
 def attest_verify(quote_file):
+	label = quote_file if isinstance(quote_file, str) else "quote"
+	with attest_metrics.request(label):
+		return attest_stages(quote_file)
+
+def attest_stages(quote_file):
 	# verify that the Endorsment Key came from an authorized TPM,
 	# that the quote is signed by a valid Attestation Key
-	sub = subprocess.run(["./sbin/tpm2-attest", "verify", quote_file ],
-		stdout=subprocess.PIPE,
-		stderr=sys.stderr,
-	)
+	quote_valid, quote = quote_verify(quote_file)
 
-	quote_valid = sub.returncode == 0
-
-	# The output contains YAML formatted hash of the EK and the PCRs
-	quote = yaml.safe_load(sub.stdout)
+	# The output contains the hash of the EK and the PCRs
 	if 'ekhash' in quote:
 		ekhash = quote['ekhash']
 	else:
 		quote_valid = False
 		ekhash = "UNKNOWN"
-
-	with open("/tmp/quote.yaml", "w") as y:
-		y.write(str(quote))
+	attest_metrics.set_label(f"{ekhash=}")
+	if 'pcrs' not in quote:
+		logging.warning(f"{ekhash=}: quote verification failed")
+		attest_metrics.outcome('quote_verify_failed')
+		return (403, "QUOTE_VERIFY FAILED")
 
 	# Validate that the every computed PCR in the eventlog
 	# matches a quoted PCRs.
@@ -57,12 +150,21 @@ def attest_verify(quote_file):
 	# of the verifier to check.
 	if alg not in quote['pcrs']:
 		logging.warning(f"{ekhash=}: quote does not have hash {alg}")
-	quote_pcrs = quote['pcrs'][alg]
 
-	# XXX We need a way to configure whether the eventlog is optional
-	if quote['eventlog-pcrs'] != None:
-		eventlog_pcrs = quote['eventlog-pcrs'][alg]
+	# The native engine also provides the PCRs as bytes, which can be
+	# compared directly; the subprocess engine only has the ints that
+	# yaml.safe_load() parsed from the "tpm2-attest verify" output.
+	quote_digests = quote.pop('pcr-digests', None)
+	eventlog_digests = quote.pop('eventlog-digests', None)
+	if quote_digests is not None:
+		quote_pcrs = quote_digests.get(alg, {})
+		eventlog_pcrs = eventlog_digests.get(alg, {}) if eventlog_digests is not None else None
+	else:
+		quote_pcrs = quote['pcrs'].get(alg, {})
+		eventlog_pcrs = quote['eventlog-pcrs'][alg] if quote['eventlog-pcrs'] != None else None
 
+	# XXX We need a way to configure whether the eventlog is optional
+	if eventlog_pcrs != None:
 		for pcr_index in eventlog_pcrs:
 			eventlog_pcr = eventlog_pcrs[pcr_index]
 
@@ -82,42 +184,170 @@ def attest_verify(quote_file):
 	# the quote, eventlog and PCRS are consistent, so ask the verifier to
 	# process the eventlog and decide if the eventlog meets policy for
 	# this ekhash.
-	sub = subprocess.run(["./sbin/attest-verify", "verify", str(quote_valid)],
-		input=bytes(str(quote), encoding="utf-8"),
-		stdout=subprocess.PIPE,
-		stderr=sys.stderr,
-	)
-
-	if sub.returncode != 0:
+	decision = attest_policy.verify(quote, quote_valid)
+	if not decision.allowed:
+		attest_metrics.outcome(decision.reason.lower().replace(' ', '_'))
 		return (403, "ATTEST_VERIFY FAILED")
 
-	# read the (binary) response from the sub process stdout
-	response = sub.stdout
-
-	result = subprocess.run(["./sbin/tpm2-attest", "seal", quote_file, ],
-		input=response,
-		capture_output=True
-	)
+	# the (binary) enrollment tarball to be sealed
+	response = decision.payload
 
-	if result.returncode != 0:
+	sealed = seal(quote_file, response)
+	if sealed is None:
+		attest_metrics.outcome('seal_failed')
 		return (403, "ATTEST_SEAL FAILED")
 
-	return (200, result.stdout)
+	attest_metrics.outcome('ok')
+	return (200, sealed)
+
+# If the database is partitioned (see attest_partition.py), the enrollment of
+# the quote may be on another replica, and the request is then passed on to it,
+# unless it was passed on to this one. Returns the URL of that replica, or None
+# if the quote is attested here.
+def partition_route(quote_file, forwarded):
+	if forwarded:
+		return None
+	return attest_partition.route(quote_file)
+
+# Passes the quote on to the replica at 'url'. Returns a 3-tuple of its
+# status, body and content type.
+def forward(url, quote_file):
+	with attest_metrics.request(url):
+		with attest_metrics.stage('forward'):
+			result = attest_partition.forward(url, quote_file)
+		attest_metrics.outcome('forwarded')
+	return result
+
+# Like attest_verify(), for a quote that another replica attests. (It replies
+# to a failed attestation with a JSON error, rather than the sealed reply.)
+def forward_verify(url, quote_file):
+	rcode, rbody, content_type = forward(url, quote_file)
+	if rcode == 200 and content_type.startswith('application/json'):
+		return (403, "ATTEST FAILED AT " + url)
+	if rcode != 200:
+		return (rcode, "ATTEST FORWARD FAILED")
+	return (200, rbody)
+
+class BatchTooLarge(Exception):
+	pass
+
+# Returns the list of (name, quote tarball) items in a batch request, given the
+# uploaded (field, filename, contents) files. Each file is a quote, except for
+# those in a "batch" field, which are (uncompressed) tarballs of quote
+# tarballs. Raises BatchTooLarge as soon as there are more than batch_max_items
+# items, or they add up to more than batch_max_size bytes, so that the tarballs
+# are not read any further than that.
+def batch_items(uploads):
+	items = []
+	total = 0
+	def add(name, size, read):
+		nonlocal total
+		total += size
+		if len(items) >= batch_max_items or total > batch_max_size:
+			raise BatchTooLarge()
+		items.append((name, read()))
+	for field, name, data in uploads:
+		if field != 'batch':
+			add(name or field, len(data), lambda: data)
+			continue
+		with tarfile.open(fileobj=io.BytesIO(data), mode='r:') as tar:
+			for member in tar:
+				if member.isfile():
+					add(member.name, member.size,
+					    lambda: tar.extractfile(member).read())
+	return items
+
+# Attests every item of a batch, concurrently, and returns a tarball of the
+# results. "results.json" has an entry for each item, in order, with its name
+# and status code, and either the name of the file in the tarball that holds
+# its sealed reply, or the error. (An item whose enrollment is on another
+# replica is passed on to it by itself, whatever the partitioning mode.)
+def attest_batch(items, forwarded=False):
+	with tempfile.TemporaryDirectory() as tmp:
+		s = os.stat(tmp)
+		os.chmod(tmp, s.st_mode | S_IROTH | S_IXOTH)
+
+		def attest_item(index, quote):
+			owner = partition_route(quote, forwarded)
+			if owner is not None:
+				return forward_verify(owner, quote)
+			if in_memory:
+				return attest_verify(quote)
+			p = os.path.join(tmp, "%d.tar" % (index))
+			with open(p, "wb") as f:
+				f.write(quote)
+			return attest_verify(p)
+
+		futures = [ batch_executor.submit(attest_item, i, quote)
+			    for i, (name, quote) in enumerate(items) ]
+		results = []
+		sealed = []
+		for i, ((name, quote), future) in enumerate(zip(items, futures)):
+			try:
+				rcode, rbody = future.result()
+			except Exception as e:
+				logging.warning(f"batch: {name}: {e}")
+				rcode, rbody = (500, "INTERNAL ERROR")
+			if rcode == 200:
+				results.append({ "name": name, "status": rcode, "file": "%d.tar" % (i) })
+				sealed.append(("%d.tar" % (i), rbody))
+			else:
+				results.append({ "name": name, "status": rcode, "error": rbody })
+
+	buf = io.BytesIO()
+	with tarfile.open(fileobj=buf, mode='w', format=tarfile.GNU_FORMAT) as tar:
+		for name, data in [("results.json", json.dumps(results).encode())] + sealed:
+			info = tarfile.TarInfo(name)
+			info.size = len(data)
+			info.mode = 0o644
+			tar.addfile(info, io.BytesIO(data))
+	return buf.getvalue()
 
 # The flask details;
 
+# In the in-memory mode, uploads are kept in memory regardless of their size
+# (werkzeug would otherwise spool anything over 500KB to a temporary file),
+# which is safe because of the MAX_CONTENT_LENGTH bound.
+class InMemoryRequest(flask.Request):
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        return io.BytesIO()
+
 app = flask.Flask(__name__)
 app.config["DEBUG"] = True
+if in_memory:
+    app.request_class = InMemoryRequest
+    app.config["MAX_CONTENT_LENGTH"] = max(max_quote_size, batch_max_size)
 
 @app.route('/', methods=['GET'])
 def home_get():
     return { "error": "GET request, but this service only supports POST" }
 
+# Replies to a request whose quote another replica attests
+def forward_response(url, quote_file):
+    if attest_partition.mode == 'redirect':
+        return flask.redirect(url + '/', code=307)
+    rcode, rbody, content_type = forward(url, quote_file)
+    return flask.Response(rbody, status=rcode, content_type=content_type)
+
 @app.route('/', methods=['POST'])
 def home_post():
     if 'quote' not in request.files:
         abort(500)
     f = request.files['quote']
+    forwarded = request.headers.get(attest_partition.FORWARDED_HEADER)
+    if in_memory:
+        # Read the quote straight from the request, and reply from memory
+        quote = f.stream.read(max_quote_size + 1)
+        if len(quote) > max_quote_size:
+            abort(413)
+        owner = partition_route(quote, forwarded)
+        if owner is not None:
+            return forward_response(owner, quote)
+        rcode, rbody = attest_verify(quote)
+        if (rcode != 200):
+            return { "error": "attestation failed" }
+        return flask.Response(rbody, mimetype="application/octet-stream")
     # Create a temporary directory for the quote file, and make it world
     # readable+executable. (This gets garbage collected after we're done, as do
     # any files we put in there.) We may priv-sep the python API from the
@@ -131,6 +361,9 @@ def home_post():
     # path, and save the quote file.
     p = os.path.join(tf.name, secure_filename(f.filename))
     f.save(p)
+    owner = partition_route(p, forwarded)
+    if owner is not None:
+        return forward_response(owner, p)
     # Pass the saved quote file (by path) to the attestation code
     rcode, rbody = attest_verify(p)
     if (rcode != 200):
@@ -142,5 +375,31 @@ def home_post():
     os.close(ofd)
     return send_file(p)
 
+@app.route('/metrics', methods=['GET'])
+def metrics_get():
+    return flask.Response(attest_metrics.render(),
+        mimetype="text/plain; version=0.0.4")
+
+@app.route('/batch', methods=['POST'])
+def batch_post():
+    uploads = []
+    total = 0
+    for name, f in request.files.items(multi=True):
+        data = f.stream.read(batch_max_size + 1 - total)
+        total += len(data)
+        if total > batch_max_size:
+            abort(413)
+        uploads.append((name, f.filename, data))
+    try:
+        items = batch_items(uploads)
+    except tarfile.TarError:
+        return { "error": "malformed batch" }
+    except BatchTooLarge:
+        abort(413)
+    if len(items) == 0:
+        abort(500)
+    forwarded = request.headers.get(attest_partition.FORWARDED_HEADER)
+    return flask.Response(attest_batch(items, forwarded), mimetype="application/x-tar")
+
 if __name__ == "__main__":
     app.run()
@@ -0,0 +1,199 @@
+"""
+Asynchronous (ASGI) serving mode for the attestation server.
+
+This serves the same API as the flask app in attest-server-sub.py, and uses
+the same attest_verify(), but from an asyncio event loop. The verify, policy
+and seal stages run in a bounded thread pool, and requests beyond what the pool
+and its queue can hold are refused straight away with a 503 and a Retry-After
+header, rather than piling up in the listen queue until the clients time out.
+The /batch end-point is served in the same way. It is launched by
+sbin/attest-server when SAFEBOOT_ATTEST_SERVER=asgi, with any ASGI server
+(uvicorn by default).
+
+Environment variable controls;
+SAFEBOOT_ASYNC_WORKERS
+   The number of attestations in flight at once (default 4).
+SAFEBOOT_ASYNC_QUEUE
+   The number of attestations that may wait for a worker (default 64).
+SAFEBOOT_ASYNC_RETRY_AFTER
+   Seconds for the Retry-After header of a 503 (default 5).
+"""
+import io
+import os
+import json
+import stat
+import asyncio
+import logging
+import tarfile
+import tempfile
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.formparser import parse_form_data
+
+# attest-server-sub.py can't be imported by name
+spec = importlib.util.spec_from_file_location("attest_server_sub",
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), "attest-server-sub.py"))
+sub = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(sub)
+
+import attest_metrics
+
+workers = int(os.environ.get('SAFEBOOT_ASYNC_WORKERS') or 4)
+queue_depth = int(os.environ.get('SAFEBOOT_ASYNC_QUEUE') or 64)
+retry_after = int(os.environ.get('SAFEBOOT_ASYNC_RETRY_AFTER') or 5)
+
+executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="attest")
+
+# Requests that have been admitted, whether running or waiting for a worker.
+# Only touched from the event loop, so no lock is needed.
+pending = 0
+
+# Runs in the executor. With the "native" engine the quote is verified from
+# memory, otherwise it is written to a temporary directory like home_post()
+# in attest-server-sub.py does.
+def attest(quote):
+	if sub.in_memory:
+		return sub.attest_verify(quote)
+	with tempfile.TemporaryDirectory() as tmp:
+		s = os.stat(tmp)
+		os.chmod(tmp, s.st_mode | stat.S_IROTH | stat.S_IXOTH)
+		p = os.path.join(tmp, 'quote.tar')
+		with open(p, 'wb') as f:
+			f.write(quote)
+		return sub.attest_verify(p)
+
+async def send_response(send, status, body, content_type, headers=[]):
+	await send({
+		'type': 'http.response.start',
+		'status': status,
+		'headers': [
+			(b'content-type', content_type),
+			(b'content-length', str(len(body)).encode()),
+		] + headers,
+	})
+	await send({ 'type': 'http.response.body', 'body': body })
+
+async def send_json(send, status, value, headers=[]):
+	await send_response(send, status, json.dumps(value).encode(),
+		b'application/json', headers)
+
+# Returns the request body, or None if it is larger than 'limit'
+async def read_body(receive, limit):
+	body = bytearray()
+	while True:
+		message = await receive()
+		if message['type'] == 'http.disconnect':
+			return None
+		body += message.get('body', b'')
+		if len(body) > limit:
+			return None
+		if not message.get('more_body', False):
+			return bytes(body)
+
+# The files in a multipart/form-data body
+def form_files(body, content_type):
+	environ = {
+		'REQUEST_METHOD': 'POST',
+		'CONTENT_TYPE': content_type,
+		'CONTENT_LENGTH': str(len(body)),
+		'wsgi.input': io.BytesIO(body),
+	}
+	_, _, files = parse_form_data(environ,
+		stream_factory=lambda *args, **kwargs: io.BytesIO())
+	return files
+
+# Runs in the executor, like attest()
+def attest_batch(uploads, forwarded):
+	try:
+		items = sub.batch_items(uploads)
+	except sub.BatchTooLarge:
+		return None
+	if len(items) == 0:
+		return None
+	return sub.attest_batch(items, forwarded)
+
+async def app(scope, receive, send):
+	global pending
+
+	if scope['type'] == 'lifespan':
+		while True:
+			message = await receive()
+			if message['type'] == 'lifespan.startup':
+				await send({ 'type': 'lifespan.startup.complete' })
+			elif message['type'] == 'lifespan.shutdown':
+				executor.shutdown(wait=False)
+				await send({ 'type': 'lifespan.shutdown.complete' })
+				return
+	if scope['type'] != 'http':
+		return
+
+	if scope['path'] == '/metrics' and scope['method'] == 'GET':
+		return await send_response(send, 200, attest_metrics.render().encode(),
+			b'text/plain; version=0.0.4')
+	if scope['path'] not in ('/', '/batch'):
+		return await send_json(send, 404, { "error": "not found" })
+	if scope['method'] == 'GET' and scope['path'] == '/':
+		return await send_json(send, 200,
+			{ "error": "GET request, but this service only supports POST" })
+	if scope['method'] != 'POST':
+		return await send_json(send, 405, { "error": "method not allowed" })
+
+	# shed load before reading the body, so that a burst costs as little
+	# as possible
+	if pending >= workers + queue_depth:
+		logging.warning(f"{pending} attestations pending, refusing request")
+		return await send_json(send, 503, { "error": "server busy" },
+			[ (b'retry-after', str(retry_after).encode()) ])
+
+	pending += 1
+	try:
+		batch = scope['path'] == '/batch'
+		body = await read_body(receive,
+			sub.batch_max_size if batch else sub.max_quote_size)
+		if body is None:
+			return await send_json(send, 413, { "error": "quote too large" })
+		headers = dict(scope['headers'])
+		content_type = headers.get(b'content-type', b'').decode('latin-1')
+		forwarded = headers.get(sub.attest_partition.FORWARDED_HEADER.lower().encode())
+		loop = asyncio.get_running_loop()
+		# parsing the body, and finding the replica that has the quote's
+		# enrollment, read the whole quote, so they are done off the
+		# event loop, in the default executor
+		files = await loop.run_in_executor(None, form_files, body, content_type)
+
+		# a batch takes up only one worker, as its items are attested
+		# by the batch executor in attest-server-sub.py
+		if batch:
+			uploads = [ (field, f.filename, f.stream.getvalue())
+				    for field, f in files.items(multi=True) ]
+			try:
+				rbody = await loop.run_in_executor(executor, attest_batch,
+					uploads, forwarded)
+			except tarfile.TarError:
+				return await send_json(send, 200, { "error": "malformed batch" })
+			if rbody is None:
+				return await send_json(send, 413, { "error": "bad batch size" })
+			return await send_response(send, 200, rbody, b'application/x-tar')
+
+		if 'quote' not in files:
+			return await send_json(send, 500, { "error": "no quote" })
+		quote = files['quote'].stream.getvalue()
+
+		# (see attest-server-sub.py) passing the quote on takes up a
+		# thread of the default executor, rather than a worker
+		owner = await loop.run_in_executor(None, sub.partition_route, quote, forwarded)
+		if owner is not None and sub.attest_partition.mode == 'redirect':
+			return await send_response(send, 307, b'', b'text/plain',
+				[ (b'location', (owner + '/').encode()) ])
+		if owner is not None:
+			rcode, rbody, content_type = await loop.run_in_executor(None,
+				sub.forward, owner, quote)
+			return await send_response(send, rcode, rbody, content_type.encode())
+
+		rcode, rbody = await loop.run_in_executor(executor, attest, quote)
+		if rcode != 200:
+			return await send_json(send, 200, { "error": "attestation failed" })
+		await send_response(send, 200, rbody, b'application/octet-stream')
+	finally:
+		pending -= 1
@@ -0,0 +1,299 @@
+"""
+In-memory EK certificate trust store, for use by the attestation server.
+
+This is a native python equivalent of 'tpm2-attest ek-verify'. Rather than
+running 'openssl verify -CApath' against the vendor certificates for every
+attestation, the certificates are loaded once into a store that is indexed by
+subject key identifier and by subject name, and the outcome of each chain
+verification is cached (keyed by the sha256 of ek.crt) in a bounded LRU with a
+TTL. The store reloads itself when the certificate directory, or any of the
+certificates in it, changes; that is checked at most every
+SAFEBOOT_EK_RELOAD_INTERVAL seconds, by one thread at a time, while the others
+keep using the tables already loaded.
+
+Environment variable controls;
+SAFEBOOT_EK_CACHE_SIZE
+   Maximum number of ek.crt verification results to remember (default 4096).
+SAFEBOOT_EK_CACHE_TTL
+   Seconds for which a verification result is reused (default 3600).
+SAFEBOOT_EK_RELOAD_INTERVAL
+   Seconds between checks for changes to the certificates (default 10).
+"""
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec, rsa, padding
+
+import attest_quote
+from attest_quote import QuoteError
+
+# Same defaults as sbin/tpm2-attest
+EK_TYPE = 'fixedtpm|fixedparent|sensitivedataorigin|adminwithpolicy|restricted|decrypt'
+CERT = os.environ.get('CERT', os.environ.get('PREFIX', '') + os.environ.get('DIR', '/etc/safeboot') + '/cert.pem')
+
+cache_size = int(os.environ.get('SAFEBOOT_EK_CACHE_SIZE') or 4096)
+cache_ttl = int(os.environ.get('SAFEBOOT_EK_CACHE_TTL') or 3600)
+reload_interval = int(os.environ.get('SAFEBOOT_EK_RELOAD_INTERVAL') or 10)
+
+# The bound on chain length, to stop a badly formed store from looping
+MAX_DEPTH = 8
+
+# TPM EK certificates read from NVRAM are often padded after the DER encoding,
+# which 'openssl x509 -inform DER' ignores. Trim to the outer SEQUENCE.
+def der_trim(data):
+	if len(data) < 2 or data[0] != 0x30:
+		return data
+	n = data[1]
+	if n < 0x80:
+		return data[:2 + n]
+	nbytes = n & 0x7f
+	return data[:2 + nbytes + int.from_bytes(data[2:2 + nbytes], 'big')]
+
+def load_certs(path):
+	with open(path, 'rb') as f:
+		data = f.read()
+	if b'-----BEGIN CERTIFICATE-----' in data:
+		certs = []
+		for block in data.split(b'-----END CERTIFICATE-----')[:-1]:
+			certs.append(x509.load_pem_x509_certificate(block + b'-----END CERTIFICATE-----\n'))
+		return certs
+	return [x509.load_der_x509_certificate(der_trim(data))]
+
+def not_before(cert):
+	return getattr(cert, 'not_valid_before_utc', None) or cert.not_valid_before
+
+def not_after(cert):
+	return getattr(cert, 'not_valid_after_utc', None) or cert.not_valid_after
+
+def valid_now(cert):
+	now = time.time()
+	return not_before(cert).timestamp() <= now <= not_after(cert).timestamp()
+
+def ski(cert):
+	try:
+		return cert.extensions.get_extension_for_class(x509.SubjectKeyIdentifier).value.digest
+	except x509.ExtensionNotFound:
+		return None
+
+def aki(cert):
+	try:
+		return cert.extensions.get_extension_for_class(x509.AuthorityKeyIdentifier).value.key_identifier
+	except x509.ExtensionNotFound:
+		return None
+
+def is_ca(cert):
+	try:
+		return cert.extensions.get_extension_for_class(x509.BasicConstraints).value.ca
+	except x509.ExtensionNotFound:
+		# v1 roots have no extensions at all
+		return True
+
+def signed_by(cert, issuer):
+	if cert.issuer != issuer.subject:
+		return False
+	key = issuer.public_key()
+	try:
+		if isinstance(key, rsa.RSAPublicKey):
+			params = cert.signature_algorithm_parameters
+			if not isinstance(params, padding.PSS):
+				params = padding.PKCS1v15()
+			key.verify(cert.signature, cert.tbs_certificate_bytes,
+				   params, cert.signature_hash_algorithm)
+		elif isinstance(key, ec.EllipticCurvePublicKey):
+			key.verify(cert.signature, cert.tbs_certificate_bytes,
+				   ec.ECDSA(cert.signature_hash_algorithm))
+		else:
+			return False
+	except (InvalidSignature, ValueError, TypeError):
+		return False
+	return True
+
+def self_signed(cert):
+	return cert.issuer == cert.subject and signed_by(cert, cert)
+
+class EKStore:
+	def __init__(self, ca_path=attest_quote.CA_PATH, cert=CERT,
+		     size=cache_size, ttl=cache_ttl, interval=reload_interval):
+		self.ca_path = ca_path
+		self.cert = cert
+		self.size = size
+		self.ttl = ttl
+		self.interval = interval
+		self.lock = threading.Lock()
+		self.reload_lock = threading.Lock()
+		self.stamp = None
+		self.load()
+		self.next_check = time.monotonic() + interval
+
+	# Used to notice changes to the certificate directory (refresh-certs
+	# and c_rehash both add/rename files, which updates its mtime), to the
+	# certificates in it (which may be replaced in place), or to the
+	# safeboot cert.
+	def current_stamp(self):
+		def mtime(p):
+			try:
+				return os.stat(p).st_mtime_ns
+			except OSError:
+				return None
+		stamp = [ mtime(self.ca_path), mtime(self.cert) ]
+		try:
+			names = sorted(os.listdir(self.ca_path))
+		except OSError:
+			names = []
+		for name in names:
+			stamp.append((name, mtime(os.path.join(self.ca_path, name))))
+		return tuple(stamp)
+
+	def load(self):
+		stamp = self.current_stamp()
+		by_ski = {}
+		by_subject = {}
+		roots = []
+		n = 0
+		if os.path.isdir(self.ca_path):
+			for name in sorted(os.listdir(self.ca_path)):
+				p = os.path.join(self.ca_path, name)
+				# skip the c_rehash symlinks, they duplicate the pem files
+				if os.path.islink(p) or not os.path.isfile(p):
+					continue
+				try:
+					certs = load_certs(p)
+				except (ValueError, OSError) as e:
+					logging.warning(f"{p}: unable to load: {e}")
+					continue
+				for c in certs:
+					n += 1
+					k = ski(c)
+					if k is not None:
+						by_ski.setdefault(k, []).append(c)
+					by_subject.setdefault(c.subject, []).append(c)
+					if self_signed(c):
+						roots.append(c)
+		# Like 'openssl verify -CAfile roots.pem -CApath certs' (with the
+		# directory c_rehash'ed, as refresh-certs does), any self-signed
+		# certificate in roots.pem or in the directory is trusted.
+		safeboot = []
+		if os.path.isfile(self.cert):
+			try:
+				safeboot = load_certs(self.cert)
+			except (ValueError, OSError) as e:
+				logging.warning(f"{self.cert}: unable to load: {e}")
+		with self.lock:
+			self.by_ski = by_ski
+			self.by_subject = by_subject
+			self.roots = set(c.fingerprint(hashes.SHA256()) for c in roots)
+			self.safeboot = safeboot
+			self.cache = OrderedDict()
+			self.stamp = stamp
+		logging.info(f"{self.ca_path}: loaded {n} certificates, {len(roots)} roots")
+
+	# If another thread is already checking (or reloading), don't wait for
+	# it, the current tables are used until it is done.
+	def reload_if_changed(self):
+		now = time.monotonic()
+		if now < self.next_check or not self.reload_lock.acquire(blocking=False):
+			return
+		try:
+			self.next_check = now + self.interval
+			if self.current_stamp() != self.stamp:
+				self.load()
+		finally:
+			self.reload_lock.release()
+
+	def issuers(self, cert):
+		k = aki(cert)
+		if k is not None and k in self.by_ski:
+			return self.by_ski[k]
+		return self.by_subject.get(cert.issuer, [])
+
+	def is_root(self, cert):
+		return cert.fingerprint(hashes.SHA256()) in self.roots
+
+	# Depth-first search for a chain of valid signatures that ends at a
+	# trusted root.
+	def chain(self, cert, depth=0):
+		if depth > MAX_DEPTH or not valid_now(cert):
+			return None
+		if self.is_root(cert):
+			return [cert]
+		for issuer in self.issuers(cert):
+			if issuer is cert or not is_ca(issuer) or not signed_by(cert, issuer):
+				continue
+			rest = self.chain(issuer, depth + 1)
+			if rest is not None:
+				return [cert] + rest
+		return None
+
+	def verify_cert(self, ek_crt):
+		ek_crt = der_trim(ek_crt)
+		key = hashlib.sha256(ek_crt).digest()
+		now = time.monotonic()
+		self.reload_if_changed()
+		with self.lock:
+			hit = self.cache.get(key)
+			if hit is not None and now - hit[0] < self.ttl:
+				self.cache.move_to_end(key)
+				return hit[1]
+		result = self.verify_uncached(ek_crt)
+		with self.lock:
+			self.cache[key] = (now, result)
+			self.cache.move_to_end(key)
+			while len(self.cache) > self.size:
+				self.cache.popitem(last=False)
+		return result
+
+	# Returns a 2-tuple of (cert, error), where cert is the parsed EK
+	# certificate if and only if it chains to a trusted root.
+	def verify_uncached(self, ek_crt):
+		try:
+			cert = x509.load_der_x509_certificate(ek_crt)
+		except ValueError as e:
+			return None, f"ek.crt: unable to parse: {e}"
+		# check to see if the EK was signed with the safeboot key, which
+		# happens if this the TPM did not include its own OEM cert
+		for c in self.safeboot:
+			if valid_now(cert) and signed_by(cert, c):
+				logging.info("ek.crt certificate validated with safeboot cert")
+				return cert, None
+		if self.chain(cert) is not None:
+			logging.info("ek.crt certificate validated with SSL cert")
+			return cert, None
+		return None, "ek.crt: SSL verification failure"
+
+	# The equivalent of 'tpm2-attest ek-verify': the certificate must chain
+	# to a trusted root, ek.pub must have the EK attributes, and the two
+	# must hold the same RSA key.
+	def ek_verify(self, files):
+		cert, err = self.verify_cert(files['ek.crt'])
+		if cert is None:
+			raise QuoteError(err)
+
+		# ek.pub is a TPM2B_PUBLIC, so skip the size
+		ek = attest_quote.parse_public(files['ek.pub'][2:])
+		if not attest_quote.tpma_check(ek['attributes'], EK_TYPE):
+			raise QuoteError("ek.pub: unexpected EK key parameters")
+
+		key = cert.public_key()
+		if ek['type'] != attest_quote.TPM_ALG_RSA or not isinstance(key, rsa.RSAPublicKey):
+			raise QuoteError("ek.crt and ek.pub have different key types")
+		if int.from_bytes(ek['modulus'], 'big') != key.public_numbers().n:
+			raise QuoteError("ek.crt and ek.pub have different moduli")
+
+store = None
+store_lock = threading.Lock()
+
+# The process-wide store, loaded on first use (or ahead of time, by calling
+# this at startup).
+def default_store():
+	global store
+	with store_lock:
+		if store is None:
+			store = EKStore()
+	return store
@@ -0,0 +1,206 @@
+"""
+TCG event log parser and PCR replay, for use by the attestation server.
+
+This is a native python replacement for the 'tpm2 eventlog' step of
+'tpm2-attest verify'. It reads the binary_bios_measurements format (the
+crypto-agile TCG_PCR_EVENT2 format, or the older SHA1-only format), streams the
+events, and replays the extends into a fixed-size array of PCRs per bank. The
+replayed PCRs are returned as bytes, so they can be compared directly with the
+quoted ones.
+"""
+import sys
+import time
+import struct
+import hashlib
+import tarfile
+import subprocess
+import yaml
+
+# Same names as tpm2-tools, by TPM_ALG_ID
+hash_algs = {
+	0x0004: ('sha1', hashlib.sha1),
+	0x000b: ('sha256', hashlib.sha256),
+	0x000c: ('sha384', hashlib.sha384),
+	0x000d: ('sha512', hashlib.sha512),
+}
+
+NUM_PCRS = 24
+TPM_ALG_SHA1 = 0x0004
+EV_NO_ACTION = 0x00000003
+SPEC_ID_EVENT03 = b'Spec ID Event03\0'
+STARTUP_LOCALITY = b'StartupLocality\0'
+
+class EventLogError(Exception):
+	pass
+
+def unpack(fmt, data, off):
+	if off + struct.calcsize(fmt) > len(data):
+		raise EventLogError("event log truncated at offset %d" % (off))
+	return struct.unpack_from(fmt, data, off)
+
+# Yields (pcr, event_type, digests, event_data) for every event in the log,
+# where digests is a list of (TPM_ALG_ID, digest) pairs. The first event is
+# always in the SHA1-only format: in a crypto-agile log it is the EV_NO_ACTION
+# Spec ID header, in an older log it is a measurement like any other.
+# Everything in the log is little-endian.
+def events(data):
+	data = memoryview(data)
+	pcr, event_type, digest, size = unpack('<II20sI', data, 0)
+	off = 32
+	header = bytes(data[off:off + size])
+	off += size
+	yield pcr, event_type, [(TPM_ALG_SHA1, digest)], header
+
+	digest_sizes = None
+	if event_type == EV_NO_ACTION and header.startswith(SPEC_ID_EVENT03):
+		# TCG_EfiSpecIdEvent: 16 bytes of signature, u32 platformClass,
+		# u8 minor, major, errata, uintnSize, then the algorithm list
+		count, = unpack('<I', header, 24)
+		digest_sizes = {}
+		for i in range(count):
+			alg, dsize = unpack('<HH', header, 28 + 4 * i)
+			digest_sizes[alg] = dsize
+
+	while off < len(data):
+		if digest_sizes is None:
+			pcr, event_type, digest, size = unpack('<II20sI', data, off)
+			off += 32
+			digests = [(TPM_ALG_SHA1, digest)]
+		else:
+			pcr, event_type, count = unpack('<III', data, off)
+			off += 12
+			digests = []
+			for _ in range(count):
+				alg, = unpack('<H', data, off)
+				if alg not in digest_sizes:
+					raise EventLogError("unknown digest algorithm 0x%04x" % (alg))
+				dsize = digest_sizes[alg]
+				if off + 2 + dsize > len(data):
+					raise EventLogError("event log truncated at offset %d" % (off))
+				digests.append((alg, bytes(data[off + 2:off + 2 + dsize])))
+				off += 2 + dsize
+			size, = unpack('<I', data, off)
+			off += 4
+		if off + size > len(data):
+			raise EventLogError("event log truncated at offset %d" % (off))
+		yield pcr, event_type, digests, bytes(data[off:off + size])
+		off += size
+
+# A fixed-size array of the PCRs in one bank, and which of them the log has
+# extended.
+class PCRBank:
+	def __init__(self, alg, locality=0):
+		self.name, self.hash = hash_algs[alg]
+		self.size = self.hash().digest_size
+		self.pcrs = bytearray(NUM_PCRS * self.size)
+		self.pcrs[self.size - 1] = locality
+		self.used = 0
+
+	def __getitem__(self, i):
+		return bytes(self.pcrs[i * self.size:(i + 1) * self.size])
+
+	def extend(self, i, digest):
+		start = i * self.size
+		self.pcrs[start:start + self.size] = self.hash(
+			self.pcrs[start:start + self.size] + digest).digest()
+		self.used |= 1 << i
+
+	# Only the extended PCRs, like 'tpm2 eventlog' prints them
+	def digests(self):
+		return { i: self[i] for i in range(NUM_PCRS) if self.used & (1 << i) }
+
+# Replays the event log, and returns { 'sha256': { pcr: bytes, ... }, ... }
+# for each bank in the log (or only the banks named in 'algs').
+def replay(data, algs=None):
+	banks = {}
+	locality = 0
+	for pcr, event_type, digests, event in events(data):
+		if event_type == EV_NO_ACTION:
+			# Not extended (this includes the Spec ID header), but the StartupLocality event sets the
+			# initial value of PCR0. It comes before any extends.
+			if pcr == 0 and event.startswith(STARTUP_LOCALITY) and len(event) > 16:
+				locality = event[16]
+			continue
+		if pcr >= NUM_PCRS:
+			raise EventLogError("PCR%d out of range" % (pcr))
+		for alg, digest in digests:
+			if alg not in hash_algs:
+				continue
+			if algs is not None and hash_algs[alg][0] not in algs:
+				continue
+			if alg not in banks:
+				banks[alg] = PCRBank(alg, locality)
+			banks[alg].extend(pcr, digest)
+	return { bank.name: bank.digests() for bank in banks.values() }
+
+# The same layout that yaml.safe_load() makes from 'tpm2 eventlog' output,
+# i.e. { 'sha256': { pcr: int, ... } }
+def as_ints(pcrs):
+	return { alg: { i: int.from_bytes(v, 'big') for i, v in bank.items() }
+		 for alg, bank in pcrs.items() }
+
+def read_eventlog(path):
+	if tarfile.is_tarfile(path):
+		with tarfile.open(path) as tar:
+			for member in tar.getmembers():
+				if member.isfile() and member.name.split('/')[-1] == 'eventlog':
+					return tar.extractfile(member).read()
+		raise EventLogError("%s has no eventlog" % (path))
+	with open(path, 'rb') as f:
+		return f.read()
+
+# Compares replay() with 'tpm2 eventlog' followed by yaml.safe_load(), which is
+# what the subprocess path of the attestation server does.
+def bench(path, iterations):
+	data = read_eventlog(path)
+	start = time.perf_counter()
+	for _ in range(iterations):
+		native = replay(data)
+	native_time = (time.perf_counter() - start) / iterations
+	print("native replay: %.3f ms/log" % (native_time * 1000))
+
+	start = time.perf_counter()
+	for _ in range(iterations):
+		try:
+			sub = subprocess.run(["tpm2", "eventlog", "/dev/stdin"],
+				input=data,
+				stdout=subprocess.PIPE,
+				stderr=subprocess.DEVNULL,
+			)
+		except FileNotFoundError:
+			print("tpm2 not found, not comparing", file=sys.stderr)
+			return 0
+		if sub.returncode != 0:
+			print("tpm2 eventlog failed, not comparing", file=sys.stderr)
+			return 1
+		tools = yaml.safe_load(sub.stdout)['pcrs']
+	tools_time = (time.perf_counter() - start) / iterations
+	print("tpm2 eventlog: %.3f ms/log (%.1fx)" % (tools_time * 1000, tools_time / native_time))
+
+	if as_ints(native) != tools:
+		print("MISMATCH between native replay and tpm2 eventlog", file=sys.stderr)
+		return 1
+	return 0
+
+if __name__ == '__main__':
+	from sys import argv
+
+	if len(argv) < 3:
+		print("Usage: attest_eventlog.py replay|bench eventlog [iterations]", file=sys.stderr)
+		exit(1)
+
+	if argv[1] == "replay":
+		# print the PCRs in the same form as 'tpm2 eventlog' does
+		pcrs = replay(read_eventlog(argv[2]))
+		print("pcrs:")
+		for alg, bank in pcrs.items():
+			print("  %s:" % (alg))
+			for i, v in bank.items():
+				print("    %-2d : 0x%s" % (i, v.hex().upper()))
+		exit(0)
+
+	if argv[1] == "bench":
+		exit(bench(argv[2], int(argv[3]) if len(argv) > 3 else 100))
+
+	print("Unknown command: '%s'" % (argv[1]), file=sys.stderr)
+	exit(1)
@@ -0,0 +1,223 @@
+"""
+Per-stage latency histograms and outcome counters for the attestation server.
+
+The stages of an attestation (unpack, ek-verify, quote-verify, eventlog replay,
+policy, payload pack and seal, or passing it on to another replica, and the
+total) are timed with stage(), into
+histograms, and the result of each attestation is counted by outcome(). Each
+process keeps its numbers in a fixed layout of doubles in a memory-mapped file,
+one file per process in a shared (tmpfs) directory, so that render() can add up
+every uwsgi worker when it serves /metrics, in the Prometheus text format.
+
+Environment variable controls;
+SAFEBOOT_METRICS_DIR
+   The directory for the per-process files (sbin/attest-server sets this to a
+   directory under /dev/shm). If not set, each process only reports itself.
+SAFEBOOT_SLOW_REQUEST_MS
+   Attestations that take longer than this many milliseconds are logged with
+   their per-stage breakdown (default 0, which disables this).
+"""
+import os
+import mmap
+import time
+import array
+import logging
+import threading
+from contextlib import contextmanager
+
+metrics_dir = os.environ.get('SAFEBOOT_METRICS_DIR') or None
+slow_request_ms = float(os.environ.get('SAFEBOOT_SLOW_REQUEST_MS') or 0)
+
+# The layout is fixed, so that the per-process files can simply be added up.
+stages = [
+	'unpack',
+	'ek_verify',
+	'quote_verify',
+	'subprocess_verify',
+	'eventlog',
+	'policy',
+	'pack',
+	'seal',
+	'forward',
+	'total',
+]
+outcomes = [
+	'ok',
+	'quote_verify_failed',
+	'not_enrolled',
+	'invalid_quote',
+	'unknown_machine',
+	'bad_pcrs',
+	'unable_to_pack_enrollment',
+	'seal_failed',
+	'forwarded',
+	'other',
+]
+buckets = [ 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10 ]
+
+# Each stage has a slot per bucket (plus +Inf), the sum and the count
+stage_slots = len(buckets) + 3
+num_slots = len(stages) * stage_slots + len(outcomes)
+
+def stage_base(name):
+	return stages.index(name) * stage_slots
+
+def outcome_slot(name):
+	return len(stages) * stage_slots + outcomes.index(name)
+
+class Store:
+	def __init__(self, path=None):
+		size = num_slots * 8
+		if path is None:
+			self.map = mmap.mmap(-1, size)
+		else:
+			fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+			try:
+				os.ftruncate(fd, size)
+				self.map = mmap.mmap(fd, size)
+			finally:
+				os.close(fd)
+		self.values = memoryview(self.map).cast('d')
+		self.lock = threading.Lock()
+
+	def observe(self, name, seconds):
+		base = stage_base(name)
+		with self.lock:
+			for i, le in enumerate(buckets):
+				if seconds <= le:
+					self.values[base + i] += 1
+					break
+			else:
+				self.values[base + len(buckets)] += 1
+			self.values[base + len(buckets) + 1] += seconds
+			self.values[base + len(buckets) + 2] += 1
+
+	def count(self, name):
+		with self.lock:
+			self.values[outcome_slot(name)] += 1
+
+store = None
+store_pid = None
+store_lock = threading.Lock()
+
+# The store for this process. uwsgi forks its workers after loading the app,
+# so this is created on first use in each worker, rather than at import.
+def get_store():
+	global store, store_pid
+	with store_lock:
+		if store_pid != os.getpid():
+			path = None
+			if metrics_dir is not None:
+				os.makedirs(metrics_dir, exist_ok=True)
+				path = os.path.join(metrics_dir, "%d.metrics" % (os.getpid()))
+			store = Store(path)
+			store_pid = os.getpid()
+	return store
+
+# The stage timings of the attestation in progress on this thread
+current = threading.local()
+
+@contextmanager
+def stage(name):
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		elapsed = time.perf_counter() - start
+		if getattr(current, 'untimed', False):
+			return
+		get_store().observe(name, elapsed)
+		timings = getattr(current, 'timings', None)
+		if timings is not None:
+			timings[name] = timings.get(name, 0) + elapsed
+
+# Leaves the stages of what it wraps out of the histograms and the slow request
+# log, e.g. the native verification that the "compare" engine runs besides the
+# subprocess one, whose time is already in the 'subprocess_verify' stage.
+@contextmanager
+def untimed():
+	current.untimed = True
+	try:
+		yield
+	finally:
+		current.untimed = False
+
+# Names the attestation in progress, in the slow request log
+def set_label(label):
+	current.label = label
+
+# Wraps a whole attestation, to time the total and to log the breakdown of the
+# slow ones.
+@contextmanager
+def request(label):
+	current.timings = {}
+	current.label = label
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		elapsed = time.perf_counter() - start
+		get_store().observe('total', elapsed)
+		timings = current.timings
+		current.timings = None
+		if slow_request_ms and elapsed * 1000 > slow_request_ms:
+			breakdown = " ".join("%s=%.1fms" % (k, v * 1000) for k, v in timings.items())
+			logging.warning(f"{current.label}: slow attestation {elapsed * 1000:.1f}ms: {breakdown}")
+
+def outcome(name):
+	if name not in outcomes:
+		name = 'other'
+	get_store().count(name)
+
+# The sum of every process's values (including this one's)
+def collect():
+	total = array.array('d', bytes(num_slots * 8))
+	own = get_store()
+	paths = []
+	if metrics_dir is not None:
+		paths = [ os.path.join(metrics_dir, name) for name in os.listdir(metrics_dir)
+			  if name.endswith('.metrics') ]
+	for path in paths:
+		try:
+			with open(path, 'rb') as f:
+				data = f.read()
+		except OSError:
+			continue
+		if len(data) != num_slots * 8:
+			continue
+		for i, v in enumerate(array.array('d', data)):
+			total[i] += v
+	if metrics_dir is None:
+		for i in range(num_slots):
+			total[i] = own.values[i]
+	return total
+
+def fmt(v):
+	return "%d" % (v) if v == int(v) else repr(v)
+
+# The Prometheus text exposition format
+def render():
+	values = collect()
+	lines = [
+		"# HELP safeboot_attest_stage_seconds Time spent in each stage of attestation.",
+		"# TYPE safeboot_attest_stage_seconds histogram",
+	]
+	for name in stages:
+		base = stage_base(name)
+		cumulative = 0
+		for i, le in enumerate(buckets + [ '+Inf' ]):
+			cumulative += values[base + i]
+			lines.append('safeboot_attest_stage_seconds_bucket{stage="%s",le="%s"} %s'
+				% (name, le, fmt(cumulative)))
+		lines.append('safeboot_attest_stage_seconds_sum{stage="%s"} %s'
+			% (name, fmt(values[base + len(buckets) + 1])))
+		lines.append('safeboot_attest_stage_seconds_count{stage="%s"} %s'
+			% (name, fmt(values[base + len(buckets) + 2])))
+	lines += [
+		"# HELP safeboot_attest_outcomes_total Attestations by outcome.",
+		"# TYPE safeboot_attest_outcomes_total counter",
+	]
+	for name in outcomes:
+		lines.append('safeboot_attest_outcomes_total{outcome="%s"} %s'
+			% (name, fmt(values[outcome_slot(name)])))
+	return "\n".join(lines) + "\n"
@@ -0,0 +1,184 @@
+"""
+Partitioning of the enrollment database across attestation service replicas.
+
+Normally every replica has all of the enrollment database. Partitioned, each
+replica has only some of its shards (see hcp/enrollsvc/common.sh), so that
+adding replicas spreads the disk, memory and update costs of the database as
+well as the attestations. The shards are assigned to the replicas with a
+consistent hash ring; each replica has VNODES points on the ring (hashes of its
+name), and each shard is at the point of the first ekpubhash of its range (the
+ekpubhash being a hash already), and belongs to the replica with the first
+point at or after it. So a change of the replicas only moves the shards
+between the points of the replicas that were added or removed and the points
+before them, and the rest stay where they are. (With 256 shards, each shard is
+one first-ply directory of the database.)
+
+A replica that is sent a quote whose ekhash it doesn't have finds the one that
+does from the EK in the quote, before verifying anything, and passes the
+request on to it (or, in the "redirect" mode, redirects the client to it). A
+request that was passed on carries FORWARDED_HEADER, and isn't passed on again,
+in case the replicas don't agree about the ring.
+
+The replica's updater (see my_shards, in hcp/attestsvc/common.sh) uses the
+command line to find the shards that it has.
+
+Environment variable controls;
+SAFEBOOT_PARTITION_PEERS
+   The replicas that the database is partitioned across, as comma-separated
+   "<name>=<url>" pairs, which must be the same on each of them. If not set,
+   the database isn't partitioned.
+SAFEBOOT_PARTITION_SELF
+   The name of this replica, in SAFEBOOT_PARTITION_PEERS.
+SAFEBOOT_PARTITION_SHARDS
+   The number of shards of the database (default 1).
+SAFEBOOT_PARTITION_MODE
+   "proxy" (the default) passes a request for another replica on to it, and
+   "redirect" answers it with a 307 to the other replica.
+"""
+import io
+import os
+import sys
+import bisect
+import hashlib
+import logging
+import tarfile
+import urllib.error
+import urllib.request
+
+# the points on the ring of each replica
+VNODES = 64
+
+FORWARDED_HEADER = 'X-Safeboot-Forwarded'
+
+# the time allowed for the other replica to attest a quote
+FORWARD_TIMEOUT = 60
+
+# the bound on the size of ek.pub (a TPM2B_PUBLIC, so well under this)
+EK_PUB_MAX_SIZE = 4096
+
+# Returns the { name: url } of a SAFEBOOT_PARTITION_PEERS value
+def parse_peers(value):
+	peers = {}
+	for peer in value.replace(',', ' ').split():
+		name, sep, url = peer.partition('=')
+		if not sep or not name or not url or name in peers:
+			raise ValueError(f"bad peer '{peer}'")
+		peers[name] = url.rstrip('/')
+	return peers
+
+def point(data):
+	return int.from_bytes(hashlib.sha256(data.encode()).digest()[0:8], 'big')
+
+# The point of a shard, i.e. that of the first ekpubhash of its range (as
+# shard_of, in hcp/enrollsvc/common_defs.sh, has it)
+def shard_point(shard, shards):
+	return ((shard * 256 + shards - 1) // shards) << 56
+
+def shard_of(ekhash, shards):
+	return int(ekhash[0:2], 16) * shards // 256
+
+class Ring:
+	def __init__(self, names):
+		if not names:
+			raise ValueError("no peers")
+		self.points = sorted((point(f"{name}-{i}"), name)
+				for name in names for i in range(VNODES))
+		self.keys = [ p for p, _ in self.points ]
+
+	# The name of the replica that has the shard
+	def owner(self, shard, shards):
+		i = bisect.bisect_left(self.keys, shard_point(shard, shards))
+		return self.points[i % len(self.points)][1]
+
+	def shards_of(self, name, shards):
+		return [ shard for shard in range(shards) if self.owner(shard, shards) == name ]
+
+peers = parse_peers(os.environ.get('SAFEBOOT_PARTITION_PEERS') or '')
+self_name = os.environ.get('SAFEBOOT_PARTITION_SELF')
+shards = int(os.environ.get('SAFEBOOT_PARTITION_SHARDS') or 1)
+mode = os.environ.get('SAFEBOOT_PARTITION_MODE') or 'proxy'
+ring = Ring(peers) if peers else None
+if ring is not None and self_name not in peers:
+	raise ValueError(f"SAFEBOOT_PARTITION_SELF ('{self_name}') isn't one of the peers")
+
+# The ekhash of a quote tarball (or its path), or None if it has no EK
+def quote_ekhash(quote_file):
+	try:
+		# (quote.tar is never compressed)
+		if isinstance(quote_file, str):
+			tar = tarfile.open(quote_file, mode='r:')
+		else:
+			tar = tarfile.open(fileobj=io.BytesIO(quote_file), mode='r:')
+		with tar:
+			member = tar.getmember('ek.pub')
+			if not member.isfile() or member.size > EK_PUB_MAX_SIZE:
+				return None
+			return hashlib.sha256(tar.extractfile(member).read()).hexdigest()
+	except (KeyError, OSError, tarfile.TarError):
+		return None
+
+# The URL of the replica that has the enrollment of the quote, or None if this
+# one does (or should attest it anyway)
+def route(quote_file):
+	if ring is None:
+		return None
+	ekhash = quote_ekhash(quote_file)
+	# (it is left to verification to reject)
+	if ekhash is None:
+		return None
+	owner = ring.owner(shard_of(ekhash, shards), shards)
+	if owner == self_name:
+		return None
+	return peers[owner]
+
+# Passes the quote on to the replica at 'url', as the client would have sent
+# it. Returns a 3-tuple of the status, the body, and its content type.
+def forward(url, quote_file):
+	if isinstance(quote_file, str):
+		with open(quote_file, 'rb') as f:
+			quote = f.read()
+	else:
+		quote = quote_file
+	boundary = hashlib.sha256(quote).hexdigest()
+	body = b''.join([
+		f'--{boundary}\r\n'.encode(),
+		b'Content-Disposition: form-data; name="quote"; filename="quote.tar"\r\n',
+		b'Content-Type: application/octet-stream\r\n\r\n',
+		quote,
+		f'\r\n--{boundary}--\r\n'.encode(),
+	])
+	req = urllib.request.Request(url + '/', data=body, method='POST', headers={
+		'Content-Type': f'multipart/form-data; boundary={boundary}',
+		FORWARDED_HEADER: self_name,
+	})
+	try:
+		with urllib.request.urlopen(req, timeout=FORWARD_TIMEOUT) as r:
+			return r.status, r.read(), r.headers.get('Content-Type', 'application/octet-stream')
+	except urllib.error.HTTPError as e:
+		return e.code, e.read(), e.headers.get('Content-Type', 'application/json')
+	except OSError as e:
+		logging.warning(f"{url}: unable to forward the quote: {e}")
+		return 502, b'{"error": "replica unavailable"}', 'application/json'
+
+if __name__ == '__main__':
+	from sys import argv
+
+	def usage():
+		print("Usage: attest_partition.py shards <peers> <name> <shards>", file=sys.stderr)
+		print("       attest_partition.py owner <peers> <shards> <ekhash>", file=sys.stderr)
+		exit(1)
+
+	try:
+		if len(argv) == 5 and argv[1] == 'shards':
+			names = parse_peers(argv[2])
+			if argv[3] not in names:
+				raise ValueError(f"'{argv[3]}' isn't one of the peers")
+			print(' '.join(str(s) for s in Ring(names).shards_of(argv[3], int(argv[4]))))
+		elif len(argv) == 5 and argv[1] == 'owner':
+			n = int(argv[3])
+			print(Ring(parse_peers(argv[2])).owner(shard_of(argv[4], n), n))
+		else:
+			usage()
+	except ValueError as e:
+		print(f"Error, {e}", file=sys.stderr)
+		exit(1)
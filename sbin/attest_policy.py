@@ -0,0 +1,485 @@
+"""
+Eventlog verification policy, which only checks golden PCR values against a
+database.
+
+This is the policy engine behind 'attest-verify verify', as a module so that the
+attestation server can apply it to the quote dict it already holds, rather than
+passing it as YAML to another python process. verify() returns a Decision, which
+carries the tarball of the enrolled secrets (as bytes) when the policy is met.
+
+The packed tarballs are cached in memory, keyed by ekhash and the identity of
+the database snapshot, so that repeat attestations of the same host don't
+re-pack the enrollment. A swap of the 'current' snapshot (by
+hcp/attestsvc/updater_loop.sh) invalidates the cached entries of that snapshot.
+(If the database is sharded, each shard has a 'current' snapshot of its own, see
+hcp/attestsvc/init_clones.sh.)
+
+An enrollment is either a directory of files, or a packed record (see
+hcp/enrollsvc/common_defs.sh), i.e. a '.tar' file that already is the tarball
+to send, so that it is read rather than packed.
+
+Alternatively, the database is a key-value store of packed records (see
+hcp/attestsvc/kv_update.py), i.e. an sqlite database in the database directory,
+that replicas keep up to date from the enrollment service's change feed. An
+enrollment is then read from it once per attestation, so that the attestation
+sees the one version of it, and isn't cached, as it is already packed.
+
+If the snapshot has an index of its enrollments (built by
+hcp/attestsvc/ekindex.py, as part of each update), it is mapped into memory
+(and so shared by all of the processes of the server), and an enrollment, and
+whether it is in phase2 and its golden PCRs, are found with a probe of that
+rather than by looking up paths. The index also stands for the snapshot in the
+cache, so a hit costs no system calls at all. The updater retires the index of
+a snapshot that it has swapped out (by setting a byte of it, which the mapping
+sees), upon which the index of the new one is mapped.
+
+Environment variable controls;
+SAFEBOOT_PAYLOAD_CACHE_SIZE
+   Total bytes of packed enrollments to keep in memory (default 67108864),
+   or 0 to disable the cache.
+"""
+import io
+import os
+import mmap
+import time
+import yaml
+import struct
+import logging
+import sqlite3
+import tarfile
+import threading
+from collections import namedtuple, OrderedDict
+
+import attest_metrics
+
+# hard code the hashing algorithm used
+alg = 'sha256'
+
+# attestation directory path (XXX make configurable)
+db_path = os.environ.get('SAFEBOOT_DB_DIR','build/attest')
+
+cache_size = int(os.environ.get('SAFEBOOT_PAYLOAD_CACHE_SIZE') or 67108864)
+
+# the key-value store, if the database is one (see kv_store())
+kv_path = os.path.join(db_path, 'enrolldb.sqlite')
+kv_local = threading.local()
+
+# the index of a snapshot, as hcp/attestsvc/ekindex.py writes it (see there)
+ekindex_path = os.path.join('.git', 'hcp-index')
+EKINDEX_MAGIC = b'HCPEKIX1'
+EKINDEX_HEADER = struct.Struct('<8sB7xQQQ64s')
+EKINDEX_RETIRED = 8
+EKINDEX_SLOT = struct.Struct('<16sIQI')
+EKINDEX_PACKED = 2
+EKINDEX_PHASE2 = 4
+EKINDEX_PCRS = 8
+# how long to wait before looking for an index again, if there was none
+EKINDEX_RETRY = 10
+
+# The outcome of verify(); 'payload' is the enrollment tarball if 'allowed',
+# otherwise None, and 'reason' says why.
+Decision = namedtuple('Decision', ['allowed', 'reason', 'payload'])
+
+# Check that all of the required PCRs are present and match the golden values.
+# It is ok if the quote or event log have more, but none must be missing.
+def pcr_validate(ekhash, golden, quote):
+	if alg not in quote:
+		logging.warning(f"{ekhash=}: quote does not have PCR algorithm '{alg}'")
+		return False
+	if alg not in golden:
+		logging.warning(f"{ekhash=}: PCR file does not have PCR algorithm '{alg}'")
+		return False
+
+	quote = quote[alg]
+	golden = golden[alg]
+	valid = True
+
+	if golden == None:
+		golden = {}
+	for pcr in golden:
+		if type(golden[pcr]) == type(1):
+			good_pcr = golden[pcr]
+		else:
+			good_pcr = int(golden[pcr], 16)
+		if not pcr in quote:
+			logging.warning(f"{ekhash=}: PCR{int(pcr)} missing")
+			valid = False
+		elif good_pcr != quote[pcr]:
+			logging.warning(f"{ekhash=}: PCR{pcr} mismatch {quote[pcr]:x} != expected {good_pcr:x}")
+			valid = False
+
+	return valid
+
+def write_tofu_pcrs(ekhash, ekdir, q, which_pcrs):
+	v = { 'pcrs': { 'sha256': {}}}
+	for pcr in which_pcrs:
+		v['pcrs']['sha256'][pcr] = q[pcr]
+	path = ekdir.path if isinstance(ekdir, IndexedRecord) else ekdir
+	logging.info(f"{ekhash=}: writing TOFU PCRs to {path}")
+	write_enrollment_file(ekdir, 'pcrs', yaml.dump(v).encode())
+
+def read_tofu_pcrs(path):
+	tofu_pcrs = [0, 1]
+	if os.path.exists(os.path.join(path, 'tofu_pcrs')):
+		with open(os.path.join(path, 'tofu_pcrs')) as tofu_pcrs_file:
+			tofu_pcrs = yaml.safe_load(tofu_pcrs_file)
+	return tofu_pcrs
+
+# An enrollment in the key-value store, as read from it (see find_enrollment)
+class KVRecord:
+	def __init__(self, ekhash, data):
+		self.ekhash = ekhash
+		self.data = data
+
+# The mapped index of a snapshot
+class EKIndex:
+	def __init__(self, snapshot):
+		# resolved, so that this is the snapshot that the index is of
+		self.path = os.path.realpath(snapshot)
+		with open(os.path.join(self.path, ekindex_path), 'rb') as f:
+			self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, _, self.slots_off, self.nslots, _, _ = \
+			EKINDEX_HEADER.unpack_from(self.mm)
+		if magic != EKINDEX_MAGIC:
+			raise ValueError(f"{self.path}: not an enrollment index")
+		self.tofu_pcrs = read_tofu_pcrs(db_path)
+
+	def retired(self):
+		return self.mm[EKINDEX_RETIRED] != 0
+
+	# Returns the IndexedRecord of ekhash, or None if it isn't enrolled
+	def lookup(self, ekhash):
+		try:
+			key = bytes.fromhex(ekhash[0:32])
+		except ValueError:
+			return None
+		mask = self.nslots - 1
+		i = int.from_bytes(key[0:8], 'little') & mask
+		while True:
+			k, flags, off, n = EKINDEX_SLOT.unpack_from(self.mm,
+						self.slots_off + i * EKINDEX_SLOT.size)
+			if flags == 0:
+				return None
+			if k == key:
+				break
+			i = (i + 1) & mask
+		ekdir = os.path.join(self.path, 'ekpubhash', ekhash[0:2], ekhash[0:6], ekhash[0:32])
+		if flags & EKINDEX_PACKED:
+			ekdir += '.tar'
+		pcrs = self.mm[off:off + n] if flags & EKINDEX_PCRS else None
+		return IndexedRecord(ekdir, flags & EKINDEX_PACKED != 0,
+				flags & EKINDEX_PHASE2 != 0, pcrs, self)
+
+# An enrollment found in an index (see find_enrollment), i.e. its path (a
+# directory or packed record), and what the index has of it
+class IndexedRecord:
+	def __init__(self, path, packed, phase2, pcrs, index):
+		self.path = path
+		self.packed = packed
+		self.phase2 = phase2
+		self.pcrs = pcrs
+		self.index = index
+
+# The snapshot directory of each first ply, and the index of each snapshot (or,
+# if there was none, when to look again)
+ekindex_dirs = {}
+ekindex_maps = {}
+
+# The index of the snapshot that ekhash's enrollment is in, or None if it
+# hasn't one. (See snapshot_id for which snapshot that is.)
+def ek_index(ekhash):
+	snapshot = ekindex_dirs.get(ekhash[0:2])
+	if snapshot is None:
+		ply1 = os.path.join(db_path, 'ekpubhash', ekhash[0:2])
+		try:
+			snapshot = db_path
+			if os.path.islink(ply1):
+				snapshot = os.path.normpath(os.path.join(os.path.dirname(ply1),
+								os.readlink(ply1), '..', '..'))
+			elif not os.path.exists(ply1):
+				# not cached, as it may be a link once it exists
+				return ek_index_of(snapshot)
+		except OSError:
+			return None
+		ekindex_dirs[ekhash[0:2]] = snapshot
+	return ek_index_of(snapshot)
+
+def ek_index_of(snapshot):
+	index = ekindex_maps.get(snapshot)
+	if isinstance(index, EKIndex) and not index.retired():
+		return index
+	if isinstance(index, float) and time.monotonic() < index:
+		return None
+	try:
+		index = EKIndex(snapshot)
+	except (OSError, ValueError, struct.error) as e:
+		logging.info(f"{snapshot}: no enrollment index: {e}")
+		ekindex_maps[snapshot] = time.monotonic() + EKINDEX_RETRY
+		return None
+	ekindex_maps[snapshot] = index
+	return index
+
+# This thread's connection to the key-value store, or None if the database
+# isn't one
+def kv_store():
+	conn = getattr(kv_local, 'conn', None)
+	if conn is None and os.path.exists(kv_path):
+		# kv_update.py may be applying changes
+		conn = sqlite3.connect(kv_path, timeout=5)
+		kv_local.conn = conn
+	return conn
+
+# Returns the enrollment directory (or packed record) for ekhash, or None. The
+# path is resolved, so that a swap of the database symlinks (see
+# hcp/attestsvc/updater_loop.sh) during the request can't mix files from two
+# versions. If the database is a key-value store, it returns the KVRecord, and
+# if the snapshot has an index, the IndexedRecord.
+def find_enrollment(ekhash):
+	kv = kv_store()
+	if kv is not None:
+		row = kv.execute('SELECT record FROM records WHERE ekhash = ?',
+				(ekhash[0:32],)).fetchone()
+		return KVRecord(ekhash[0:32], row[0]) if row is not None else None
+	ekdir = os.path.join(db_path, 'ekpubhash', ekhash[0:2], ekhash[0:6], ekhash[0:32])
+	paths = [ ekdir, ekdir + '.tar', os.path.join(db_path, ekhash[0:2], ekhash) ]
+	index = ek_index(ekhash)
+	if index is not None:
+		found = index.lookup(ekhash)
+		if found is not None:
+			return found
+		# the index only has the 'ekpubhash' layout
+		paths = paths[2:]
+	for path in paths:
+		if os.path.exists(path):
+			return os.path.realpath(path)
+	return None
+
+def packed(ekdir):
+	if isinstance(ekdir, IndexedRecord):
+		return ekdir.packed
+	return isinstance(ekdir, KVRecord) or ekdir.endswith('.tar')
+
+# The files of a packed record, as { name: data }. A file that was added since
+# (write_enrollment_file appends it) is in it twice, and the last one wins.
+def record_files(ekdir):
+	files = {}
+	if isinstance(ekdir, KVRecord):
+		tar = tarfile.open(fileobj=io.BytesIO(ekdir.data), mode='r:')
+	elif isinstance(ekdir, IndexedRecord):
+		tar = tarfile.open(ekdir.path, mode='r:')
+	else:
+		tar = tarfile.open(ekdir, mode='r:')
+	with tar:
+		for info in tar:
+			name = os.path.normpath(info.name)
+			if info.isfile() and '/' not in name:
+				files[name] = tar.extractfile(info).read()
+	return files
+
+# (The index has the PCRs of an indexed enrollment as of the snapshot, so if it
+# hasn't any, they may have been written since.)
+def enrollment_has_file(ekdir, name):
+	if isinstance(ekdir, IndexedRecord):
+		if name == 'phase2':
+			return ekdir.phase2
+		if name == 'pcrs' and ekdir.pcrs is not None:
+			return True
+		if ekdir.packed:
+			return name in record_files(ekdir)
+		ekdir = ekdir.path
+	if packed(ekdir):
+		return name in record_files(ekdir)
+	return os.path.exists(os.path.join(ekdir, name))
+
+def read_enrollment_file(ekdir, name):
+	if isinstance(ekdir, IndexedRecord):
+		if name == 'pcrs' and ekdir.pcrs is not None:
+			return ekdir.pcrs
+		if ekdir.packed:
+			return record_files(ekdir)[name]
+		ekdir = ekdir.path
+	if packed(ekdir):
+		return record_files(ekdir)[name]
+	with open(os.path.join(ekdir, name), 'rb') as f:
+		return f.read()
+
+def write_enrollment_file(ekdir, name, data):
+	if isinstance(ekdir, IndexedRecord):
+		if name == 'pcrs':
+			ekdir.pcrs = data
+		ekdir = ekdir.path
+	if not packed(ekdir):
+		with open(os.path.join(ekdir, name), 'wb') as f:
+			f.write(data)
+		return
+	info = tarfile.TarInfo('./' + name)
+	info.size = len(data)
+	info.mode = 0o644
+	if not isinstance(ekdir, KVRecord):
+		with tarfile.open(ekdir, mode='a', format=tarfile.GNU_FORMAT) as tar:
+			tar.addfile(info, io.BytesIO(data))
+		return
+	# (until the enrollment service changes it, and the change is applied)
+	buf = io.BytesIO(ekdir.data)
+	with tarfile.open(fileobj=buf, mode='a', format=tarfile.GNU_FORMAT) as tar:
+		tar.addfile(info, io.BytesIO(data))
+	ekdir.data = buf.getvalue()
+	kv = kv_store()
+	with kv:
+		kv.execute('UPDATE records SET record = ? WHERE ekhash = ?',
+				(ekdir.data, ekdir.ekhash))
+
+# The equivalent of 'tar cf - -C ekdir .', in memory
+def pack_enrollment(ekdir):
+	if isinstance(ekdir, KVRecord):
+		return ekdir.data
+	if isinstance(ekdir, IndexedRecord):
+		ekdir = ekdir.path
+	if packed(ekdir):
+		with open(ekdir, 'rb') as f:
+			return f.read()
+	buf = io.BytesIO()
+	with tarfile.open(fileobj=buf, mode='w', format=tarfile.GNU_FORMAT) as tar:
+		tar.add(ekdir, arcname='.')
+	return buf.getvalue()
+
+# Used to notice an enrollment being changed in place, which adds or replaces
+# files and so updates the directory (or packed record) mtime. None if it
+# mustn't be cached. An indexed enrollment is only changed in place by TOFU,
+# i.e. if it is in phase2 and has no PCRs, so only then is it looked at.
+def dir_stamp(ekdir):
+	if isinstance(ekdir, KVRecord):
+		return None
+	if isinstance(ekdir, IndexedRecord):
+		if not ekdir.phase2 or ekdir.pcrs is not None:
+			return 0
+		ekdir = ekdir.path
+	try:
+		st = os.stat(ekdir)
+	except OSError:
+		return None
+	return (st.st_ino, st.st_mtime_ns)
+
+PayloadEntry = namedtuple('PayloadEntry', ['snapshot', 'ekdir', 'stamp', 'payload'])
+
+# The snapshot of the database that ekhash's enrollment is in, identified by
+# the 'current' symlink (replaced on every swap) and the directory it resolves
+# to. In a sharded database, 'current' is a directory in which each first ply
+# is a link into the 'current' snapshot of its shard, and that is the one. If
+# the snapshot has an index, that identifies it instead.
+def snapshot_id(ekhash):
+	index = ek_index(ekhash)
+	if index is not None:
+		return index
+	current = db_path
+	ply1 = os.path.join(db_path, 'ekpubhash', ekhash[0:2])
+	try:
+		if os.path.islink(ply1):
+			current = os.path.normpath(os.path.join(os.path.dirname(ply1),
+							os.readlink(ply1), '..', '..'))
+		st = os.lstat(current)
+	except OSError:
+		return None
+	return (os.path.realpath(current), st.st_ino, st.st_mtime_ns)
+
+# A bounded LRU of packed enrollments. Each entry belongs to the snapshot its
+# enrollment was read from, and is no longer valid once that is swapped out.
+class PayloadCache:
+	def __init__(self, size=cache_size):
+		self.size = size
+		self.used = 0
+		self.lock = threading.Lock()
+		self.cache = OrderedDict()
+
+	# Returns a 2-tuple of the current snapshot (of ekhash's enrollment) and
+	# the entry for ekhash, if there is a still valid one.
+	def lookup(self, ekhash):
+		snapshot = snapshot_id(ekhash)
+		with self.lock:
+			entry = self.cache.get(ekhash)
+			if entry is None or entry.snapshot != snapshot:
+				return snapshot, None
+			self.cache.move_to_end(ekhash)
+		if dir_stamp(entry.ekdir) != entry.stamp:
+			return snapshot, None
+		return snapshot, entry
+
+	def store(self, ekhash, entry):
+		if len(entry.payload) > self.size:
+			return
+		# the snapshot was swapped while this one was being packed
+		if entry.snapshot != snapshot_id(ekhash):
+			return
+		with self.lock:
+			old = self.cache.pop(ekhash, None)
+			if old is not None:
+				self.used -= len(old.payload)
+			self.cache[ekhash] = entry
+			self.used += len(entry.payload)
+			while self.used > self.size:
+				_, old = self.cache.popitem(last=False)
+				self.used -= len(old.payload)
+
+payload_cache = PayloadCache()
+
+# Applies the policy, and returns a 4-tuple of a Decision if it rejects the
+# quote (otherwise None), the enrollment directory, and the cache snapshot and
+# entry for the ekhash.
+def check(quote, quote_valid):
+	ekhash = quote['ekhash']
+
+	# check for an enrolled directory, unless it is already known
+	snapshot, entry = payload_cache.lookup(ekhash)
+	ekdir = entry.ekdir if entry is not None else find_enrollment(ekhash)
+	if ekdir is None:
+		logging.warning(f"{ekhash=}: can't find matching enrollment")
+		return Decision(False, "not enrolled", None), None, snapshot, entry
+
+	# default policy is to reject any invalid quotes
+	if not quote_valid:
+		logging.warning(f"{ekhash=}: rejecting invalid quote")
+		return Decision(False, "invalid quote", None), ekdir, snapshot, entry
+
+	if enrollment_has_file(ekdir, 'phase2'):
+		if isinstance(ekdir, IndexedRecord):
+			tofu_pcrs = ekdir.index.tofu_pcrs
+		else:
+			tofu_pcrs = read_tofu_pcrs(db_path)
+		if len(tofu_pcrs) > 0 and not enrollment_has_file(ekdir, "pcrs"):
+			write_tofu_pcrs(ekhash, ekdir, quote['pcrs']['sha256'], tofu_pcrs)
+		valid_pcrs = yaml.safe_load(read_enrollment_file(ekdir, "pcrs"))
+		if valid_pcrs is None:
+			logging.warning(f"{ekhash=}: rejecting unknown machine")
+			return Decision(False, "unknown machine", None), ekdir, snapshot, entry
+
+		if not pcr_validate(ekhash, valid_pcrs['pcrs'], quote['pcrs']):
+			logging.warning(f"{ekhash=}: rejecting bad PCRs")
+			return Decision(False, "bad PCRs", None), ekdir, snapshot, entry
+
+	return None, ekdir, snapshot, entry
+
+def verify(quote, quote_valid):
+	ekhash = quote['ekhash']
+	with attest_metrics.stage('policy'):
+		decision, ekdir, snapshot, entry = check(quote, quote_valid)
+	if decision is not None:
+		return decision
+
+	# the eventlog meets the policy requirements
+	# so output the secret for encoding by the attestation server
+	logging.info(f"{ekhash=}: sending secrets")
+
+	# the stamp is taken first, so that a change during the packing
+	# will cause a miss next time
+	stamp = dir_stamp(ekdir)
+	if entry is not None and entry.stamp == stamp:
+		return Decision(True, "ok", entry.payload)
+	try:
+		with attest_metrics.stage('pack'):
+			payload = pack_enrollment(ekdir)
+	except (OSError, tarfile.TarError) as e:
+		logging.warning(f"{ekhash=}: unable to pack enrollment: {e}")
+		return Decision(False, "unable to pack enrollment", None)
+	if stamp is not None:
+		payload_cache.store(ekhash, PayloadEntry(snapshot, ekdir, stamp, payload))
+	return Decision(True, "ok", payload)
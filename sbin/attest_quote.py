@@ -0,0 +1,396 @@
+"""
+In-process quote verification, for use by the attestation server.
+
+This is a native python equivalent of the "unpack-quote" and "quote-verify"
+steps of 'tpm2-attest verify'. It parses the TPMS_ATTEST structure in
+quote.out, checks the attributes of ak.pub against AK_TYPE, verifies the
+ECDSA quote signature, checks the PCR digest against quote.pcr and checks the
+nonce for freshness (QUOTE_MAX_AGE). The result is the same dict that
+attest-server-sub.py gets from yaml.safe_load() of 'tpm2-attest verify'
+output, so the two paths can be run side by side and diffed.
+
+The EK certificate is checked against the in-memory trust store in
+attest_ekstore.py, and the event log is replayed by attest_eventlog.py. Besides
+the YAML-compatible fields, the quote dict carries the quoted and replayed PCRs
+as bytes ('pcr-digests' and 'eventlog-digests') so that they can be compared
+directly.
+"""
+import io
+import os
+import sys
+import time
+import struct
+import tarfile
+import hashlib
+import logging
+import yaml
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import encode_dss_signature
+
+import attest_eventlog
+import attest_metrics
+
+# Same defaults as sbin/tpm2-attest
+QUOTE_MAX_AGE = int(os.environ.get('QUOTE_MAX_AGE') or 30)
+AK_TYPE = 'fixedtpm|stclear|fixedparent|sensitivedataorigin|userwithauth|restricted|sign'
+CA_PATH = os.environ.get('PREFIX', '') + os.environ.get('DIR', '/etc/safeboot') + '/certs'
+
+# The files of quote.tar (see 'tpm2-attest quote') that are read, and the bound
+# on the size of each, the same as that on the quote (see attest-server-sub.py)
+QUOTE_FILES = ('ek.crt', 'ek.pub', 'ak.pub', 'ak.ctx', 'nonce',
+	       'quote.out', 'quote.sig', 'quote.pcr', 'eventlog')
+QUOTE_FILE_MAX_SIZE = int(os.environ.get('SAFEBOOT_QUOTE_MAX_SIZE') or 4194304)
+
+# TPM2 constants (TPM 2.0 Part 2: Structures)
+TPM_GENERATED_VALUE = 0xff544347
+TPM_ST_ATTEST_QUOTE = 0x8018
+TPM_ALG_RSA = 0x0001
+TPM_ALG_NULL = 0x0010
+TPM_ALG_ECDSA = 0x0018
+TPM_ALG_ECC = 0x0023
+
+# Hash algorithms, by TPM_ALG_ID, with the names used by tpm2-tools
+hash_algs = {
+	0x0004: ('sha1', hashlib.sha1),
+	0x000b: ('sha256', hashlib.sha256),
+	0x000c: ('sha384', hashlib.sha384),
+	0x000d: ('sha512', hashlib.sha512),
+}
+
+ecc_curves = {
+	0x0003: ec.SECP256R1,
+	0x0004: ec.SECP384R1,
+	0x0005: ec.SECP521R1,
+}
+
+# TPMA_OBJECT bits, by the names that 'tpm2 print' uses
+tpma_object = {
+	'fixedtpm': 1 << 1,
+	'stclear': 1 << 2,
+	'fixedparent': 1 << 4,
+	'sensitivedataorigin': 1 << 5,
+	'userwithauth': 1 << 6,
+	'adminwithpolicy': 1 << 7,
+	'noda': 1 << 10,
+	'encryptedduplication': 1 << 11,
+	'restricted': 1 << 16,
+	'decrypt': 1 << 17,
+	'sign': 1 << 18,
+}
+
+def tpma_value(attrs):
+	v = 0
+	for a in attrs.split('|'):
+		v |= tpma_object[a]
+	return v
+
+# Like the 'grep "value: $AK_TYPE"' in tpm2-attest, attributes above the
+# highest expected one are not considered.
+def tpma_check(attributes, attrs):
+	expected = tpma_value(attrs)
+	return attributes & ((1 << expected.bit_length()) - 1) == expected
+
+class QuoteError(Exception):
+	pass
+
+# Minimal TPM2 unmarshalling. Everything on the wire is big-endian, the only
+# exception being the tpm2-tools "serialized" PCR file (see parse_pcrs()).
+class Buffer:
+	def __init__(self, data):
+		self.data = data
+		self.off = 0
+
+	def take(self, n):
+		if self.off + n > len(self.data):
+			raise QuoteError("structure truncated")
+		v = self.data[self.off:self.off+n]
+		self.off += n
+		return v
+
+	def u8(self):
+		return self.take(1)[0]
+
+	def u16(self):
+		return struct.unpack('>H', self.take(2))[0]
+
+	def u32(self):
+		return struct.unpack('>I', self.take(4))[0]
+
+	def u64(self):
+		return struct.unpack('>Q', self.take(8))[0]
+
+	def tpm2b(self):
+		return self.take(self.u16())
+
+def pcr_selection_list(sel):
+	result = []
+	for _ in range(sel.u32()):
+		alg = sel.u16()
+		bitmap = sel.take(sel.u8())
+		pcrs = [i for i in range(len(bitmap) * 8) if bitmap[i // 8] & (1 << (i % 8))]
+		result.append((alg, pcrs))
+	return result
+
+# TPMS_ATTEST, as written by 'tpm2 quote --message'
+def parse_attest(data):
+	b = Buffer(data)
+	attest = {}
+	if b.u32() != TPM_GENERATED_VALUE:
+		raise QuoteError("quote is not TPM generated")
+	if b.u16() != TPM_ST_ATTEST_QUOTE:
+		raise QuoteError("attestation is not a quote")
+	attest['signer'] = b.tpm2b()
+	attest['extra'] = b.tpm2b()
+	attest['clock'] = b.u64()
+	attest['resetCount'] = b.u32()
+	attest['restartCount'] = b.u32()
+	attest['safe'] = b.u8()
+	attest['firmwareVersion'] = b.u64()
+	attest['pcrSelect'] = pcr_selection_list(b)
+	attest['pcrDigest'] = b.tpm2b()
+	return attest
+
+# TPMT_PUBLIC, as written by 'tpm2 readpublic --format tpmt' (ak.pub). The
+# TPM2B_PUBLIC in ek.pub is the same thing with a size prefix. Only the fields
+# that matter for verification are decoded.
+def parse_public(data):
+	b = Buffer(data)
+	pub = {}
+	pub['type'] = b.u16()
+	pub['nameAlg'] = b.u16()
+	pub['attributes'] = b.u32()
+	pub['authPolicy'] = b.tpm2b()
+	if pub['type'] == TPM_ALG_RSA:
+		pub['symmetric'] = b.u16()
+		if pub['symmetric'] != TPM_ALG_NULL:
+			pub['symKeyBits'] = b.u16()
+			pub['symMode'] = b.u16()
+		pub['scheme'] = b.u16()
+		if pub['scheme'] != TPM_ALG_NULL:
+			pub['schemeHash'] = b.u16()
+		pub['keyBits'] = b.u16()
+		pub['exponent'] = b.u32() or 65537
+		pub['modulus'] = b.tpm2b()
+	elif pub['type'] == TPM_ALG_ECC:
+		if b.u16() != TPM_ALG_NULL:
+			raise QuoteError("signing key has a symmetric algorithm")
+		pub['scheme'] = b.u16()
+		if pub['scheme'] != TPM_ALG_NULL:
+			pub['schemeHash'] = b.u16()
+		pub['curve'] = b.u16()
+		if b.u16() != TPM_ALG_NULL:
+			raise QuoteError("unexpected ECC KDF")
+		pub['x'] = b.tpm2b()
+		pub['y'] = b.tpm2b()
+	else:
+		raise QuoteError("unsupported key type 0x%04x" % (pub['type']))
+	return pub
+
+# TPMT_SIGNATURE, as written by 'tpm2 quote --signature'
+def parse_signature(data):
+	b = Buffer(data)
+	sig = {}
+	sig['alg'] = b.u16()
+	if sig['alg'] != TPM_ALG_ECDSA:
+		raise QuoteError("unsupported signature algorithm 0x%04x" % (sig['alg']))
+	sig['hash'] = b.u16()
+	sig['r'] = b.tpm2b()
+	sig['s'] = b.tpm2b()
+	return sig
+
+# The "serialized" PCR file written by 'tpm2 quote --pcr'. This is a memory
+# dump of a TPML_PCR_SELECTION, a count of TPML_DIGEST structures, and the
+# TPML_DIGEST structures themselves, all in host (little-endian) byte order.
+# The PCR values are returned per bank, in the same order as the selection.
+def parse_pcrs(data):
+	off = 0
+	def unpack(fmt):
+		nonlocal off
+		if off + struct.calcsize(fmt) > len(data):
+			raise QuoteError("PCR file truncated")
+		v = struct.unpack_from(fmt, data, off)
+		off += struct.calcsize(fmt)
+		return v
+
+	count, = unpack('<I')
+	if count > 16:
+		raise QuoteError("PCR file has too many banks")
+	selections = []
+	for i in range(16):
+		alg, size, bitmap = unpack('<HB4sx')
+		if i < count:
+			bitmap = bitmap[:size]
+			pcrs = [n for n in range(size * 8) if bitmap[n // 8] & (1 << (n % 8))]
+			selections.append((alg, pcrs))
+	ndigests, = unpack('<I')
+	digests = []
+	for _ in range(ndigests):
+		n, = unpack('<I')
+		for j in range(8):
+			size, value = unpack('<H64s')
+			if j < n:
+				digests.append(value[:size])
+	return selections, digests
+
+# quote_file is either a path or the tarball itself, as bytes, in which case
+# nothing is written to disk.
+def unpack_quote(quote_file):
+	files = {}
+	# quote.tar is never compressed, so nor is it decompressed here
+	if isinstance(quote_file, (bytes, bytearray)):
+		tar = tarfile.open(fileobj=io.BytesIO(quote_file), mode='r:')
+	else:
+		tar = tarfile.open(quote_file, mode='r:')
+	with tar:
+		for member in tar:
+			name = os.path.basename(member.name)
+			if not member.isfile() or name not in QUOTE_FILES:
+				continue
+			if member.size > QUOTE_FILE_MAX_SIZE:
+				raise QuoteError("quote %s is too large" % (name))
+			files[name] = tar.extractfile(member).read()
+	if 'ek.pub' not in files:
+		raise QuoteError("quote is missing EK public key")
+	return files
+
+def check_nonce(nonce):
+	try:
+		quote_time = int(nonce, 16)
+	except ValueError:
+		raise QuoteError("malformed nonce '%s'" % (nonce))
+	verify_time = int(time.time())
+	if QUOTE_MAX_AGE != 0 and verify_time - quote_time > QUOTE_MAX_AGE:
+		raise QuoteError("Old nonce: %d > %d + %d" % (quote_time, verify_time, QUOTE_MAX_AGE))
+
+# The equivalent of 'tpm2-attest quote-verify' (attribute checks and
+# 'tpm2 checkquote'). Returns the quoted PCRs in the same layout that
+# 'tpm2 checkquote' prints them, but as bytes rather than the ints that
+# yaml.safe_load() parses them into, i.e. { 'sha256': { 0: bytes, ... } }.
+def quote_verify(files, nonce=None):
+	for f in ('quote.out', 'quote.sig', 'quote.pcr', 'ak.pub'):
+		if f not in files:
+			raise QuoteError("quote is missing %s" % (f))
+
+	if nonce is None:
+		# if no nonce was specified, read it from the tar file
+		# and check it for freshness compared to the current time
+		nonce = files.get('nonce', b'').decode('utf-8', 'replace')
+		check_nonce(nonce)
+
+	attest = parse_attest(files['quote.out'])
+
+	# If 'stclear' is not set, then an attacker might have a persistent
+	# version of this key and could reboot into an untrusted state.
+	ak = parse_public(files['ak.pub'])
+	if ak['type'] != TPM_ALG_ECC or not tpma_check(ak['attributes'], AK_TYPE):
+		raise QuoteError("ak.pub: incorrect key attributes 0x%08x" % (ak['attributes']))
+
+	sig = parse_signature(files['quote.sig'])
+	if sig['hash'] not in hash_algs or ak['curve'] not in ecc_curves:
+		raise QuoteError("unsupported signature hash or curve")
+	try:
+		extra = bytes.fromhex(nonce)
+	except ValueError:
+		raise QuoteError("malformed nonce '%s'" % (nonce))
+	if attest['extra'] != extra:
+		raise QuoteError("unable to verify quote with '%s'" % (nonce))
+
+	key = ec.EllipticCurvePublicNumbers(
+		int.from_bytes(ak['x'], 'big'),
+		int.from_bytes(ak['y'], 'big'),
+		ecc_curves[ak['curve']]()).public_key()
+	halg = getattr(hashes, hash_algs[sig['hash']][0].upper())()
+	try:
+		key.verify(
+			encode_dss_signature(int.from_bytes(sig['r'], 'big'),
+					     int.from_bytes(sig['s'], 'big')),
+			files['quote.out'],
+			ec.ECDSA(halg))
+	except InvalidSignature:
+		raise QuoteError("quote signature is invalid")
+
+	# The PCR values must be exactly those that were quoted, and their
+	# digest (with the signing hash) must match the one in the quote.
+	selections, digests = parse_pcrs(files['quote.pcr'])
+	if selections != attest['pcrSelect']:
+		raise QuoteError("PCR selection does not match the quote")
+	if sum(len(pcrs) for _, pcrs in selections) != len(digests):
+		raise QuoteError("PCR file has the wrong number of digests")
+	pcr_digest = hash_algs[sig['hash']][1](b''.join(digests)).digest()
+	if pcr_digest != attest['pcrDigest']:
+		raise QuoteError("PCR digest does not match the quote")
+
+	pcrs = {}
+	values = iter(digests)
+	for alg, indices in selections:
+		if alg not in hash_algs:
+			raise QuoteError("unsupported PCR bank 0x%04x" % (alg))
+		bank = pcrs.setdefault(hash_algs[alg][0], {})
+		for i in indices:
+			bank[i] = next(values)
+	return pcrs
+
+# The EK certificate is checked against the process-wide trust store.
+def ek_verify(files):
+	# imported here, as attest_ekstore itself builds on this module
+	import attest_ekstore
+	attest_ekstore.default_store().ek_verify(files)
+
+# Replays the event log natively, rather than with 'tpm2 eventlog'. Returns None
+# if the quote did not include an event log, like 'tpm2-attest verify' does.
+def eventlog_pcrs(files):
+	if 'eventlog' not in files:
+		return None
+	try:
+		return attest_eventlog.replay(files['eventlog'])
+	except attest_eventlog.EventLogError as e:
+		raise QuoteError("unable to parse eventlog: %s" % (e))
+
+# The equivalent of 'tpm2-attest verify quote.tar [nonce]'. Returns a 2-tuple
+# of (valid, quote), where quote holds whatever had been established before
+# any failure, exactly like the YAML printed by the shell version.
+def verify(quote_file, nonce=None):
+	quote = {}
+	try:
+		with attest_metrics.stage('unpack'):
+			files = unpack_quote(quote_file)
+		if 'ek.crt' in files:
+			with attest_metrics.stage('ek_verify'):
+				ek_verify(files)
+		else:
+			logging.warning("verify: no EK certificate")
+		quote['ekhash'] = hashlib.sha256(files['ek.pub']).hexdigest()
+		with attest_metrics.stage('quote_verify'):
+			quote['pcr-digests'] = quote_verify(files, nonce)
+		quote['pcrs'] = attest_eventlog.as_ints(quote['pcr-digests'])
+		with attest_metrics.stage('eventlog'):
+			quote['eventlog-digests'] = eventlog_pcrs(files)
+		quote['eventlog-pcrs'] = None
+		if quote['eventlog-digests'] is not None:
+			quote['eventlog-pcrs'] = attest_eventlog.as_ints(quote['eventlog-digests'])
+	except (QuoteError, tarfile.TarError, OSError) as e:
+		name = quote_file if isinstance(quote_file, str) else "quote"
+		logging.warning(f"{name}: {e}")
+		return False, quote
+	return True, quote
+
+if __name__ == '__main__':
+	from sys import argv
+	logging.basicConfig(level=logging.INFO)
+
+	if len(argv) < 3 or argv[1] != "verify":
+		print("Usage: attest_quote.py verify quote.tar [nonce]", file=sys.stderr)
+		exit(1)
+
+	# use the imported module, so that QuoteError is the same class that
+	# attest_ekstore raises
+	import attest_quote
+	valid, quote = attest_quote.verify(argv[2], argv[3] if len(argv) > 3 else None)
+	# only the fields that 'tpm2-attest verify' prints
+	for k in ('pcr-digests', 'eventlog-digests'):
+		quote.pop(k, None)
+	yaml.safe_dump(quote, sys.stdout)
+	exit(0 if valid else 1)
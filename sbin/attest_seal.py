@@ -0,0 +1,170 @@
+"""
+In-process sealing of attestation replies, for use by the attestation server.
+
+This is a native python equivalent of 'tpm2-attest seal'. A random secret key
+is wrapped to the client's EK with TPM2 MakeCredential, bound to the name of
+the AK that signed the quote (so only that TPM, with that AK loaded, can
+recover it with 'tpm2 activatecredential'), and the reply is encrypted with it
+in the same format as aead_encrypt in functions.sh. The result is the same
+credential.bin/cipher.bin/ak.ctx tarball that 'tpm2-attest unseal' expects,
+built in memory, and the secret key is never written out.
+"""
+import io
+import os
+import sys
+import hmac
+import time
+import struct
+import tarfile
+import hashlib
+
+from cryptography.hazmat.primitives import hashes, padding as sympadding
+from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+try:
+	# newer versions of cryptography have moved CFB mode
+	from cryptography.hazmat.decrepit.ciphers.modes import CFB
+except ImportError:
+	CFB = modes.CFB
+
+import attest_quote
+from attest_quote import QuoteError
+
+TPM_ALG_AES = 0x0006
+TPM_ALG_CFB = 0x0043
+
+# The header that tpm2-tools puts on the makecredential output file
+# (files_write_header() in tpm2-tools), which activatecredential checks.
+CRED_MAGIC = 0xBADCC0DE
+CRED_VERSION = 1
+
+# TPM2 Part 1, 11.4.10.2: KDFa() in counter mode with HMAC. The label is
+# null-terminated.
+def kdfa(hash_name, key, label, context_u, context_v, bits):
+	out = b''
+	counter = 1
+	while len(out) * 8 < bits:
+		out += hmac.new(key,
+			struct.pack('>I', counter) + label + b'\0' + context_u + context_v + struct.pack('>I', bits),
+			hash_name).digest()
+		counter += 1
+	return out[:(bits + 7) // 8]
+
+# The TPM2B_NAME of a public area: nameAlg followed by the digest of the
+# marshalled TPMT_PUBLIC. For the AK this is the same as
+# 'echo 000b$(sha256 < ak.pub)' in tpm2-attest.
+def key_name(public):
+	name_alg = struct.unpack('>H', public[2:4])[0]
+	if name_alg not in attest_quote.hash_algs:
+		raise QuoteError("unsupported name algorithm 0x%04x" % (name_alg))
+	return public[2:4] + attest_quote.hash_algs[name_alg][1](public).digest()
+
+# TPM2 Part 1, 24: MakeCredential with an RSA storage key (the EK). Returns the
+# marshalled TPM2B_ID_OBJECT and TPM2B_ENCRYPTED_SECRET.
+def make_credential(ek_pub, secret, name):
+	ek = attest_quote.parse_public(ek_pub)
+	if ek['type'] != attest_quote.TPM_ALG_RSA:
+		raise QuoteError("ek.pub: only RSA EKs are supported")
+	if ek['symmetric'] != TPM_ALG_AES or ek.get('symMode') != TPM_ALG_CFB:
+		raise QuoteError("ek.pub: unsupported symmetric algorithm")
+	if ek['nameAlg'] not in attest_quote.hash_algs:
+		raise QuoteError("ek.pub: unsupported name algorithm 0x%04x" % (ek['nameAlg']))
+	hash_name, hash_fn = attest_quote.hash_algs[ek['nameAlg']]
+	digest_size = hash_fn().digest_size
+
+	# the seed is encrypted to the EK with OAEP, using the EK's name
+	# algorithm and the label "IDENTITY"
+	seed = os.urandom(digest_size)
+	key = rsa.RSAPublicNumbers(ek['exponent'],
+		int.from_bytes(ek['modulus'], 'big')).public_key()
+	halg = getattr(hashes, hash_name.upper())()
+	enc_seed = key.encrypt(seed, padding.OAEP(
+		mgf=padding.MGF1(algorithm=halg),
+		algorithm=halg,
+		label=b'IDENTITY\0'))
+
+	# the credential (a TPM2B_DIGEST) is encrypted with a key derived from
+	# the seed and the name of the AK, with a zero IV
+	sym_key = kdfa(hash_name, seed, b'STORAGE', name, b'', ek['symKeyBits'])
+	encryptor = Cipher(algorithms.AES(sym_key), CFB(bytes(16))).encryptor()
+	enc_identity = encryptor.update(struct.pack('>H', len(secret)) + secret) + encryptor.finalize()
+
+	# and integrity protected with an HMAC over it and the AK name
+	hmac_key = kdfa(hash_name, seed, b'INTEGRITY', b'', b'', digest_size * 8)
+	outer_hmac = hmac.new(hmac_key, enc_identity + name, hash_name).digest()
+
+	id_object = struct.pack('>H', len(outer_hmac)) + outer_hmac + enc_identity
+	return (struct.pack('>H', len(id_object)) + id_object,
+		struct.pack('>H', len(enc_seed)) + enc_seed)
+
+# The equivalent of 'tpm2 makecredential --tcti none --credential-blob',
+# including the tpm2-tools file header.
+def credential_blob(ek_pub, secret, name):
+	id_object, enc_secret = make_credential(ek_pub, secret, name)
+	return struct.pack('>II', CRED_MAGIC, CRED_VERSION) + id_object + enc_secret
+
+# The equivalent of aead_encrypt in functions.sh: a random 16 byte confounder
+# and the plaintext, encrypted with AES-256-CBC (and a zero IV), followed by an
+# HMAC-SHA256 of the ciphertext keyed with the sha256 of the key. The cipher
+# key is what 'openssl enc -kfile -iter 1 -md SHA256 -nosalt' derives from
+# the key in hex, which is PBKDF2 with an empty salt.
+def aead_encrypt(plaintext, key):
+	enc_key = hashlib.pbkdf2_hmac('sha256', key.hex().encode(), b'', 1, 32)
+	mac_key = hashlib.sha256(key).digest()
+
+	padder = sympadding.PKCS7(128).padder()
+	padded = padder.update(os.urandom(16) + plaintext) + padder.finalize()
+	encryptor = Cipher(algorithms.AES(enc_key), modes.CBC(bytes(16))).encryptor()
+	ciphertext = encryptor.update(padded) + encryptor.finalize()
+	return ciphertext + hmac.new(mac_key, ciphertext, 'sha256').digest()
+
+def tar_bytes(members):
+	buf = io.BytesIO()
+	now = int(time.time())
+	with tarfile.open(fileobj=buf, mode='w', format=tarfile.GNU_FORMAT) as tar:
+		for name, data in members:
+			info = tarfile.TarInfo(name)
+			info.size = len(data)
+			info.mode = 0o644
+			info.mtime = now
+			tar.addfile(info, io.BytesIO(data))
+	return buf.getvalue()
+
+# The equivalent of 'echo payload | tpm2-attest seal quote.tar', where
+# quote_file is a path or the quote tarball as bytes. Returns the sealed
+# tarball as bytes.
+def seal(quote_file, payload):
+	files = attest_quote.unpack_quote(quote_file)
+	for f in ('ek.pub', 'ak.pub', 'ak.ctx'):
+		if f not in files:
+			raise QuoteError("quote is missing %s" % (f))
+
+	# create a random key and encrypt the payload with it
+	secret = os.urandom(32)
+	cipher = aead_encrypt(payload, secret)
+
+	# convert the attestation key into a "name" so that the TPM will only
+	# decrypt if it matches an active attestation key in that device. ek.pub
+	# is a TPM2B_PUBLIC, so skip the size.
+	credential = credential_blob(files['ek.pub'][2:], secret, key_name(files['ak.pub']))
+
+	return tar_bytes([
+		('credential.bin', credential),
+		('cipher.bin', cipher),
+		('ak.ctx', files['ak.ctx']),
+	])
+
+if __name__ == '__main__':
+	from sys import argv
+
+	if len(argv) != 3 or argv[1] != "seal":
+		print("Usage: attest_seal.py seal quote.tar < secret > sealed.tar", file=sys.stderr)
+		exit(1)
+
+	try:
+		sealed = seal(argv[2], sys.stdin.buffer.read())
+	except (attest_quote.QuoteError, tarfile.TarError, OSError) as e:
+		print("%s: %s" % (argv[2], e), file=sys.stderr)
+		exit(1)
+	sys.stdout.buffer.write(sealed)
+	exit(0)
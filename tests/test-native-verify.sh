@@ -0,0 +1,117 @@
+#!/bin/bash
+# Verify that the native (in-process) quote verification, event log replay and
+# sealing that attest-server uses agree with the shell tools
+set -e -o pipefail
+export LC_ALL=C
+
+die() { echo "$@" >&2 ; exit 1 ; }
+warn() { echo "$@" >&2 ; }
+
+DIR="`dirname $0`"
+TOP="`cd "$DIR/.." && pwd`"
+SBIN="$TOP/sbin"
+export PATH="$SBIN:$TOP/bin:$PATH"
+
+TMP="`mktemp -d`"
+trap 'rm -rf "$TMP"' EXIT
+
+gunzip -c "$DIR/quote-t490.tgz" > "$TMP/quote.tar" \
+|| die "unable to unpack the test quote"
+
+# attest_quote.py finds the EK CA certificates in $DIR/certs
+native_verify() {
+	env DIR="$TOP" python3 "$SBIN/attest_quote.py" verify "$TMP/quote.tar" "$@"
+}
+
+warn "----- Good test -----"
+native_verify abcdef \
+> "$TMP/native.yaml" \
+|| die "native attestation verification failed"
+
+warn "--- Quoted and replayed PCRs match the known PCRs"
+python3 - "$TMP/native.yaml" "$DIR/pcrs-t490.txt" <<'EOF' \
+|| die "native PCRs are wrong"
+import sys, yaml
+quote = yaml.safe_load(open(sys.argv[1]))
+good = yaml.safe_load(open(sys.argv[2]))['pcrs']['sha256']
+quoted = quote['pcrs']['sha256']
+replayed = quote['eventlog-pcrs']['sha256']
+for pcr, value in good.items():
+	if quoted.get(pcr) != value:
+		sys.exit(f"quoted PCR {pcr} is not the known one")
+for pcr, value in quoted.items():
+	if pcr in replayed and replayed[pcr] != value:
+		sys.exit(f"replayed PCR {pcr} is not the quoted one")
+EOF
+
+warn "--- Replay of a SHA1-only (pre crypto-agile) event log"
+python3 - "$SBIN" <<'EOF' \
+|| die "SHA1-only event log replay is wrong"
+import sys, struct, hashlib
+sys.path.insert(0, sys.argv[1])
+import attest_eventlog
+# Two EV_POST_CODE measurements in PCR0, the first of them the first event
+d1 = hashlib.sha1(b'one').digest()
+d2 = hashlib.sha1(b'two').digest()
+log = b''
+for d in (d1, d2):
+	log += struct.pack('<II20sI', 0, 1, d, 3) + b'abc'
+pcr0 = hashlib.sha1(hashlib.sha1(bytes(20) + d1).digest() + d2).digest()
+if attest_eventlog.replay(log) != { 'sha1': { 0: pcr0 } }:
+	sys.exit("replayed PCR0 is not the extend of both events")
+EOF
+
+if command -v tpm2 >/dev/null; then
+	warn "--- Same result as tpm2-attest verify"
+	tpm2-attest verify \
+		"$TMP/quote.tar" \
+		abcdef \
+		"$TOP/certs" \
+	> "$TMP/tools.yaml" \
+	|| die "attestation verification failed"
+	python3 - "$TMP/native.yaml" "$TMP/tools.yaml" <<'EOF' \
+	|| die "native and tpm2-attest verification differ"
+import sys, yaml
+native = yaml.safe_load(open(sys.argv[1]))
+tools = yaml.safe_load(open(sys.argv[2]))
+for k in set(native) | set(tools):
+	if native.get(k) != tools.get(k):
+		sys.exit(f"{k} differs")
+EOF
+else
+	warn "--- No tpm2 tools, not comparing with tpm2-attest verify"
+fi
+
+warn "--- Wrong nonce (should fail)"
+native_verify 12345678 \
+> "$TMP/native-fail.yaml" \
+&& die "wrong nonce: native attestation verification should have failed"
+
+warn "--- Sealed payload decrypts with aead_decrypt"
+head -c 32 /dev/urandom > "$TMP/key"
+head -c 1000 /dev/urandom > "$TMP/plaintext"
+python3 - "$SBIN" "$TMP" <<'EOF' \
+|| die "unable to encrypt"
+import sys
+sys.path.insert(0, sys.argv[1])
+import attest_seal
+key = open(sys.argv[2] + '/key', 'rb').read()
+plaintext = open(sys.argv[2] + '/plaintext', 'rb').read()
+with open(sys.argv[2] + '/ciphertext', 'wb') as f:
+	f.write(attest_seal.aead_encrypt(plaintext, key))
+EOF
+(
+	. "$TOP/functions.sh"
+	aead_decrypt "$TMP/ciphertext" "$TMP/key" "$TMP/decrypted"
+) || die "aead_decrypt failed"
+cmp "$TMP/plaintext" "$TMP/decrypted" \
+|| die "aead_decrypt did not give back the plaintext"
+
+warn "--- Tampered ciphertext (should fail)"
+printf '\x01' | dd of="$TMP/ciphertext" bs=1 seek=20 conv=notrunc 2>/dev/null
+(
+	. "$TOP/functions.sh"
+	aead_decrypt "$TMP/ciphertext" "$TMP/key" "$TMP/decrypted"
+) && die "tampered ciphertext: aead_decrypt should have failed"
+
+warn "all tests passed"